@@ -2,7 +2,9 @@
 
 import sys
 import os
+import time
 import logging
+import __builtin__
 
 from . import config
 debug = config.debug
@@ -10,6 +12,53 @@ debug = config.debug
 if debug:
     logging.getLogger().setLevel(logging.DEBUG)
 
+
+class ImportTimer(object):
+    """Times the imports of new modules, to report what a cold start costs.
+
+    Each import is charged its own time, excluding the time of the imports
+    it makes.
+    """
+    def __init__(self):
+        self.times = {}     # module name -> [seconds, seconds excluding nested imports]
+        self.nested = []    # Seconds spent in nested imports, per active import.
+        self.original = None
+
+    def install(self):
+        self.original = __builtin__.__import__
+        __builtin__.__import__ = self.timed_import
+
+    def uninstall(self):
+        __builtin__.__import__ = self.original
+
+    def timed_import(self, name, *args, **kw):
+        modules = len(sys.modules)
+        start = time.time()
+        self.nested.append(0.0)
+        try:
+            return self.original(name, *args, **kw)
+        finally:
+            elapsed = time.time() - start
+            own = elapsed - self.nested.pop()
+            if self.nested:
+                self.nested[-1] += elapsed
+            if len(sys.modules) != modules:
+                total = self.times.setdefault(name, [0.0, 0.0])
+                total[0] += elapsed
+                total[1] += own
+
+    def report(self, count=25):
+        """Return the slowest imports, as lines of text."""
+        times = sorted(self.times.items(), key=lambda item: -item[1][1])
+        lines = ['%8.1f ms %8.1f ms  %s' % (own * 1000, elapsed * 1000, name)
+                 for name, (elapsed, own) in times[:count]]
+        return ['     own    total  module'] + lines
+
+import_timer = None
+if config.profile_imports:
+    import_timer = ImportTimer()
+    import_timer.install()
+
 def get_this_module():
     this = sys.modules.get(__name__, None)
     if not this:
@@ -61,8 +110,6 @@ elif sys.version_info[:2] < (2, 8):
     # google.appengine.ext.webapp.template.  Most of this is taken from
     # the old module.
     from types import ModuleType
-    from django.template import Context
-    import django.template.loader
     
     def _swap_settings(new):
         old = {}
@@ -73,29 +120,32 @@ elif sys.version_info[:2] < (2, 8):
     
     template_cache = {}
     def render(template_path, template_dict, debug=False):
+        from django.template import Context
+        import django.template.loader
+
         abspath = os.path.abspath(template_path)
 
         template = None
         if not debug:
             template = template_cache.get(abspath, None)
         
-        if not template:
-            directory, file_name = os.path.split(abspath)
-            new_settings = {
-                'TEMPLATE_DIRS': (directory,),
-                'TEMPLATE_DEBUG': debug,
-                'DEBUG': debug,
-            }
-            old_settings = _swap_settings(new_settings)
-            try:
+        directory, file_name = os.path.split(abspath)
+        new_settings = {
+            'TEMPLATE_DIRS': (directory,),
+            'TEMPLATE_DEBUG': debug,
+            'DEBUG': debug,
+        }
+        old_settings = _swap_settings(new_settings)
+        try:
+            if not template:
                 template = django.template.loader.get_template(file_name)
-
-                return template.render(Context(template_dict))
-            finally:
-                _swap_settings(old_settings)
-        
                 if not debug:
                     template_cache[abspath] = template
+
+            # Templates they extend or include are looked up while rendering.
+            return template.render(Context(template_dict))
+        finally:
+            _swap_settings(old_settings)
     
     template_module_name = 'google.appengine.ext.webapp.template'
     template = ModuleType(name=template_module_name)
@@ -135,38 +185,10 @@ def initialize():
         
         sys.path.append(os.path.join(APPZIPPATH, APPDIRNAME))
         sys.path.append(APPZIPPATH)
-        
-        # Must do this "wasted" import to have google do some special
-        # configuration of the django module first.  Then we can add
-        # the custom zipfile template loader.  Why isn't google's code
-        # written to make this easier?
-        from google.appengine.ext.webapp import template
-        from django.conf import settings
-        # Some django settings are cached and so can't reliably modified at
-        # runtime.  The TEMPLATE_LOADERS _is_ one of them up to 1.1.0 final.
-        # So we must clear the cache
-        settings.TEMPLATE_LOADERS += ('app.zip_loader.load_template_source',)
-        
-        import django.template
-        from django.template import loader
-        # Save the current cache and clear the cache to remake with new
-        # loaders
-        template_source_loaders = loader.template_source_loaders
-        loader.template_source_loaders = None
-        try:
-            loader.find_template_source('__non-existant-template__.tmpl')
-        except django.template.TemplateDoesNotExist:
-            # Merge the new loaders with old cached ones, making sure the
-            # new ones are tried after the old ones
-            for ldr in loader.template_source_loaders:
-                if template_source_loaders and ldr not in template_source_loaders:
-                    template_source_loaders += (ldr,)
-        finally:
-            # If not expected exception is raised or no exception, this
-            # will set the cache back to its previous value.  Otherwise,
-            # it uses the new merged cache
-            loader.template_source_loaders = template_source_loaders
-        
+
+        # The zipfile template loader is added by template(), when a page
+        # is first rendered.
+
     elif os.path.isdir(APPDIRPATH):
         sys.path.append(os.path.dirname(BASEDIR))
         sys.path.append(os.path.join(BASEDIR, APPDIRNAME))
@@ -175,9 +197,61 @@ def initialize():
         raise Exception("Could not find app")
 
 
+def install_zip_template_loader():
+    # Must do this "wasted" import to have google do some special
+    # configuration of the django module first.  Then we can add
+    # the custom zipfile template loader.  Why isn't google's code
+    # written to make this easier?
+    from google.appengine.ext.webapp import template
+    from django.conf import settings
+    # Some django settings are cached and so can't reliably modified at
+    # runtime.  The TEMPLATE_LOADERS _is_ one of them up to 1.1.0 final.
+    # So we must clear the cache
+    settings.TEMPLATE_LOADERS += ('app.zip_loader.load_template_source',)
+
+    import django.template
+    from django.template import loader
+    # Save the current cache and clear the cache to remake with new
+    # loaders
+    template_source_loaders = loader.template_source_loaders
+    loader.template_source_loaders = None
+    try:
+        loader.find_template_source('__non-existant-template__.tmpl')
+    except django.template.TemplateDoesNotExist:
+        # Merge the new loaders with old cached ones, making sure the
+        # new ones are tried after the old ones
+        for ldr in loader.template_source_loaders:
+            if template_source_loaders and ldr not in template_source_loaders:
+                template_source_loaders += (ldr,)
+    finally:
+        # If not expected exception is raised or no exception, this
+        # will set the cache back to its previous value.  Otherwise,
+        # it uses the new merged cache
+        loader.template_source_loaders = template_source_loaders
+
+
+_template_ready = []
+
+def template():
+    """Return the webapp template module.  Django, and the zipfile template
+    loader if needed, are only set up when a page is first rendered, so that
+    requests which don't render one don't pay for it.
+    """
+    from google.appengine.ext.webapp import template
+    if not _template_ready:
+        if os.path.isfile(APPZIPPATH):
+            install_zip_template_loader()
+        _template_ready.append(True)
+    return template
+
+
 initialize()
 from app.console import application, main
 
+if import_timer:
+    import_timer.uninstall()
+    logging.info('Console startup imports:\n%s' % '\n'.join(import_timer.report()))
+
 
 if __name__ == '__main__':
     main()
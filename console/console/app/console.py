@@ -38,6 +38,13 @@ application = webapp.WSGIApplication([
     ('/console/dashboard/'  , controller.Dashboard),
     ('/console/help.*'      , controller.Help),
     ('/console/statement'   , controller.Statement),
+    ('/console/statements'  , controller.Statements),
+    ('/console/output'      , controller.Output),
+    ('/console/complete'    , controller.Complete),
+    ('/console/share'       , controller.Share),
+    ('/console/history'     , controller.History),
+    ('/console/history/search', controller.HistorySearch),
+    ('/console/sweep'       , controller.Sweep),
     ('/console/banner'      , controller.Banner),
     ('/console/static/(.*)' , static.ConsoleStaticZipHandler),
     ('/console.*'           , controller.Console),
@@ -25,23 +25,27 @@ import sys
 import cgi
 import sets
 import string
+import hashlib
 import logging
+import datetime
 import traceback
 import exceptions
 
-import pygments
-import pygments.lexers
-import pygments.formatters
-
 import util
 import model
+import ratelimit
+import model.output
+import model.complete
+import model.history
+import model.session
+import console
 from console import config
 
 from google.appengine.api        import users
 from google.appengine.api        import memcache
 from google.appengine.ext        import db
+from google.appengine.ext.db     import stats
 from google.appengine.ext        import webapp
-from google.appengine.ext.webapp import template
 from django.utils                import simplejson
 
 # Unpicklable statements to seed new sessions with.
@@ -53,11 +57,148 @@ INITIAL_UNPICKLABLES = [
                'finally: del sys'])
 ]
 
-DOCUMENTED_EXCEPTIONS = sets.Set()
-for name in dir(exceptions):
-    e = getattr(exceptions, name)
-    if (type(e) is type) and issubclass(e, exceptions.BaseException):
-        DOCUMENTED_EXCEPTIONS.add(e)
+# Pygments, and the objects below made with it, are only loaded once they're
+# needed: most requests don't highlight anything.
+@util.once
+def pythonLexer():
+    from pygments.lexers.agile import PythonLexer
+    return PythonLexer()
+
+@util.once
+def consoleLexer():
+    from pygments.lexers.agile import PythonConsoleLexer
+    return PythonConsoleLexer()
+
+def htmlFormatter(cssclass):
+    from pygments.formatters.html import HtmlFormatter
+    return HtmlFormatter(cssclass=cssclass)
+
+@util.once
+def documentedExceptions():
+    """Return the set of exceptions documented in the Python library reference."""
+    documented = sets.Set()
+    for name in dir(exceptions):
+        e = getattr(exceptions, name)
+        if (type(e) is type) and issubclass(e, exceptions.BaseException):
+            documented.add(e)
+    return documented
+
+# Output which can be linked to the Python documentation, as one pattern.  Each
+# alternative names the documentation page to link to.
+DOC_LINK_RE = re.compile(
+    r"^(?:<(?P<lib_module>module '(?P<lib_module_name>.*?)') from '%s/lib/python%d\.%d/(?P=lib_module_name)\.py[co]?'>"
+    r"|(?P<truth>None|False|True)"
+    r"|<type '(?P<numeric>int|float|long|complex)'>"
+    r"|<type '(?P<sequence>str|unicode|list|tuple|buffer|xrange)'>"
+    r"|<type '(?P<set>set|frozenset)'>"
+    r"|<type '(?P<mapping>dict)'>"
+    r"|<type '(?P<file>file)'>"
+    r")$"
+    r"|<(?P<builtin_module>module '(?P<builtin_module_name>.*?)') \(built-in\)>$"
+    % (re.escape(sys.prefix), sys.version_info[0], sys.version_info[1]))
+
+DOC_LINK_PATHS = {
+    'truth'    : '/library/stdtypes.html#truth-value-testing',
+    'numeric'  : '/library/stdtypes.html#numeric-types-int-float-long-complex',
+    'sequence' : '/library/stdtypes.html#sequence-types-str-unicode-list-tuple-buffer-xrange',
+    'set'      : '/library/stdtypes.html#set-types-set-frozenset',
+    'mapping'  : '/library/stdtypes.html#mapping-types-dict',
+    'file'     : '/library/stdtypes.html#file-objects',
+}
+
+# Highlighted HTML is cached per instance, up to this many items or characters, and
+# in memcache for text long enough that lexing it costs more than fetching it.
+HIGHLIGHT_CACHE_ITEMS = 1000
+HIGHLIGHT_CACHE_SIZE = 1024 * 1024
+HIGHLIGHT_MEMCACHE_MIN = 256
+HIGHLIGHT_CACHE_TIME = 24 * 60 * 60
+
+highlightCache = util.LRUCache(HIGHLIGHT_CACHE_ITEMS, HIGHLIGHT_CACHE_SIZE)
+
+def cachedHighlight(code, lexer, name, render, weigh):
+    """Return render(), cached by the lexer, the name of the rendering and a hash of
+    the code.  The weight of the result in the cache is weigh(result).
+    """
+    # Output is often a byte string, which may not be ASCII.
+    data = code
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    digest = hashlib.md5(data).hexdigest()
+    key = '%s:%s:%s' % (lexer.__class__.__name__, name, digest)
+
+    result = highlightCache.get(key)
+    if result is not None:
+        return result
+
+    use_memcache = config.highlight_memcache and len(code) >= HIGHLIGHT_MEMCACHE_MIN
+    if use_memcache:
+        result = memcache.get('console:highlight:%s' % key)
+
+    if result is None:
+        result = render()
+        if use_memcache:
+            memcache.set('console:highlight:%s' % key, result, HIGHLIGHT_CACHE_TIME)
+
+    highlightCache.put(key, result, weigh(result))
+    return result
+
+def highlight(code, lexer, formatter):
+    """Return pygments.highlight(code, lexer, formatter), cached."""
+    def render():
+        import pygments
+        return pygments.highlight(code, lexer, formatter)
+    return cachedHighlight(code, lexer, formatter.cssclass, render, len)
+
+# For highlighting in the browser, token types are sent as numbers: indexes into
+# the CSS classes of the token types the highlighting style has rules for.  Other
+# token types are sent as their closest styled parent, which looks the same.
+# Every console page lists these classes, so they are kept here rather than
+# worked out with Pygments, which a test checks them against: the class of the
+# root token type, then those of the styled types in order.
+TOKEN_CLASSES = [
+    '', 'c', 'cm', 'cp', 'c1', 'cs', 'err', 'gd', 'ge', 'gr', 'gh', 'gi', 'go',
+    'gp', 'gs', 'gu', 'gt', 'k', 'kc', 'kd', 'kn', 'kp', 'kr', 'kt', 'm', 'mf',
+    'mh', 'mi', 'il', 'mo', 's', 'sb', 'sc', 'sd', 's2', 'se', 'sh', 'si', 'sx',
+    'sr', 's1', 'ss', 'na', 'nb', 'bp', 'nc', 'no', 'nd', 'ni', 'ne', 'nf', 'nl',
+    'nn', 'nt', 'nv', 'vc', 'vg', 'vi', 'o', 'ow', 'w',
+]
+
+tokenIds = {}
+
+@util.once
+def styledTokenIds():
+    """Fill in the IDs of the token types the style has rules for."""
+    ids = dict([(cls, i) for i, cls in enumerate(TOKEN_CLASSES)])
+    for ttype, cls in htmlFormatter('').ttype2class.items():
+        tokenIds[ttype] = ids[cls]
+
+def tokenId(ttype):
+    """Return the number a token type is sent as."""
+    styledTokenIds()
+    styled = ttype
+    while styled not in tokenIds:
+        styled = styled.parent
+    tokenIds[ttype] = tokenIds[styled]
+    return tokenIds[ttype]
+
+def tokenize(code, lexer):
+    """Return the tokens of code as [token ID, text] pairs, for highlighting in the
+    browser.  Neighbouring tokens which look the same are merged.
+    """
+    def render():
+        tokens = []
+        for ttype, text in lexer.get_tokens(code):
+            id = tokenId(ttype)
+            if tokens and tokens[-1][0] == id:
+                tokens[-1][1] += text
+            else:
+                tokens.append([id, text])
+        return tokens
+
+    def weigh(tokens):
+        return sum([len(text) + 8 for id, text in tokens])
+
+    return cachedHighlight(code, lexer, 'tokens', render, weigh)
 
 def confirm_permission():
     """Raises an exception if the user does not have permission to execute a statement"""
@@ -91,6 +232,15 @@ def username():
         name = '[Unknown User]'
     return '%s (%s)' % (name, os.environ['REMOTE_ADDR'])
 
+def owner():
+    """Return who the statement history belongs to: the user, or for anonymous
+    users (only allowed in development), their address.
+    """
+    user = users.get_current_user()
+    if user:
+        return 'user:%s' % user.email()
+    return 'ip:%s' % ratelimit.remote_addr()
+
 
 class HandlerError(Exception):
     """A handler can not process a request normally"""
@@ -107,6 +257,14 @@ class NotAdminError(ConsoleError):
 class TooFastError(ConsoleError):
     """The rate of statements it too high"""
 
+class SessionExpiredError(ConsoleError):
+    """The session has been deleted"""
+
+class NotSharedError(ConsoleError):
+    """The session belongs to somebody else, who has not shared it"""
+
+NOT_SHARED_MESSAGE = 'This console session is no longer shared. Please reload the page to start a new one.'
+
 class ConsoleHandler(webapp.RequestHandler):
     """This is a normal webapp request handler, but if the user does not have permission
     to access the page, it will 404 if configured to do so.
@@ -115,6 +273,13 @@ class ConsoleHandler(webapp.RequestHandler):
     # This value is only used for the App Engine Console public web site, to prevent abuse.
     PUBLIC_STATEMENT_LIMIT = 10   # 10 statements per minute
 
+    # Everybody behind the same proxy shares the limit; ratelimit.BY_USER would
+    # give logged-in users their own.
+    statementLimiter = ratelimit.RateLimiter('statements', PUBLIC_STATEMENT_LIMIT, 60, ratelimit.BY_IP)
+
+    # The most statements which may be run in one batch request.
+    BATCH_STATEMENT_LIMIT = 500
+
     def safe_get(self):
         try:
             confirm_permission()
@@ -131,68 +296,78 @@ class ConsoleHandler(webapp.RequestHandler):
 
 
 class Statement(ConsoleHandler):
-    lexer           = pygments.lexers.PythonLexer()
-    resultLexer     = pygments.lexers.PythonConsoleLexer()
-    inputFormatter  = pygments.formatters.HtmlFormatter(cssclass='statement')
-    outputFormatter = pygments.formatters.HtmlFormatter(cssclass='stdout')
-    errorFormatter  = pygments.formatters.HtmlFormatter(cssclass='stderr')
-
-    def confirmPostRate(self):
-        """Make sure anybody using the site doesn't post too quickly and use up resources."""
+    lexer           = util.lazy(pythonLexer)
+    resultLexer     = util.lazy(consoleLexer)
+    inputFormatter  = util.lazy(lambda: htmlFormatter('statement'))
+    outputFormatter = util.lazy(lambda: htmlFormatter('stdout'))
+    errorFormatter  = util.lazy(lambda: htmlFormatter('stderr'))
+
+    PLAIN_TEMPLATE_CHANGES = { 'login_link' : 'log in', 'logout_link': 'log out', 'download':'downloading App Engine Console' }
+
+    def confirmPostRate(self, count=1):
+        """Make sure anybody using the site doesn't post too quickly and use up resources.
+        The count is the number of statements being posted.
+        """
         if not util.is_my_website():
             return
 
-        # Ideally, the REMOTE_ADDR combined with HTTP_X_FORWARDED_FOR reasonably identifies a unique user.  But
-        # someone could just change their FORWARDED_FOR header all the time and get around this limit, so we
-        # just make everybody behind the same proxy suffer.
-        requester = os.environ.get('REMOTE_ADDR', 'unknown')
-        #requester += ',' + os.environ.get('HTTP_X_FORWARDED_FOR', '')
-
-        # XXX: There is a small risk here since no distinction is made between "key does not exist"
-        # and "failed to increment key for some other reason.
-        numStatements = memcache.incr(requester)
-        if numStatements is None:
-            # Start a fresh timer to limit the statements.
-            result = memcache.add(requester, 1, 60)     # 60-second timeout
-            if result == False:
-                logging.error('Failed to set memcache for: %s' % requester)
-                self.error(403)
-                raise HandlerError('Memcache error')
-        elif numStatements > self.PUBLIC_STATEMENT_LIMIT:
-                logging.info('Denying statement %d: %s' % (numStatements, username()))
-                raise TooFastError('Sorry, your statements are too frequent. Please wait one minute or consider ${download}.')
+        allowed = self.statementLimiter.attempt(count)
+        if allowed is None:
+            self.error(403)
+            raise HandlerError('Memcache error')
+        elif not allowed:
+            logging.info('Denying statements: %s' % username())
+            raise TooFastError('Sorry, your statements are too frequent. Please wait one minute or consider ${download}.')
 
     def post(self):
         """Process a statement and return output and error messages"""
-        code = self.request.get('code')
-        output_templating = False
-        out, err, exc_type = ('', '', None)
+        responses = self.execute([self.request.get('code')])
+        if responses is None:
+            return
 
+        self.response.headers['Content-Type'] = 'application/x-javascript'
+        self.response.out.write(simplejson.dumps(responses[0]))
+
+    def execute(self, codes):
+        """Process statements in order, in one session, and return a response for
+        each.  Return None if the request has already been answered.
+        """
         try:
             confirm_permission()
-            self.confirmPostRate()
+            self.confirmPostRate(len(codes))
+
+            session_key = self.request.get('session')
+            engine = model.AppEngineConsole.load(session_key)
+            if engine is None:
+                raise SessionExpiredError('This console session has expired. Please reload the page to start a new one.')
+            if not engine.mayUse(owner()):
+                raise NotSharedError(NOT_SHARED_MESSAGE)
         except ConsoleError:
             # Acces denied.
-            logging.info('Access denied (%s): %s\n%s' % (exc_type, username(), code))
             exc_type, exc_value, tb = sys.exc_info()
-            err = self.formatConsoleError(code, exc_type, exc_value)
-            result = False
-            output_templating = True
+            logging.info('Access denied (%s): %s\n%s' % (exc_type, username(), '\n'.join(codes)))
+            err = self.formatConsoleError(codes[0], exc_type, exc_value)
+            response = self.buildResponse(codes[0], '', err, exc_type, True)
+            response['result'] = False
+            return [response]
         except HandlerError:
             # This can happen for a permission denial, e.g. with the rate limiter.
-            return
-        else:
-            # Access granted.
-            session_key = self.request.get('session')
-            engine = model.AppEngineConsole.get(session_key)
-            result = engine.runsource(code)
-            out = engine.out
-            err = engine.err
+            return None
 
-        self.response.headers['Content-Type'] = 'application/x-javascript'
-        response = self.buildResponse(code, out, err, exc_type, output_templating)
-        response['result'] = result
-        self.response.out.write(simplejson.dumps(response))
+        # Access granted.
+        stream = self.request.get('stream') or None
+        responses = []
+        try:
+            for code, (result, out, err, exc_type) in zip(codes, engine.runsources(codes, stream)):
+                response = self.buildResponse(code, out, err)
+                response['result'] = result
+                responses.append(response)
+        finally:
+            try:
+                model.history.append(owner(), codes)
+            except db.Error:
+                logging.warning('Could not save the history of %s:\n%s' % (owner(), traceback.format_exc()))
+        return responses
 
     def formatConsoleError(self, code, exc_type, exc_value):
         """Format a ConsoleError exception for sending back to the client."""
@@ -203,10 +378,19 @@ class Statement(ConsoleHandler):
 
     def buildResponse(self, code, out='', err='', exc_type=None, templating=False):
         """Given the output and error messages of a statement, prepare them for sending via JSON."""
-        highlighting = (self.request.get('highlight') != '0')
+        mode = self.request.get('highlight')
+        if mode == 'tokens':
+            # The browser highlights the tokens, without links to the documentation.
+            if templating:
+                err = string.Template(err).safe_substitute(self.PLAIN_TEMPLATE_CHANGES)
+            return {'in' : tokenize(code, self.lexer),
+                    'out': out and tokenize(out, self.resultLexer) or [],
+                    'err': err and tokenize(err, self.resultLexer) or []}
+
+        highlighting = (mode != '0')
         if highlighting:
             logging.debug('Highlighting code')
-            code = pygments.highlight(code, self.lexer, self.inputFormatter)
+            code = highlight(code, self.lexer, self.inputFormatter)
 
             if out:
                 out = self.highlight(out)
@@ -219,7 +403,7 @@ class Statement(ConsoleHandler):
                             'logout_link': ('<a href="%s">log out</a>' % users.create_logout_url('/console/')),
                             'download'   : '<a href="http://www.proven-corporation.com/software/app-engine-console/">downloading App Engine Console</a>'}
             else:
-                changes = { 'login_link' : 'log in', 'logout_link': 'log out', 'download':'downloading App Engine Console' }
+                changes = self.PLAIN_TEMPLATE_CHANGES
             err = string.Template(err).safe_substitute(changes)
 
         return {'in':code, 'out': out + err,}
@@ -231,7 +415,7 @@ class Statement(ConsoleHandler):
         if exc_type:
             formatter = self.errorFormatter
 
-        output = pygments.highlight(plain, self.resultLexer, formatter).strip()
+        output = highlight(plain, self.resultLexer, formatter).strip()
 
         # Fancy linking to documented parts of Python.
         if not config.python_doc_linking:
@@ -244,58 +428,198 @@ class Statement(ConsoleHandler):
             """Return an HTML link to the documentation"""
             return '<a href="%s%s">%s</a>' % (config.python_doc, path, name)
 
-        if exc_type in DOCUMENTED_EXCEPTIONS:
+        if exc_type in documentedExceptions():
             name = exc_type.__name__
             link = doclink('/library/exceptions.html#exceptions.%s' % name, name)
 
-        match = re.search(r"<(module '(.*?)') \(built-in\)>$", plain)
+        match = DOC_LINK_RE.search(plain)
         if match:
-            name, mod_name = match.groups()
-            name = name.replace("'", '&#39;')
-            link = doclink('/library/%s.html' % mod_name, name)
+            groups = match.groupdict()
+            for module_group in ('lib_module', 'builtin_module'):
+                if groups[module_group]:
+                    name = groups[module_group].replace("'", '&#39;')
+                    link = doclink('/library/%s.html' % groups[module_group + '_name'], name)
+            for group, path in DOC_LINK_PATHS.items():
+                if groups[group]:
+                    name = groups[group]
+                    link = doclink(path, name)
 
-        moduleRE = r"^<(module '(.*?)') from '%s/lib/python%d.%d/\2\.py[co]?'>$" % (sys.prefix, sys.version_info[0], sys.version_info[1])
-        match = re.search(moduleRE, plain)
-        if match:
-            name, mod_name = match.groups()
-            name = name.replace("'", '&#39;')
-            link = doclink('/library/%s.html' % mod_name, name)
+        # Finally, do the replacing if needed.
+        if name and link:
+            logging.debug("Replacing output:\nold: %s\nnew: %s" % (name, link))
+            output = output.replace(name, link)
 
-        match = re.search(r'^(None|False|True)$', plain)
-        if match:
-            name = match.groups()[0]
-            link = doclink('/library/stdtypes.html#truth-value-testing', name)
+        return output
 
-        match = re.search(r"^<type '(int|float|long|complex)'>$", plain)
-        if match:
-            name = match.groups()[0]
-            link = doclink('/library/stdtypes.html#numeric-types-int-float-long-complex', name)
 
-        match = re.search(r"^<type '(str|unicode|list|tuple|buffer|xrange)'>$", plain)
-        if match:
-            name = match.groups()[0]
-            link = doclink('/library/stdtypes.html#sequence-types-str-unicode-list-tuple-buffer-xrange', name)
+class Statements(Statement):
+    """Process several statements, e.g. a pasted script, in one request."""
+    def post(self):
+        """Process statements in order and return the output and error messages of each"""
+        codes = self.request.get_all('code')
+        if not codes:
+            self.error(400)
+            return
+        if len(codes) > self.BATCH_STATEMENT_LIMIT:
+            self.error(413)
+            return
 
-        match = re.search(r"^<type '(set|frozenset)'>$", plain)
-        if match:
-            name = match.groups()[0]
-            link = doclink('/library/stdtypes.html#set-types-set-frozenset', name)
+        responses = self.execute(codes)
+        if responses is None:
+            return
 
-        if plain == "<type 'dict'>":
-            name = 'dict'
-            link = doclink('/library/stdtypes.html#mapping-types-dict', name)
+        self.response.headers['Content-Type'] = 'application/x-javascript'
+        self.response.out.write(simplejson.dumps({'results': responses}))
 
-        if plain == "<type 'file'>":
-            name = 'file'
-            link = doclink('/library/stdtypes.html#file-objects', name)
+class Output(ConsoleHandler):
+    """Return the output streamed so far by a statement which is still running."""
+    def get(self):
+        try:
+            confirm_permission()
+        except ConsoleError:
+            self.error(403)
+            return
 
-        # Finally, do the replacing if needed.
-        if name and link:
-            logging.debug("Replacing output:\nold: %s\nnew: %s" % (name, link))
-            output = output.replace(name, link)
+        stream = self.request.get('stream')
+        try:
+            chunk = int(self.request.get('chunk', '0'))
+        except ValueError:
+            self.error(400)
+            return
 
-        return output
+        out, chunk = model.output.fetchChunks(stream, chunk)
+        self.response.headers['Content-Type'] = 'application/x-javascript'
+        self.response.out.write(simplejson.dumps({'out': out, 'chunk': chunk}))
+
+class Complete(ConsoleHandler):
+    """Return the completions of the name being typed, which ends the given text."""
+    def get(self):
+        try:
+            confirm_permission()
+        except ConsoleError:
+            self.error(403)
+            return
+
+        try:
+            session_key = str(db.Key(self.request.get('session')))
+        except db.BadKeyError:
+            self.error(400)
+            return
+
+        try:
+            completed = model.complete.complete(session_key, self.request.get('text'), owner())
+        except model.complete.NotShared:
+            logging.info('Access denied (not shared): %s' % username())
+            self.error(403)
+            self.response.headers['Content-Type'] = 'application/x-javascript'
+            self.response.out.write(simplejson.dumps({'error': NOT_SHARED_MESSAGE}))
+            return
+        if completed is None:
+            self.error(404)
+            return
+
+        start, names = completed
+        self.response.headers['Content-Type'] = 'application/x-javascript'
+        self.response.out.write(simplejson.dumps({'start': start, 'completions': names}))
+
+class Share(ConsoleHandler):
+    """Share the session (shared=1) with anybody who has its address, or stop
+    sharing it (shared=0).  Only the owner may.
+    """
+    def post(self):
+        try:
+            confirm_permission()
+        except ConsoleError:
+            self.error(403)
+            return
 
+        try:
+            engine = model.AppEngineConsole.load(self.request.get('session'))
+        except db.BadKeyError:
+            self.error(400)
+            return
+        if engine is None:
+            self.error(404)
+            return
+        if engine.owner and engine.owner != owner():
+            self.error(403)
+            return
+
+        engine.share(self.request.get('shared') == '1')
+        try:
+            engine.put()
+        except model.console.SessionConflict:
+            # Sharing touches no globals, so only a very busy session gets here.
+            self.error(503)
+            return
+        self.response.headers['Content-Type'] = 'application/x-javascript'
+        self.response.out.write(simplejson.dumps({'shared': engine.shared}))
+
+class History(ConsoleHandler):
+    """Return a page of the user's statement history, ending before the given
+    statement number (or at the latest).
+    """
+    def get(self):
+        try:
+            confirm_permission()
+        except ConsoleError:
+            self.error(403)
+            return
+
+        try:
+            before = None
+            if self.request.get('before'):
+                before = int(self.request.get('before'))
+            count = int(self.request.get('count', model.history.PAGE_SIZE))
+        except ValueError:
+            self.error(400)
+            return
+
+        start, statements = model.history.page(owner(), before, count)
+        self.response.headers['Content-Type'] = 'application/x-javascript'
+        self.response.out.write(simplejson.dumps({'start': start, 'statements': statements}))
+
+class HistorySearch(ConsoleHandler):
+    """Return the latest statements of the user's history containing (or, with
+    prefix=1, starting with) the query, numbered below before, newest first.
+    """
+    def get(self):
+        try:
+            confirm_permission()
+        except ConsoleError:
+            self.error(403)
+            return
+
+        try:
+            before = None
+            if self.request.get('before'):
+                before = int(self.request.get('before'))
+            count = int(self.request.get('count', model.history.PAGE_SIZE))
+        except ValueError:
+            self.error(400)
+            return
+
+        results = model.history.search(owner(), self.request.get('q'), before,
+                                       prefix=(self.request.get('prefix') == '1'), count=count)
+        self.response.headers['Content-Type'] = 'application/x-javascript'
+        self.response.out.write(simplejson.dumps({'results': results}))
+
+class Sweep(webapp.RequestHandler):
+    """Delete idle sessions.  This is requested by cron (see cron.yaml), or by an admin."""
+    def get(self):
+        is_cron = (self.request.headers.get('X-AppEngine-Cron') == 'true')
+        if not (is_cron or users.is_current_user_admin()):
+            self.error(403)
+            return
+
+        result = {'finished': True}
+        if config.session_max_idle_days is not None:
+            max_idle = datetime.timedelta(days=config.session_max_idle_days)
+            result = model.AppEngineConsole.sweep(max_idle)
+            result['time'] = str(result['time'])
+
+        self.response.headers['Content-Type'] = 'application/x-javascript'
+        self.response.out.write(simplejson.dumps(result))
 
 class Banner(ConsoleHandler):
     def get(self):
@@ -307,8 +631,39 @@ class Banner(ConsoleHandler):
         self.response.headers['Content-Type'] = 'application/x-javascript'
         self.response.out.write(simplejson.dumps({'banner':banner}))
 
+class PageClass(type):
+    """Works out what a page class needs for every request -- its name, the pattern of
+    its sub-page paths, and the template values which don't depend on the request --
+    once, when the class is defined.
+    """
+    def __init__(cls, name, bases, attrs):
+        type.__init__(cls, name, bases, attrs)
+        cls.page = name.lower()
+        cls.subpageRE = re.compile(r'^/console/%s/(.+)$' % re.escape(cls.page))
+
+        values = {}
+        values['app']        = cls.appID
+        values['is_dev']     = util.is_dev()
+        values['version']    = cls.appVersion
+        values['subpages']   = cls.subpages
+        values['controller'] = cls.page.capitalize()
+
+        values['pages']    = [ {'name':'Console'   , 'href':'/console/'},
+                               {'name':'Dashboard' , 'href':'/console/dashboard/'},
+                               {'name':'Help'      , 'href':'/console/help/'},
+                             ]
+
+        if util.is_my_website():
+            values['my_website'] = True
+            values['app'] = 'App Engine Console'
+            values['version'] = re.sub(r'\.\d$', '', values['version'])
+
+        cls.classValues = values
+
 class Page(ConsoleHandler):
     """A human-visible "page" that presents itself to a person."""
+    __metaclass__ = PageClass
+
     templates = os.path.join(
         os.path.dirname(
             os.path.dirname(__file__)),
@@ -323,33 +678,16 @@ class Page(ConsoleHandler):
         self.do_get = self.get
         self.get = self.wrap_get
 
-        myClass = re.search(r"<class '.*\.(.*)'", str(self.__class__)).groups()[0]
-        self.page = myClass.lower()
-
         path = os.environ['PATH_INFO']
 
-        self.values = {}
-        self.values['app']        = self.appID
+        # Only the values which depend on the request are worked out here.
+        self.values = dict(self.classValues)
         self.values['path']       = path
         self.values['admin']      = users.is_current_user_admin()
-        self.values['is_dev']     = util.is_dev()
         self.values['log_in']     = users.create_login_url(path)
         self.values['log_out']    = users.create_logout_url(path)
-        self.values['version']    = self.appVersion
-        self.values['subpages']   = self.subpages
-        self.values['controller'] = self.page.capitalize()
 
-        self.values['pages']    = [ {'name':'Console'   , 'href':'/console/'},
-                                    {'name':'Dashboard' , 'href':'/console/dashboard/'},
-                                    {'name':'Help'      , 'href':'/console/help/'},
-                                  ]
-
-        if util.is_my_website():
-            self.values['my_website'] = True
-            self.values['app'] = 'App Engine Console'
-            self.values['version'] = re.sub(r'\.\d$', '', self.values['version'])
-
-        match = re.search(r'^/console/%s/(.+)$' % self.page, path)
+        match = self.subpageRE.search(path)
         if match:
             # Handle a sub-path which is within the main controller path (e.g. /help/something instead of just /help).
             self.values['subpage'] = match.groups()[0]
@@ -363,7 +701,7 @@ class Page(ConsoleHandler):
         self.template = os.path.join(self.templates, templateFile)
 
     def write(self):
-        self.response.out.write(template.render(self.template, self.values))
+        self.response.out.write(console.template().render(self.template, self.values))
 
     def wrap_get(self):
         self.values['user'] = users.get_current_user()
@@ -375,22 +713,25 @@ class Console(Page):
     subpages = []
 
     def get(self):
-        # Set up the session. TODO: garbage collect old shell sessions
+        # Set up the session.  Idle sessions are deleted by Sweep.
         try:
             confirm_permission()
         except ConsoleError:
             # No reason to use up space if the statements won't execute anyway
             session_key = ''
+            shared = False
         else:
             # Access granted.
             session_key = self.request.get('session')
+            engine = None
             if session_key:
-                engine = model.AppEngineConsole.get(session_key)
-            else:
+                engine = model.AppEngineConsole.load(session_key)
+            if engine is None or not engine.mayUse(owner()):
                 # Create a new session.
-                engine = model.AppEngineConsole()
+                engine = model.AppEngineConsole(owner=owner())
                 engine.unpicklables = [db.Text(line) for line in INITIAL_UNPICKLABLES]
                 session_key = engine.put()
+            shared = engine.shared
 
         if util.is_my_website():
             self.values['ratelimit'] = self.PUBLIC_STATEMENT_LIMIT
@@ -407,9 +748,11 @@ class Console(Page):
             {'id':'session'  , 'value':session_key       , 'type':'hidden'},
             {'id':'room'     , 'value':room              , 'type':'hidden'},
             {'id':'pastebin' , 'value':pastebin          , 'type':'hidden'},
+            {'id':'tokens'   , 'value':' '.join(TOKEN_CLASSES), 'type':'hidden'},
+            {'id':'shared'   , 'value':shared and '1' or '0', 'type':'hidden'},
 
-            {'id':'highlight', 'options': ['Highlighting', 'No highlighting']},
-            {'id':'teamwork' , 'options': ['Flying Solo' , 'Pastebin', 'Chatting']},
+            {'id':'highlight', 'options': ['Highlighting', 'Browser highlighting', 'No highlighting']},
+            {'id':'teamwork' , 'options': ['Flying Solo' , 'Pastebin', 'Chatting', 'Sharing']},
         ]
 
 
@@ -433,14 +776,35 @@ class Dashboard(Page):
             options.append('Analytics')
             self.values['settings'].append({'type':'hidden', 'id':'dash_url_analytics', 'value':config.analytics_id})
 
+        if self.values['admin']:
+            self.values['session_stats'] = self.sessionStats()
+
+    def sessionStats(self):
+        """Return statistics about the storage and caching of console sessions."""
+        values = {'max_idle_days': config.session_max_idle_days}
+
+        # The datastore statistics are updated about once a day, in production only.
+        for name, kind in (('sessions', model.AppEngineConsole.kind()), ('globals', model.session.ShellGlobal.kind())):
+            stat = stats.KindStat.all().filter('kind_name =', kind).get()
+            if stat:
+                values[name] = {'count': stat.count, 'bytes': stat.bytes, 'timestamp': stat.timestamp}
+
+        values['last_sweep'] = memcache.get(model.console.SWEEP_RESULT_KEY)
+        values['warm_sessions'] = model.console.warmSessions.stats()
+        values['highlight_cache'] = highlightCache.stats()
+        values['rate_limiters'] = [limiter.stats() for limiter in ratelimit.limiters.values()]
+        if console.import_timer:
+            values['startup_imports'] = '\n'.join(console.import_timer.report())
+        return values
+
 
 class Help(Page):
     subpages = ['usage', 'integration', 'about']
 
-    pythonLexer     = pygments.lexers.PythonLexer()
-    resultLexer     = pygments.lexers.PythonConsoleLexer()
-    inputFormatter  = pygments.formatters.HtmlFormatter(cssclass='statement')
-    outputFormatter = pygments.formatters.HtmlFormatter(cssclass='stdout')
+    pythonLexer     = util.lazy(pythonLexer)
+    resultLexer     = util.lazy(consoleLexer)
+    inputFormatter  = util.lazy(lambda: htmlFormatter('statement'))
+    outputFormatter = util.lazy(lambda: htmlFormatter('stdout'))
 
     examples = ["""
         >>> print "hello, world"
@@ -463,25 +827,38 @@ class Help(Page):
         """
     ]
 
+    # The highlighted examples of each sub-page, made once.
+    exampleValues = {}
+
     def get(self):
         self.values['project'] = 'http://www.proven-corporation.com/software/app-engine-console/'
 
-        if self.values['subpage'] == 'usage':
+        subpage = self.values['subpage']
+        if subpage in self.subpages and subpage not in self.exampleValues:
+            self.exampleValues[subpage] = self.highlightExamples(subpage)
+        self.values.update(self.exampleValues.get(subpage, {}))
+
+    def highlightExamples(self, subpage):
+        """Return the template values of the highlighted examples of a sub-page."""
+        import pygments
+        values = {}
+        if subpage == 'usage':
             for exampleNum in range(len(self.examples)):
                 key = 'example%d' % (exampleNum + 1)
                 val = util.trim(self.examples[exampleNum])
                 val = pygments.highlight(val, self.resultLexer, self.outputFormatter).strip()
-                self.values[key] = val
-        elif self.values['subpage'] == 'integration':
-            self.values['example1'] = pygments.highlight(util.trim("""
+                values[key] = val
+        elif subpage == 'integration':
+            values['example1'] = pygments.highlight(util.trim("""
                 def is_dev():
                     import os
                     return os.environ['SERVER_SOFTWARE'].startswith('Dev')
             """), self.pythonLexer, self.outputFormatter).strip()
-            self.values['example2'] = pygments.highlight(util.trim("""
+            values['example2'] = pygments.highlight(util.trim("""
                 >>> is_dev()
                 True
             """), self.resultLexer, self.outputFormatter).strip()
+        return values
 
 class Root(Page):
     def get(self):
@@ -491,7 +868,7 @@ class Root(Page):
             self.redirect('/console/')
         self.done = True
 
-__all__ = ['Console', 'Dashboard', 'Help', 'Statement', 'Banner', 'Root']
+__all__ = ['Console', 'Dashboard', 'Help', 'Statement', 'Statements', 'Output', 'Complete', 'Share', 'History', 'HistorySearch', 'Sweep', 'Banner', 'Root']
 
 if __name__ == "__main__":
     logging.error('I should be running unit tests')
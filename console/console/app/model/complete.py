@@ -0,0 +1,244 @@
+# App Engine Console name completion
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Completion of names, attributes and module members in console sessions.
+
+Completion runs at the rate of keystrokes, so it avoids loading the session,
+and never runs any of its code.  The names of a session's globals are kept in
+memcache next to the session itself (see AppEngineConsole.cache), and each
+instance keeps a sorted index of them, by session version.  Attributes are only completed from live
+objects: those of the session's namespace if this instance holds it warm, and
+otherwise the modules already imported.
+"""
+
+from __future__ import absolute_import
+
+import re
+import sys
+import types
+import bisect
+import keyword
+import __builtin__
+
+import util
+
+# The most completions returned for one request.
+COMPLETION_LIMIT = 200
+
+# Each instance keeps the name indexes of this many sessions...
+SESSION_INDEX_ITEMS = 100
+
+# ... and of this many modules and classes.
+MEMBER_INDEX_ITEMS = 200
+
+# The dotted name being completed, at the end of the text before the cursor.
+COMPLETION_RE = re.compile(r'(?:(?P<path>[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*)\.)?(?P<prefix>[A-Za-z_]\w*)?$')
+
+class SymbolIndex(object):
+    """A sorted list of names, for quickly finding those starting with a prefix."""
+    def __init__(self, names):
+        self.names = sorted(set(names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def complete(self, prefix, limit=COMPLETION_LIMIT):
+        """Return the names starting with prefix, in order.  Private names (starting
+        with an underscore) are left out unless the prefix asks for them.
+        """
+        names = self.names
+        i = bisect.bisect_left(names, prefix)
+        found = []
+        while i < len(names) and len(found) < limit and names[i].startswith(prefix):
+            if prefix.startswith('_') or not names[i].startswith('_'):
+                found.append(names[i])
+            i += 1
+        return found
+
+# Session key -> (session version, SymbolIndex of its globals)
+sessionIndexes = util.LRUCache(SESSION_INDEX_ITEMS)
+
+# (module or class, number of members) -> SymbolIndex of its members
+memberIndexes = util.LRUCache(MEMBER_INDEX_ITEMS)
+
+@util.once
+def builtinIndex():
+    return SymbolIndex(dir(__builtin__) + keyword.kwlist)
+
+class NotShared(Exception):
+    """The session belongs to somebody else, who has not shared it"""
+
+def sessionIndex(session_key):
+    """Return the version, the name index, the owner and the sharing of a session,
+    or None if it doesn't exist.
+    """
+    # Imported here, since model.console imports the console package, which
+    # may import the controller, which imports this module.
+    from .console import AppEngineConsole
+
+    symbols = AppEngineConsole.cachedSymbols(session_key)
+    if symbols is None:
+        # Not cached, so the session has to be loaded after all.
+        engine = AppEngineConsole.load(session_key)
+        if engine is None:
+            return None
+        symbols = engine.symbolsValue()
+
+    # Sharing can change without the globals, so only the index is kept here.
+    version, names, owner, shared = symbols
+    cached = sessionIndexes.get(session_key)
+    if cached is None or cached[0] != version:
+        cached = (version, SymbolIndex(names))
+        sessionIndexes.put(session_key, cached)
+    return cached + (owner, shared)
+
+def ownDict(obj):
+    """Return the dictionary of an object's own attributes, or {} if it has none,
+    without running any code of its class (as __getattribute__ or __getattr__
+    would).
+    """
+    if isinstance(obj, (types.InstanceType, types.ClassType)):
+        # Old-style objects always look their dictionary up themselves.
+        return obj.__dict__
+    if isinstance(obj, type):
+        return type.__dict__['__dict__'].__get__(obj)
+    try:
+        return object.__getattribute__(obj, '__dict__')
+    except AttributeError:
+        return {}
+
+def classes(cls):
+    """Return a class and its bases, in the order their attributes are found."""
+    if isinstance(cls, types.ClassType):
+        found = [cls]
+        for base in cls.__bases__:
+            found.extend([c for c in classes(base) if c not in found])
+        return found
+    return type.__dict__['__mro__'].__get__(cls)
+
+def objectClass(obj):
+    """Return the class of an object, without asking the object."""
+    if isinstance(obj, types.InstanceType):
+        return obj.__class__
+    return type(obj)
+
+def memberNames(obj):
+    """Return the names of an object's attributes: those dir() would list, but
+    found without calling dir(), which may run code of the session (a __dir__ or
+    a __getattr__).
+    """
+    if isinstance(obj, types.ModuleType):
+        return ownDict(obj).keys()
+    if isinstance(obj, (types.TypeType, types.ClassType)):
+        names = set()
+        for cls in classes(obj):
+            names.update(ownDict(cls).keys())
+        return names
+    return set(ownDict(obj).keys()) | memberNames(objectClass(obj))
+
+def memberIndex(obj):
+    """Return the index of an object's attributes.  Those of modules and classes
+    are cached until they gain or lose members."""
+    if not isinstance(obj, (types.ModuleType, types.TypeType, types.ClassType)):
+        return SymbolIndex(memberNames(obj))
+
+    key = (obj, len(ownDict(obj)))
+    index = memberIndexes.get(key)
+    if index is None:
+        index = SymbolIndex(memberNames(obj))
+        memberIndexes.put(key, index)
+    return index
+
+def member(obj, name):
+    """Return an attribute of a module or a class, or one an instance holds in its
+    own dictionary, without running any code of the session (as a property or
+    __getattr__ would).  Raise KeyError if there is none.
+    """
+    if isinstance(obj, types.ModuleType):
+        return ownDict(obj)[name]
+    if isinstance(obj, (types.TypeType, types.ClassType)):
+        for cls in classes(obj):
+            attrs = ownDict(cls)
+            if name in attrs:
+                value = attrs[name]
+                if isinstance(value, (staticmethod, classmethod)):
+                    return value.__get__(None, obj)
+                return value
+        raise KeyError(name)
+    return ownDict(obj)[name]
+
+def resolve(path, namespace):
+    """Return the object a dotted path refers to, looking first in the namespace
+    (a dict) and then among the imported modules and the builtins.
+    Return None if it can't be found.
+    """
+    parts = path.split('.')
+    if parts[0] in namespace:
+        obj = namespace[parts[0]]
+    elif parts[0] in sys.modules and sys.modules[parts[0]] is not None:
+        obj = sys.modules[parts[0]]
+    elif parts[0] in __builtin__.__dict__:
+        obj = __builtin__.__dict__[parts[0]]
+    else:
+        return None
+
+    for name in parts[1:]:
+        try:
+            obj = member(obj, name)
+        except KeyError:
+            return None
+    return obj
+
+def complete(session_key, text, owner, limit=COMPLETION_LIMIT):
+    """Return the completions of the (dotted) name at the end of text, in a
+    session, as a (start, names) tuple: the names may replace the text from
+    position start on.  Return None if the session doesn't exist, and raise
+    NotShared if the owner (see owner() in the controller) may not use it.
+    """
+    session_key = str(session_key)
+    match = COMPLETION_RE.search(text)
+    path, prefix = match.group('path'), match.group('prefix') or ''
+    start = match.start('prefix') if match.group('prefix') else len(text)
+
+    indexed = sessionIndex(session_key)
+    if indexed is None:
+        return None
+    version, index, session_owner, shared = indexed
+    from .console import AppEngineConsole, warmSessions
+    if not AppEngineConsole.usableBy(session_owner, shared, owner):
+        raise NotShared(session_key)
+
+    if not path:
+        names = index.complete(prefix, limit) + builtinIndex().complete(prefix, limit)
+        return start, sorted(set(names))[:limit]
+
+    namespace = {}
+    warm = warmSessions.get(session_key)
+    if warm is not None and warm[0] == version:
+        namespace = warm[1].__dict__
+
+    head = path.split('.')[0]
+    if head in index.names and head not in namespace:
+        # The global is stored, but not live here; only an imported module of
+        # the same name can stand in for it.
+        if not isinstance(sys.modules.get(head), types.ModuleType):
+            return start, []
+
+    obj = resolve(path, namespace)
+    if obj is None:
+        return start, []
+    return start, memberIndex(obj).complete(prefix, limit)
@@ -17,21 +17,32 @@
 # along with App Engine Console; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+from __future__ import absolute_import
+
 import os
 import sys
 import new
 import code
 import types
+import time
+import opcode
 import logging
 import cPickle
-import StringIO
 import datetime
 import traceback
 
-from model.session import ShellSession
+import util
+from model import snapshot
+from model import guard
+from model import profiler
+from model.output import OutputBuffer
+from model.session import ShellSession, delete_sessions
+from console import config
 
 from google.appengine.ext import db
 from google.appengine.api import users
+from google.appengine.api import memcache
+from google.appengine.api import datastore
 
 # Types that can't be pickled.
 UNPICKLABLE_TYPES = (
@@ -41,14 +52,114 @@ UNPICKLABLE_TYPES = (
     types.FunctionType,
 )
 
+# How long, in seconds, a session stays in memcache after its last use.
+SESSION_CACHE_TIME = 60 * 60
+
+# Referring to any of these names lets a statement see the namespace as a
+# whole, so every global must be loaded for it.
+NAMESPACE_NAMES = frozenset([
+    'dir', 'eval', 'execfile', 'globals', 'input', 'locals', 'modules', 'vars',
+])
+
+# Marker returned by statementNames() when every global must be loaded.
+ALL_NAMES = None
+
+def statementNames(bytecode):
+    """Return the set of names which a compiled statement, or any code nested
+    in it, may refer to.  Returns ALL_NAMES if there is no telling.
+    """
+    names = set()
+    pending = [bytecode]
+    while pending:
+        co = pending.pop()
+        if chr(opcode.opmap['EXEC_STMT']) in co.co_code:
+            return ALL_NAMES
+        names.update(co.co_names)
+        pending.extend(c for c in co.co_consts if isinstance(c, types.CodeType))
+
+    if names & NAMESPACE_NAMES:
+        return ALL_NAMES
+    return names
+
+def unionNames(names, more):
+    """Return the union of two results of statementNames()."""
+    if names is ALL_NAMES or more is ALL_NAMES:
+        return ALL_NAMES
+    return names | more
+
+# Idle sessions are deleted this many at a time...
+SWEEP_BATCH_SIZE = 50
+
+# ... for at most this many seconds per sweep, to finish well within the deadline
+# of the request doing it.
+SWEEP_TIME_LIMIT = 20
+
+# The result of the last sweep is kept in memcache under this key.
+SWEEP_RESULT_KEY = 'console:sweep'
+
+# The session keeps a log of the globals changed by its last this many revisions,
+# for merging the changes of concurrent requests (see AppEngineConsole.rebase).
+CHANGE_LOG_REVISIONS = 50
+
+# A save which keeps losing the race to write the session gives up after this
+# many attempts.
+COMMIT_ATTEMPTS = 5
+
+class SessionConflict(Exception):
+    """Another request changed the session meanwhile, in a way which clashes with
+    the changes of this one, so they could not be saved.
+    """
+    def __init__(self, names):
+        self.names = names
+        if names:
+            msg = 'Another statement changed %s meanwhile' % ', '.join(names)
+        else:
+            msg = 'Other statements changed the session too often meanwhile'
+        Exception.__init__(self, '%s, so the changes of this one were not saved. Please run it again.' % msg)
+
+# The live namespaces of recently used sessions, kept by this instance.  Each is
+# stored as (session version, statement module, code names, live globals).
+warmSessions = util.LRUCache(config.warm_sessions, config.warm_session_bytes)
+
 
 class AppEngineConsole(ShellSession):
-    """An interactive console session, derived from the Google shell session example."""
-    pending_source = db.TextProperty()
-    last_used      = db.DateTimeProperty()
+    """An interactive console session, derived from the Google shell session example.
+
+    Sessions are cached in memcache, keyed by the session key.  Each save bumps
+    the session's version, and the cache is never overwritten with an older
+    version than it holds.  A statement which leaves source pending (an
+    incomplete line) is only saved to the cache; the datastore is written once
+    the statement completes.  So if the cache entry is evicted in between, only
+    the pending lines are lost.
+
+    Each write to the datastore bumps the session's revision, in a transaction
+    which first checks that the stored revision is still the one loaded.  If it
+    isn't, another request (from another tab, or another user of a shared
+    session) saved the session meanwhile, and this request's changes are
+    replayed onto the newer revision, unless they clash (see rebase()).  So
+    concurrent requests need not wait for each other, and none of them silently
+    loses globals.
+
+    A session belongs to the user who started it (see owner() in the
+    controller), and nobody else may use it unless it is shared.
+    """
+    pending_source   = db.TextProperty()
+    last_used        = db.DateTimeProperty(auto_now_add=True)
+    version          = db.IntegerProperty(default=0)
+    revision         = db.IntegerProperty(default=0)
+    change_revisions = db.ListProperty(int)
+    change_names     = db.ListProperty(db.Text)
+    owner            = db.StringProperty()
+    shared           = db.BooleanProperty(default=False)
 
     def __init__(self, *args, **kw):
         ShellSession.__init__(self, *args, **kw)
+        self.warm = None
+        self.stream = None
+        self.stream_chunk = 0
+        self.edits = []
+        self.recording = True
+        self.read_names = set()
         self.fresh()
 
     def storedValue(self, obj):
@@ -72,15 +183,415 @@ class AppEngineConsole(ShellSession):
     
     def setPending(self, pending):
         self.pending_source = pending
-        self.put()
+
+    @staticmethod
+    def cacheKey(session_key):
+        return 'console:session:%s' % session_key
+
+    @staticmethod
+    def symbolsKey(session_key):
+        return 'console:symbols:%s' % session_key
+
+    @classmethod
+    def cachedSymbols(cls, session_key):
+        """Return the version, global names, owner and sharing of a session, as
+        cached by cache(), or None.
+        """
+        return memcache.get(cls.symbolsKey(session_key))
+
+    def mayUse(self, owner):
+        """Return whether someone (see owner() in the controller) may use the
+        session: anybody if it is shared or has no owner, otherwise its owner.
+        """
+        return self.usableBy(self.owner, self.shared, owner)
+
+    @staticmethod
+    def usableBy(session_owner, shared, owner):
+        """Return whether someone may use a session with the given owner and
+        sharing, as mayUse() does, without the session at hand.
+        """
+        return shared or not session_owner or session_owner == owner
+
+    def share(self, shared):
+        """Let anybody use the session, or only its owner."""
+        self.shared = shared
+        if self.recording:
+            self.edits.append(('share', (shared,), []))
+
+    # The changes to the stored globals are recorded as the calls of these
+    # methods, so that rebase() can replay them onto a newer revision.  Only
+    # the outermost call is recorded, since replaying it repeats the calls it
+    # makes, and nothing is recorded while replaying.
+
+    def record(self, method, args, names, change, *change_args):
+        recording = self.recording
+        self.recording = False
+        try:
+            change(self, *change_args)
+        finally:
+            self.recording = recording
+        if recording:
+            self.edits.append((method, args, names))
+
+    def set_global(self, name, value, pickled=None):
+        if pickled is None:
+            pickled = self.pickle_global(value)
+        self.record('set_global', (name, None, pickled), [name],
+                    ShellSession.set_global, name, value, pickled)
+
+    def remove_global(self, name):
+        self.record('remove_global', (name,), [name], ShellSession.remove_global, name)
+
+    def set_snapshot(self, name, snapshot):
+        self.record('set_snapshot', (name, snapshot), [name], ShellSession.set_snapshot, name, snapshot)
+
+    def remove_snapshot(self, name):
+        self.record('remove_snapshot', (name,), [name], ShellSession.remove_snapshot, name)
+
+    def add_unpicklable(self, statement, names):
+        self.record('add_unpicklable', (statement, list(names)), list(names),
+                    ShellSession.add_unpicklable, statement, names)
+
+    def changedNames(self):
+        """Return the names of the globals changed since the session was loaded."""
+        names = set()
+        for method, args, edited in self.edits:
+            names.update(edited)
+        return names
+
+    def changedSince(self, revision):
+        """Return the names of the globals changed by the revisions after the given
+        one, or None if the change log doesn't reach back that far.
+        """
+        if revision < self.revision - CHANGE_LOG_REVISIONS:
+            return None
+        return set([name for r, name in zip(self.change_revisions, self.change_names) if r > revision])
+
+    def symbolNames(self):
+        """Return the names of the session's globals, for completion."""
+        names = set(self.global_names) | set(self.snapshot_names) | set(self.unpicklable_names)
+        return sorted([str(name) for name in names])
+
+    def symbolsValue(self):
+        """Return what completion needs of the session: its version, the names of
+        its globals, and who may use it.
+        """
+        return (self.version, self.symbolNames(), self.owner, self.shared)
+
+    @classmethod
+    def load(cls, session_key):
+        """Return the session with the given key, from memcache if possible."""
+        session_key = str(db.Key(str(session_key)))
+        cached = memcache.get(cls.cacheKey(session_key))
+        if cached is not None:
+            version, encoded = cached
+            try:
+                return cls.from_entity(datastore.Entity.FromPb(encoded))
+            except Exception:
+                logging.warning('Ignoring bad cached session %s:\n%s' % (session_key, traceback.format_exc()))
+
+        engine = cls.get(session_key)
+        if engine is not None:
+            # The names of the globals go back too, or completion would load
+            # the session on every request (see model.complete).
+            values = {cls.cacheKey(session_key): engine.cacheValue(),
+                      cls.symbolsKey(session_key): engine.symbolsValue()}
+            memcache.add_multi(values, SESSION_CACHE_TIME)
+        return engine
+
+    @classmethod
+    def sweep(cls, max_idle, time_limit=SWEEP_TIME_LIMIT, batch_size=SWEEP_BATCH_SIZE):
+        """Delete the sessions which have not been used for max_idle (a timedelta), a
+        batch at a time, until there are none left or time_limit seconds have passed.
+        Return a dict describing what was done, which is also kept in memcache.
+
+        Sessions from before the creation time was recorded have no last use, so
+        they are stamped with the current time first, to expire max_idle later.
+        """
+        started = time.time()
+        now = datetime.datetime.now()
+        result = {'time': now, 'deleted': 0, 'bytes': 0, 'stamped': 0, 'finished': False}
+
+        def timeLeft():
+            return time.time() - started < time_limit
+
+        while timeLeft():
+            unstamped = datastore.Query(cls.kind(), {'last_used =': None}).Get(batch_size)
+            if not unstamped:
+                break
+            for entity in unstamped:
+                entity['last_used'] = now
+            datastore.Put(unstamped)
+            result['stamped'] += len(unstamped)
+
+        # Resume each batch from the last use of the previous one.  It's only
+        # needed if the deletes lag behind the index, but then it avoids
+        # fetching the same sessions over again.
+        since = None
+        cutoff = now - max_idle
+        while timeLeft():
+            query = cls.all().filter('last_used <', cutoff).order('last_used')
+            if since is not None:
+                query.filter('last_used >=', since)
+            sessions = query.fetch(batch_size)
+            if not sessions:
+                result['finished'] = True
+                break
+
+            keys = [session.key() for session in sessions]
+            delete_sessions(keys)
+            memcache.delete_multi([cls.cacheKey(key) for key in keys] +
+                                  [cls.symbolsKey(key) for key in keys])
+            for key in keys:
+                warmSessions.pop(str(key))
+
+            result['deleted'] += len(sessions)
+            result['bytes'] += sum([session.stored_size() for session in sessions])
+            since = sessions[-1].last_used
+
+        logging.info('Session sweep: %r' % result)
+        memcache.set(SWEEP_RESULT_KEY, result)
+        return result
+
+    def cacheValue(self):
+        return (self.version, db.model_to_protobuf(self).Encode())
+
+    def cache(self):
+        """Store the session in memcache, unless a newer version is already there.
+        Return whether the cache holds this version afterward.
+        """
+        key = self.cacheKey(self.key())
+
+        # Memcache has no compare-and-set, so a concurrent save can slip in
+        # between these two calls.  The versions at least keep a slow request
+        # from clobbering a newer session long after the fact.
+        cached = memcache.get(key)
+        if cached is not None and cached[0] > self.version:
+            logging.warning('Not caching session %s version %d over version %d' % (key, self.version, cached[0]))
+            return False
+
+        # The names of the globals go along, for completion (see model.complete).
+        values = {key: self.cacheValue(),
+                  self.symbolsKey(self.key()): self.symbolsValue()}
+        failed = memcache.set_multi(values, SESSION_CACHE_TIME)
+        return key not in failed
+
+    def commit(self):
+        """Write the session to the datastore as the next revision, in a transaction,
+        unless the stored session is no longer the revision this one was loaded
+        from.  Return the key, or None if it wasn't written.
+        """
+        key = self.key()
+        revision = self.revision
+        names = self.changedNames()
+        log = [(r, name) for r, name in zip(self.change_revisions, self.change_names)
+               if r > revision + 1 - CHANGE_LOG_REVISIONS]
+        dirty, stale = set(self._dirty_globals), set(self._stale_chunks)
+
+        def txn():
+            stored = db.get(key)
+            if stored is not None and stored.revision != revision:
+                return None
+            # The transaction may be retried, so start over each time.
+            self._dirty_globals, self._stale_chunks = set(dirty), set(stale)
+            self.revision = revision + 1
+            self.change_revisions = [r for r, name in log] + [revision + 1] * len(names)
+            self.change_names = [name for r, name in log] + [db.Text(name) for name in names]
+            return ShellSession.put(self)
+
+        return db.run_in_transaction(txn)
+
+    def rebase(self):
+        """Replay the changes of this request onto the latest revision of the
+        session.  Raise SessionConflict if a revision since the one this request
+        loaded changed any global which this request's statements changed or may
+        have used.
+        """
+        latest = AppEngineConsole.get(self.key())
+        if latest is None:
+            return      # Deleted meanwhile, so this request may write it anew.
+
+        theirs = latest.changedSince(self.revision)
+        if theirs is None:
+            raise SessionConflict([])
+        if self.read_names is ALL_NAMES:
+            clashes = theirs
+        else:
+            clashes = theirs & (self.read_names | self.changedNames())
+        if clashes:
+            raise SessionConflict(sorted(clashes))
+
+        logging.info('Merging session %s revision %d onto revision %d' % (self.key(), self.revision, latest.revision))
+        latest.recording = False
+        for method, args, names in self.edits:
+            getattr(latest, method)(*args)
+        latest.version = max(self.version, latest.version + 1)
+        latest.last_used = self.last_used
+        latest.pending_source = self.pending_source
+
+        # Take the merged state.  The live namespace lacks the other changes.
+        for name in self.properties():
+            setattr(self, name, getattr(latest, name))
+        self._global_pickles = latest._global_pickles
+        self._global_hashes = latest._global_hashes
+        self._dirty_globals = latest._dirty_globals
+        self._stale_chunks = latest._stale_chunks
+        self.warm = None
+        warmSessions.pop(str(self.key()))
+
+    def put(self):
+        """Write the session to the datastore and the cache.  Raise SessionConflict
+        if another request wrote it meanwhile, and this one's changes clash.
+        """
+        self.version += 1
+        if not self.is_saved():
+            self.revision = 1
+            key = ShellSession.put(self)
+        else:
+            for attempt in range(COMMIT_ATTEMPTS):
+                key = self.commit()
+                if key is not None:
+                    break
+                self.rebase()
+            else:
+                raise SessionConflict([])
+        self.edits = []
+        self.read_names = set()
+
+        if not self.cache():
+            # A cached session older than the datastore must not be used.
+            memcache.delete(self.cacheKey(key))
+        return key
+
+    def save(self, durable=True):
+        """Save the session.  If durable is False, the session is only saved to
+        memcache if possible, leaving the datastore write for a later save.
+        Changes to the globals are always written, since only the datastore
+        keeps the log of them which merging needs.
+        """
+        if durable or not self.is_saved() or self.edits or self._dirty_globals or self._stale_chunks:
+            return self.put()
+
+        self.version += 1
+        if not self.cache():
+            logging.debug('Could not cache session, writing it instead')
+            return self.put()
+        return self.key()
 
     def runsource(self, source):
         """Wrap the real source processor to record when the source was processed."""
+        return self.runsources([source])[0][0]
+
+    def runsources(self, sources, stream=None):
+        """Process several lines of source in order, saving the session once at the
+        end.  Return a (result, out, err, exc_type) tuple for each line, where the
+        result is the return value of processSource().  The attributes for the
+        last line are left in place, as runsource() does.  If a stream ID is given,
+        the output is streamed to memcache while it runs.
+
+        If the changes can't be saved, since another request's clash with them
+        (see rebase()), the SessionConflict is reported as the last line's error.
+        """
+        self.stream = stream
+        self.stream_chunk = 0
+        self.warm = None
+        old_version = self.version
+        results = []
         try:
             self.last_used = datetime.datetime.now()
-            return self.processSource(source)
+            for source in sources:
+                result = self.processSource(source)
+                results.append((result, self.out, self.err, self.exc_type))
+            return results
         finally:
-            self.put()
+            # Source left pending is all that changed, so it can wait in the cache.
+            try:
+                self.save(durable=not self.getPending())
+            except SessionConflict, e:
+                logging.info('Not saving session %s: %s' % (self.key(), e))
+                self.err += ''.join(traceback.format_exception_only(type(e), e))
+                self.exc_type = type(e)
+                if results:
+                    result, out, err, exc_type = results[-1]
+                    results[-1] = (result, out, self.err, self.exc_type)
+                self.warm = None
+                warmSessions.pop(str(self.key()))
+            self.keepWarm(old_version)
+
+    def liveGlobals(self, statement_module):
+        """Return the stored globals which are live in a namespace, with their hashes."""
+        live = {}
+        for name in self.global_names:
+            if name in statement_module.__dict__ and name in self._global_hashes:
+                live[name] = self._global_hashes[name]
+        return live
+
+    def takeWarm(self):
+        """Take this session's live namespace left by the previous statement in
+        this request or, failing that, from the warm sessions, if this instance
+        has the current version of it.  Return (statement module, code names,
+        live globals) or None.
+        """
+        if self.warm is not None:
+            statement_module, code_names = self.warm
+            self.warm = None
+            return statement_module, code_names, self.liveGlobals(statement_module)
+        if not self.is_saved():
+            return None
+        warm = warmSessions.pop(str(self.key()))
+        if warm is None or warm[0] != self.version:
+            return None
+        version, statement_module, code_names, live = warm
+        self._global_hashes.update(live)
+        return statement_module, code_names, live
+
+    def keepWarm(self, old_version):
+        """Keep the live namespace left by the last statement, if any, for the next
+        one.  Otherwise, any namespace kept from before is still current.
+        """
+        key = str(self.key())
+        if self.warm is not None:
+            statement_module, code_names = self.warm
+            warm = (self.version, statement_module, code_names, self.liveGlobals(statement_module))
+            if not warmSessions.put(key, warm, self.stored_size()):
+                logging.debug('Session too large to keep warm: %s' % key)
+            logging.debug('Warm sessions: %r' % warmSessions.stats())
+            self.warm = None
+        elif key in warmSessions:
+            version, statement_module, code_names, live = warmSessions.pop(key)
+            if version == old_version:
+                warmSessions.put(key, (self.version, statement_module, code_names, live),
+                                 self.stored_size())
+
+    def restoreNamespace(self, statement_module):
+        """Restore the snapshots and re-evaluate the unpicklables into a fresh
+        statement module.  Return the names their code uses, since calling the
+        functions they define may touch any of those globals.
+        """
+        code_names = set()
+        restored = {}
+        for name, snap in zip(list(self.snapshot_names), list(self.snapshots)):
+            try:
+                val = snapshot.restore(snap, statement_module.__dict__)
+            except snapshot.SnapshotError:
+                msg = 'Dropping %s since it could not be restored' % name
+                self.out += '%s\n' % msg
+                logging.warning('%s:\n%s' % (msg, traceback.format_exc()))
+                self.remove_snapshot(name)
+            else:
+                statement_module.__dict__[name] = restored[name] = val
+                for co in snapshot.code_objects(val):
+                    code_names = unionNames(code_names, statementNames(co))
+
+        for bad_statement in self.unpicklables:
+            bad_bytecode = compile(bad_statement, '<string>', 'exec')
+            code_names = unionNames(code_names, statementNames(bad_bytecode))
+            exec bad_bytecode in statement_module.__dict__
+
+        # A snapshot is newer than any unpicklable statement which set the
+        # same name.
+        statement_module.__dict__.update(restored)
+        return code_names
 
     def processSource(self, source):
         """Runs some source code in the object's context.  The return value will be
@@ -98,8 +609,11 @@ class AppEngineConsole(ShellSession):
         source = self.getPending() + source
         logging.info('Compiling for: %s >>> %s' % (user, source))
 
+        # A %prun or %timeit prefix profiles the statement; see model.profiler.
+        mode, runnable = profiler.parseMode(source)
+
         try:
-            bytecode = code.compile_command(source, '<string>', 'single')
+            bytecode = code.compile_command(runnable, '<string>', 'single')
         except BaseException, e:
             self.setPending('')
             self.exc_type = type(e)
@@ -114,8 +628,16 @@ class AppEngineConsole(ShellSession):
 
         logging.debug('Compilation successful')
 
-        # Create a dedicated module to be used as this statement's __main__.
-        statement_module = new.module('__main__')
+        # Reuse the live namespace of this session's previous statement, if this
+        # instance ran it.  Otherwise, create a dedicated module to be used as
+        # this statement's __main__.
+        warm = self.takeWarm()
+        if warm is None:
+            statement_module = new.module('__main__')
+            live = {}
+        else:
+            logging.debug('Reusing the warm session namespace')
+            statement_module, code_names, live = warm
 
         # Use this request's __builtin__, since it changes on each request.
         # This is needed for import statements, among other things.
@@ -130,79 +652,166 @@ class AppEngineConsole(ShellSession):
             sys.modules['__main__'] = statement_module
             statement_module.__name__ = '__main__'
 
-            # Re-evaluate the unpicklables.
-            for bad_statement in self.unpicklables:
-                exec bad_statement in statement_module.__dict__
+            if warm is None:
+                code_names = self.restoreNamespace(statement_module)
+            referenced = unionNames(statementNames(bytecode), code_names)
+            self.read_names = unionNames(self.read_names, referenced)
+
+            # Re-initialize only the globals this statement can reach, and which
+            # aren't live already.  A statement which inspects the namespace as a
+            # whole gets them all.
+            if referenced is ALL_NAMES:
+                wanted = list(self.global_names)
+            else:
+                wanted = [name for name in self.global_names if name in referenced]
 
-            # Re-initialize the globals.
-            for name, val in self.globals_dict().items():
+            loaded = set([name for name in wanted if name in live])
+            wanted = [name for name in wanted if name not in live]
+            self.prefetch_globals(wanted)
+            for name in wanted:
                 try:
-                    statement_module.__dict__[name] = val
+                    statement_module.__dict__[name] = self.get_global(name)
                 except:
                     msg = 'Dropping %s since it could not be unpickled' % name
                     self.out += '%s\n' % msg
                     logging.warning('%s:\n%s' % (msg, traceback.format_exc()))
                     self.remove_global(name)
-
-            # Execute it.
-            buf = StringIO.StringIO()
-            old_globals = dict(statement_module.__dict__)
+                else:
+                    loaded.add(name)
 
             # Later on, we compare new variable ("global") values to these values to see what's changed
-            # and should be saved in the store; however, since old_globals is merely a shallow copy,
-            # naively comparing for inequality between old/new values will not work: mutating a list
-            # or dict for example will change the underlying object in *both* dicts and so the != comparison
-            # will return false.  In other words:
-            # >>> a = {'foo': [1, 2]}; b = dict(a); print a['foo'] is b['foo']
-            # True
-            #
-            # The current solution is to remember the object's pickled representation and compare
-            # the before and after pickled strings.  Another idea is maybe de-optimizing this completely and
-            # just always re-store every global.
-            old_global_values = dict([(a, self.storedValue(b)) for a, b in old_globals.items()])
+            # and should be saved in the store.  Naively comparing old and new objects will not work, since
+            # mutating a list or dict changes the one underlying object.  So globals loaded from the store
+            # are compared by the hash of their stored pickle, which is cached and costs nothing here.
+            # Names left behind by the unpicklables are still fingerprinted, but only those this statement
+            # can reach; nothing else can change.
+            old_names = set(statement_module.__dict__)
+            old_global_values = {}
+            for name, val in statement_module.__dict__.items():
+                if name not in loaded and (referenced is ALL_NAMES or name in referenced):
+                    old_global_values[name] = self.storedValue(val)
 
+            # Execute it, within the statement limits.
+            buf = OutputBuffer(config.max_output_size, self.stream, self.stream_chunk)
+            limits = guard.Guard(config.statement_deadline, config.statement_max_memory, buf)
+            aborted = False
             try:
                 old_stdout = sys.stdout
                 old_stderr = sys.stderr
                 try:
                     sys.stdout = buf
                     sys.stderr = buf
-                    exec bytecode in statement_module.__dict__
+                    limits.start()
+                    if mode == 'prun':
+                        report = profiler.prun(bytecode, statement_module.__dict__)
+                    elif mode == 'timeit':
+                        report = profiler.timeit(bytecode, statement_module.__dict__)
+                    else:
+                        exec bytecode in statement_module.__dict__
+                        report = None
                 finally:
+                    limits.stop()
                     sys.stdout = old_stdout
                     sys.stderr = old_stderr
+            except guard.StatementAborted, e:
+                # Keep what the statement did so far, as if it had finished there.
+                buf.flush()
+                self.stream_chunk = buf.chunk
+                self.out = buf.getvalue()
+                self.err = traceback.format_exc()
+                self.exc_type = type(e)
+                logging.warning('Aborted for: %s: %s' % (user, e))
+                aborted = True
             except BaseException, e:
                 # Store the output and user's exception.
-                buf.seek(0)
-                self.out = buf.read()
+                buf.flush()
+                self.stream_chunk = buf.chunk
+                self.out = buf.getvalue()
                 self.err = traceback.format_exc()
                 self.exc_type = type(e)
                 self.setPending('')
                 logging.info('Exception for: %s\nout:\n%s\nerr:\n%s' % (user, self.out.strip(), self.err.strip()))
                 return False    # Code execution completed (the hard way).
-
-            buf.seek(0)
-            self.out = buf.read()
-            logging.info('Execution for: %s: %s' % (user, self.out.strip()))
+            else:
+                if report:
+                    buf.write(report)
+                buf.flush()
+                self.stream_chunk = buf.chunk
+                self.out = buf.getvalue()
+                logging.info('Execution for: %s: %s' % (user, self.out.strip()))
             self.setPending('')
 
-            # Extract the new globals that this statement added.
+            # Extract the new globals that this statement added or changed,
+            # pickling only the values it could have touched.
             new_globals = {}
+            pickles = {}
             for name, val in statement_module.__dict__.items():
-                if name not in old_global_values or self.storedValue(val) != old_global_values[name]:
+                if name in loaded:
+                    if isinstance(val, UNPICKLABLE_TYPES):
+                        new_globals[name] = val
+                    else:
+                        pickled = self.pickle_global(val)
+                        if self.hash_pickle(pickled) != self.global_hash(name):
+                            new_globals[name] = val
+                            pickles[name] = pickled
+                elif name in old_global_values:
+                    if self.storedValue(val) != old_global_values[name]:
+                        new_globals[name] = val
+                elif name not in old_names:
                     new_globals[name] = val
 
-            if True in [isinstance(val, UNPICKLABLE_TYPES) for val in new_globals.values()]:
-                # This statement added an unpicklable global.  Store the statement and
-                # the names of all of the globals it added in the unpicklables.
-                self.add_unpicklable(source, new_globals.keys())
+            # Stored globals which the statement deleted.
+            for name in loaded:
+                if name not in statement_module.__dict__:
+                    logging.debug('Removing deleted global: %s' % name)
+                    self.remove_global(name)
+            for name in list(self.snapshot_names):
+                if name not in statement_module.__dict__:
+                    logging.debug('Removing deleted global: %s' % name)
+                    self.remove_snapshot(name)
+
+            # Take snapshots of the unpicklable globals this statement added.
+            snapshots = {}
+            dropped = False
+            for name, val in new_globals.items():
+                if isinstance(val, UNPICKLABLE_TYPES) and not name.startswith('__'):
+                    try:
+                        snapshots[name] = snapshot.capture(name, val, statement_module.__dict__,
+                                                           self.unpicklable_names)
+                    except snapshot.SnapshotError, e:
+                        logging.debug('Can not take a snapshot: %s' % e)
+                        if aborted:
+                            # Replaying an aborted statement would abort again.
+                            self.out += 'Dropping %s since the statement which set it was aborted\n' % name
+                            del new_globals[name]
+                            dropped = True
+                            continue
+                        snapshots = None
+                        break
+
+            if snapshots is None:
+                # This statement added an unpicklable global which can't be restored
+                # from a snapshot.  Store the statement and the names of all of the
+                # globals it added in the unpicklables.
+                self.add_unpicklable(runnable, new_globals.keys())
                 logging.debug('Storing this statement as an unpicklable.')
+                code_names = unionNames(code_names, statementNames(bytecode))
             else:
-                # This statement didn't add any unpicklables.  Pickle and store the
-                # new globals back into the datastore.
+                # Pickle and store the new globals back into the datastore, along
+                # with the snapshots of any unpicklables.
                 for name, val in new_globals.items():
-                    if not name.startswith('__'):
-                        self.set_global(name, val)
+                    if name in snapshots:
+                        self.set_snapshot(name, snapshots[name])
+                    elif not name.startswith('__'):
+                        self.set_global(name, val, pickles.get(name))
+                for name in snapshots:
+                    for co in snapshot.code_objects(new_globals[name]):
+                        code_names = unionNames(code_names, statementNames(co))
+
+            # The namespace is consistent with the stored session, so it can be
+            # reused by the next statement.
+            if not dropped:
+                self.warm = (statement_module, code_names)
         finally:
             sys.modules['__main__'] = old_main
 
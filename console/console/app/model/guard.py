@@ -0,0 +1,169 @@
+# App Engine Console statement guard
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Limits on the time, memory and output of console statements.
+
+App Engine has no signals or threads to interrupt a statement with, so a
+trace function checks the limits as the statement runs.  Tracing is costly, so
+it is kept to what a statement needs to be stopped: every call is seen, but
+only the lines of console code which loops (jumps backward), and the limits
+are only checked once every CHECK_INTERVAL of these events.  Once a limit is
+passed, StatementAborted is raised in the statement.  Python removes a trace
+function which raises an exception, so a statement which catches it with a
+bare "except:" keeps going, unguarded.
+
+A statement stuck in one long call into other code (say, a slow datastore
+query) is only stopped when that call returns.
+"""
+
+import sys
+import dis
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on App Engine, so there memory is not limited.
+    resource = None
+
+# The file name of code compiled from console statements.
+CONSOLE_FILENAME = '<string>'
+
+# The limits are checked once every this many calls and traced lines...
+CHECK_INTERVAL = 100
+
+# ... and memory use only once every this many checks.
+MEMORY_CHECK_INTERVAL = 10
+
+# The code objects of console code, and whether each loops.
+loopingCode = {}
+
+class StatementAborted(BaseException):
+    """A statement passed one of its limits.  Like KeyboardInterrupt, it isn't an
+    Exception, so that "except Exception" doesn't catch it.
+    """
+
+def loops(code):
+    """Return whether code has a backward jump, so it can run for long without
+    making any calls.
+    """
+    looping = loopingCode.get(code)
+    if looping is None:
+        looping = False
+        bytecode = code.co_code
+        i = 0
+        while i < len(bytecode):
+            op = ord(bytecode[i])
+            if op >= dis.HAVE_ARGUMENT:
+                if op in dis.hasjabs:
+                    target = ord(bytecode[i + 1]) + ord(bytecode[i + 2]) * 256
+                    if target <= i:
+                        looping = True
+                        break
+                i += 3
+            else:
+                i += 1
+        loopingCode[code] = looping
+    return looping
+
+def memoryUsage():
+    """Return the most memory, in bytes, the process has used so far, or None if
+    it is not known.
+    """
+    if resource is None:
+        return None
+    try:
+        # Linux reports kilobytes, and Mac OS X bytes.
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except (AttributeError, ValueError, resource.error):
+        return None
+    if sys.platform == 'darwin':
+        return usage
+    return usage * 1024
+
+class Guard(object):
+    """Aborts the statement run between start() and stop() once it has run for
+    longer than deadline seconds, grown the memory use by more than max_memory
+    bytes, or filled its output (an OutputBuffer).  A limit of None is no limit.
+    """
+    def __init__(self, deadline=None, max_memory=None, output=None):
+        self.deadline = deadline
+        self.max_memory = max_memory
+        self.output = output
+
+        self.started = None
+        self.events = 0         # Calls and traced lines, until the next check.
+        self.checks = 0
+        self.reason = None      # Why the statement was aborted, once it is.
+
+    def start(self):
+        self.started = time.time()
+        self.base_memory = None
+        if self.max_memory is not None:
+            self.base_memory = memoryUsage()
+        self.old_trace = getattr(sys, 'gettrace', lambda: None)()
+        sys.settrace(self.trace)
+
+    def stop(self):
+        sys.settrace(self.old_trace)
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def trace(self, frame, event, arg):
+        """The global trace function, called on every new frame."""
+        self.events += 1
+        if self.events >= CHECK_INTERVAL:
+            self.check(frame)
+        if frame.f_code.co_filename == CONSOLE_FILENAME and loops(frame.f_code):
+            return self.traceLine
+        return None
+
+    def traceLine(self, frame, event, arg):
+        """The local trace function of console code which loops."""
+        self.events += 1
+        if self.events >= CHECK_INTERVAL:
+            self.check(frame)
+        return self.traceLine
+
+    def check(self, frame):
+        self.events = 0
+        if self.reason is None:
+            self.reason = self.limitPassed()
+            if self.reason is None:
+                return
+
+        # Report where the console code got to, not what it called.
+        while frame.f_back is not None and frame.f_code.co_filename != CONSOLE_FILENAME:
+            frame = frame.f_back
+        raise StatementAborted('%s; aborted after %.1f seconds, at line %d of %s'
+                               % (self.reason, self.elapsed(), frame.f_lineno, frame.f_code.co_name))
+
+    def limitPassed(self):
+        """Return which limit the statement has passed, if any."""
+        if self.deadline is not None and self.elapsed() > self.deadline:
+            return 'Statement ran for more than %s seconds' % self.deadline
+
+        if self.output is not None and self.output.truncated:
+            return 'Statement output more than %d characters' % self.output.limit
+
+        self.checks += 1
+        if self.base_memory is not None and self.checks % MEMORY_CHECK_INTERVAL == 0:
+            used = memoryUsage()
+            if used is not None and used - self.base_memory > self.max_memory:
+                return 'Statement used more than %d MB of memory' % (self.max_memory // (1024 * 1024))
+        return None
@@ -0,0 +1,334 @@
+# App Engine Console statement history
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""The history of the statements each user has entered, kept across sessions.
+
+Statements are numbered from 0 in the order they were entered.  The latest
+ones, up to CHUNK_SIZE, are kept in the user's HistoryHead entity.  Once it is
+full, they are moved into a HistoryChunk child entity, which never changes
+again, so instances cache the chunks they read.
+
+Appending statements doesn't write to the datastore, since running them
+already has the session to save.  They are numbered with memcache.incr() and
+wait in memcache, and every FLUSH_BATCH appends (or before the history is
+read), flush() moves those waiting into the head, in one transaction.
+
+Each chunk lists the trigrams (three-character substrings) of its statements,
+lowercased, so that a search for a substring only reads the chunks having all
+of its trigrams.
+"""
+
+import logging
+
+from google.appengine.ext import db
+from google.appengine.api import memcache
+
+import util
+
+# The number of statements in each chunk.
+CHUNK_SIZE = 100
+
+# Appended statements are moved from memcache to the datastore after this many
+# appends...
+FLUSH_BATCH = 10
+
+# ... and are kept in memcache for this long, in seconds, meanwhile.
+PENDING_TIME = 24 * 60 * 60
+
+# A chunk with more distinct trigrams than this isn't indexed by them (there is a
+# limit to the index entries of an entity), and is read by every search.
+MAX_CHUNK_TERMS = 2000
+
+# The term of chunks which aren't indexed by their trigrams.
+ANY_TERM = '*'
+
+# A search looks for chunks having at most this many of the trigrams it needs.
+SEARCH_TERMS = 3
+
+# Chunks are read this many at a time when searching...
+SEARCH_BATCH = 20
+
+# ... and it reads at most the latest this many.  Anything older is not found.
+SEARCH_MAX_CHUNKS = 1000
+
+# The most statements kept of a history page or search result.
+PAGE_SIZE = 100
+
+# Each instance keeps up to this many chunks, which never change.
+CHUNK_CACHE_ITEMS = 500
+CHUNK_CACHE_SIZE = 4 * 1024 * 1024
+
+chunkCache = util.LRUCache(CHUNK_CACHE_ITEMS, CHUNK_CACHE_SIZE)
+
+class HistoryHead(db.Model):
+    """A user's history: the number of statements, the latest ones, and the
+    number of appends flushed into it.  The key name is the user's identity
+    (see owner() in the controller).
+    """
+    count   = db.IntegerProperty(default=0)
+    recent  = db.ListProperty(db.Text)
+    flushed = db.IntegerProperty(default=0)
+
+    @classmethod
+    def kind(cls):
+        return '_Console_History'
+
+class HistoryChunk(db.Model):
+    """CHUNK_SIZE statements of a history, a child of its head.  The key name is
+    chunkKeyName() of the number of the chunk.
+    """
+    statements = db.ListProperty(db.Text)
+    terms      = db.StringListProperty()
+
+    @classmethod
+    def kind(cls):
+        return '_Console_History_Chunk'
+
+def chunkKeyName(number):
+    return 'chunk:%08d' % number
+
+def chunkNumber(key):
+    return int(key.name().split(':')[1])
+
+def trigrams(text):
+    text = text.lower()
+    return set([text[i:i + 3] for i in range(len(text) - 2)])
+
+def chunkTerms(statements):
+    terms = set()
+    for statement in statements:
+        terms.update(trigrams(statement))
+    if len(terms) > MAX_CHUNK_TERMS:
+        return [ANY_TERM]
+    return sorted(terms)
+
+def pendingKey(owner, number=None):
+    """Return the memcache key of the count of a user's appends, or of the
+    statements of one of them.
+    """
+    if number is None:
+        return 'console:history:pending:%s' % owner
+    return 'console:history:pending:%s:%d' % (owner, number)
+
+def append(owner, statements):
+    """Add statements to the end of a user's history.  Return the number of the
+    append, or None if there was nothing to add.
+    """
+    statements = [unicode(s) for s in statements if s.strip()]
+    if not statements:
+        return None
+
+    key = pendingKey(owner)
+    number = memcache.incr(key)
+    if number is None:
+        memcache.add(key, lastAppend(owner))
+        number = memcache.incr(key)
+
+    if number is None or not memcache.set(pendingKey(owner, number), statements, PENDING_TIME):
+        logging.warning('Could not append to the history of %s in memcache' % owner)
+        db.run_in_transaction(store, owner, statements)
+    elif number % FLUSH_BATCH == 0:
+        flush(owner)
+    return number
+
+def lastAppend(owner):
+    """Return the number of a user's last append, for when memcache has lost
+    their count: the last one flushed, or after it the last still waiting, so
+    that they are flushed rather than written over.
+    """
+    head = HistoryHead.get_by_key_name(owner)
+    last = head and head.flushed or 0
+    while True:
+        numbers = range(last + 1, last + FLUSH_BATCH + 1)
+        pending = memcache.get_multi([pendingKey(owner, n) for n in numbers])
+        found = [n for n in numbers if pendingKey(owner, n) in pending]
+        if not found:
+            return last
+        last = found[-1]
+
+def flush(owner):
+    """Move the appends waiting in memcache into a user's history."""
+    count = memcache.get(pendingKey(owner))
+    if count is None:
+        return
+
+    def txn():
+        head = HistoryHead.get_by_key_name(owner)
+        flushed = head and head.flushed or 0
+        if count <= flushed:
+            return []
+
+        keys = [pendingKey(owner, n) for n in range(flushed + 1, count + 1)]
+        pending = memcache.get_multi(keys)
+        statements = []
+        for key in keys:
+            if key in pending:
+                statements.extend(pending[key])
+            else:
+                logging.warning('History append %s is missing' % key)
+        store(owner, statements, head, count)
+        return keys
+
+    keys = db.run_in_transaction(txn)
+    if keys:
+        memcache.delete_multi(keys)
+
+def store(owner, statements, head=None, flushed=None):
+    """Add statements to the end of a user's history in the datastore, with
+    the head if it has been read already, and record the number of appends
+    flushed.  Use it in a transaction.
+    """
+    statements = [db.Text(s) for s in statements]
+    if head is None:
+        head = HistoryHead.get_by_key_name(owner)
+    if head is None:
+        head = HistoryHead(key_name=owner)
+
+    recent = head.recent + statements
+    chunks = []
+    sealed = head.count - len(head.recent)      # Statements moved to chunks.
+    while len(recent) >= CHUNK_SIZE:
+        chunks.append(HistoryChunk(parent=head, key_name=chunkKeyName(sealed // CHUNK_SIZE),
+                                   statements=recent[:CHUNK_SIZE],
+                                   terms=chunkTerms(recent[:CHUNK_SIZE])))
+        recent = recent[CHUNK_SIZE:]
+        sealed += CHUNK_SIZE
+
+    head.recent = recent
+    head.count += len(statements)
+    if flushed is not None:
+        head.flushed = flushed
+    db.put([head] + chunks)
+
+def getChunks(owner, numbers):
+    """Return the statement lists of a user's chunks, by chunk number."""
+    found = {}
+    missing = []
+    for number in numbers:
+        statements = chunkCache.get((owner, number))
+        if statements is None:
+            missing.append(number)
+        else:
+            found[number] = statements
+
+    if missing:
+        head_key = db.Key.from_path(HistoryHead.kind(), owner)
+        keys = [db.Key.from_path(HistoryChunk.kind(), chunkKeyName(n), parent=head_key) for n in missing]
+        for number, chunk in zip(missing, HistoryChunk.get(keys)):
+            if chunk is None:
+                logging.warning('History chunk %d of %s is missing' % (number, owner))
+                statements = []
+            else:
+                statements = [unicode(s) for s in chunk.statements]
+            chunkCache.put((owner, number), statements, sum([len(s) + 40 for s in statements]))
+            found[number] = statements
+    return found
+
+def page(owner, before=None, count=PAGE_SIZE):
+    """Return (start, statements): the statements of a user's history numbered
+    from start to before (or to the end, if before is None), at most count.
+    """
+    flush(owner)
+    head = HistoryHead.get_by_key_name(owner)
+    if head is None:
+        return 0, []
+
+    end = head.count
+    if before is not None:
+        end = max(0, min(before, end))
+    count = max(0, min(count, PAGE_SIZE))
+    start = max(0, end - count)
+
+    sealed = head.count - len(head.recent)
+    statements = []
+    numbers = range(start // CHUNK_SIZE, (min(end, sealed) + CHUNK_SIZE - 1) // CHUNK_SIZE)
+    chunks = getChunks(owner, numbers)
+    for number in numbers:
+        first = number * CHUNK_SIZE
+        statements.extend(chunks[number][max(0, start - first):max(0, end - first)])
+    if end > sealed:
+        statements.extend([unicode(s) for s in head.recent[max(0, start - sealed):end - sealed]])
+    return start, statements
+
+def matches(statement, query, prefix):
+    if prefix:
+        return statement.startswith(query)
+    return query.lower() in statement.lower()
+
+def search(owner, query, before=None, prefix=False, count=PAGE_SIZE):
+    """Return the latest statements of a user's history numbered below before,
+    which contain the query (or, if prefix is true, start with it), as a list of
+    (number, statement), newest first.
+    """
+    flush(owner)
+    head = HistoryHead.get_by_key_name(owner)
+    if head is None or not query:
+        return []
+
+    if before is None:
+        before = head.count
+    count = max(0, min(count, PAGE_SIZE))
+    results = []
+
+    sealed = head.count - len(head.recent)
+    for i in range(min(before, head.count) - 1, sealed - 1, -1):
+        statement = head.recent[i - sealed]
+        if matches(statement, query, prefix):
+            results.append((i, unicode(statement)))
+            if len(results) >= count:
+                return results
+
+    # The chunks which may have matches, newest first.
+    last = (min(before, sealed) - 1) // CHUNK_SIZE
+    if last < 0:
+        return results
+    terms = sorted(trigrams(query))
+    if terms:
+        # Those in the middle are the least likely to be common.
+        step = max(1, len(terms) // SEARCH_TERMS)
+        terms = terms[step // 2::step][:SEARCH_TERMS]
+
+        # Only the latest SEARCH_MAX_CHUNKS chunks are looked for.  They are
+        # picked by a key range, since sorting by key descending would need a
+        # composite index for each number of terms.
+        head_key = db.Key.from_path(HistoryHead.kind(), owner)
+        first_key = db.Key.from_path(HistoryChunk.kind(), chunkKeyName(max(0, last - SEARCH_MAX_CHUNKS + 1)), parent=head_key)
+        last_key = db.Key.from_path(HistoryChunk.kind(), chunkKeyName(last), parent=head_key)
+        numbers = set()
+        for filters in ([('terms =', term) for term in terms], [('terms =', ANY_TERM)]):
+            chunk_keys = HistoryChunk.all(keys_only=True).ancestor(head_key)
+            for condition, value in filters:
+                chunk_keys.filter(condition, value)
+            chunk_keys.filter('__key__ >=', first_key).filter('__key__ <=', last_key)
+            numbers.update([chunkNumber(key) for key in chunk_keys.fetch(SEARCH_MAX_CHUNKS)])
+        numbers = sorted(numbers, reverse=True)
+    else:
+        # Too short to have trigrams, so every chunk may match.
+        numbers = range(last, max(-1, last - SEARCH_MAX_CHUNKS), -1)
+
+    for batch in range(0, len(numbers), SEARCH_BATCH):
+        batch = numbers[batch:batch + SEARCH_BATCH]
+        chunks = getChunks(owner, batch)
+        for number in batch:
+            first = number * CHUNK_SIZE
+            statements = chunks[number]
+            for i in range(min(len(statements), before - first) - 1, -1, -1):
+                if matches(statements[i], query, prefix):
+                    results.append((first + i, statements[i]))
+                    if len(results) >= count:
+                        return results
+    return results
@@ -0,0 +1,117 @@
+# App Engine Console statement output
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Capture of the output of console statements.
+
+App Engine can't send a response before the request is finished, so output
+is streamed through memcache instead: it is written there in numbered chunks
+while the statement runs, and the client polls for the chunks it hasn't
+seen yet (see fetchChunks).
+"""
+
+import time
+import logging
+
+from google.appengine.api import memcache
+
+# Output is flushed to memcache once this many characters are pending...
+STREAM_CHUNK_SIZE = 4096
+
+# ... or once it has been pending for this many seconds.
+STREAM_INTERVAL = 0.5
+
+# How long, in seconds, streamed output stays in memcache.
+STREAM_CACHE_TIME = 10 * 60
+
+# The most chunks returned by one poll.
+STREAM_FETCH_CHUNKS = 16
+
+def chunkKey(stream, index):
+    return 'console:output:%s:%d' % (stream, index)
+
+def fetchChunks(stream, start):
+    """Return the streamed output from chunk number start on, and the number of
+    the next chunk to ask for.
+    """
+    keys = [chunkKey(stream, index) for index in range(start, start + STREAM_FETCH_CHUNKS)]
+    chunks = memcache.get_multi(keys)
+
+    out = []
+    for key in keys:
+        if key not in chunks:
+            break
+        out.append(chunks[key])
+    return ''.join(out), start + len(out)
+
+class OutputBuffer(object):
+    """A file-like object collecting the output (stdout and stderr) of statements.
+
+    At most limit characters are kept; the rest is dropped, with a notice.  If a
+    stream ID is given, the output is also streamed to memcache as it comes,
+    starting at the given chunk number.
+    """
+    def __init__(self, limit=None, stream=None, chunk=0):
+        self.limit = limit
+        self.stream = stream
+        self.size = 0
+        self.truncated = False
+        self.pieces = []
+
+        self.chunk = chunk          # Number of the next chunk to stream.
+        self.pending = []           # Output not streamed yet.
+        self.pending_size = 0
+        self.flushed_at = time.time()
+
+    def write(self, text):
+        if self.truncated or not text:
+            return
+        if self.limit is not None and self.size + len(text) > self.limit:
+            text = text[:self.limit - self.size]
+            text += '\n[Output truncated after %d characters]\n' % self.limit
+            self.truncated = True
+
+        self.pieces.append(text)
+        self.size += len(text)
+
+        if self.stream:
+            self.pending.append(text)
+            self.pending_size += len(text)
+            if (self.pending_size >= STREAM_CHUNK_SIZE or self.truncated or
+                time.time() - self.flushed_at >= STREAM_INTERVAL):
+                self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        """Stream any pending output."""
+        if not self.pending:
+            return
+        text = ''.join(self.pending)
+        if not memcache.set(chunkKey(self.stream, self.chunk), text, STREAM_CACHE_TIME):
+            logging.warning('Failed to stream output chunk %d of %s' % (self.chunk, self.stream))
+        self.chunk += 1
+        self.pending = []
+        self.pending_size = 0
+        self.flushed_at = time.time()
+
+    def getvalue(self):
+        return ''.join(self.pieces)
+
+    def isatty(self):
+        return False
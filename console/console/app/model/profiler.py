@@ -0,0 +1,200 @@
+# App Engine Console statement profiling
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Profiling of console statements.
+
+A statement prefixed with %prun runs under the profiler, and one prefixed
+with %timeit is run repeatedly and timed.  Either way, the API calls it makes
+(datastore, memcache, and so on) are counted and timed by hooks on the API
+proxy, since those are usually what makes a statement slow.
+"""
+
+import sys
+import time
+import pstats
+from cStringIO import StringIO
+
+try:
+    import cProfile as profile
+except ImportError:
+    import profile
+
+from google.appengine.api import apiproxy_stub_map
+
+# Statement prefixes, and the profiling mode they select.
+MODES = {
+    '%prun'  : 'prun',
+    '%timeit': 'timeit',
+}
+
+# The most functions listed by %prun.
+PRUN_LINES = 20
+
+# %timeit runs a statement at most this many times...
+TIMEIT_RUNS = 100
+
+# ... or for about this many seconds, whichever comes first.
+TIMEIT_TIME_LIMIT = 2.0
+
+def parseMode(source):
+    """Return the profiling mode selected by the source's prefix, if any, and the
+    source without it.
+    """
+    stripped = source.lstrip()
+    for prefix, mode in MODES.items():
+        if stripped.startswith(prefix):
+            rest = stripped[len(prefix):]
+            if not rest or rest[0].isspace():
+                return mode, rest.lstrip(' \t')
+    return None, source
+
+class APICallRecorder(object):
+    """Counts and times the API calls made between start() and stop()."""
+
+    # The recorder currently collecting calls, if any.
+    active = None
+
+    def __init__(self):
+        self.calls = {}         # Count and total seconds, by 'service.Call'.
+        self.errors = 0
+        self.started = {}
+
+    def start(self):
+        # Adding a hook twice does nothing, and the API proxy is replaced by the
+        # unit tests, so the hooks are simply added each time.
+        apiproxy = apiproxy_stub_map.apiproxy
+        apiproxy.GetPreCallHooks().Append('console_profiler', preCall)
+        apiproxy.GetPostCallHooks().Append('console_profiler', postCall)
+        APICallRecorder.active = self
+
+    def stop(self):
+        APICallRecorder.active = None
+
+    def before(self, request):
+        self.started[id(request)] = time.time()
+
+    def after(self, service, call, request, error):
+        started = self.started.pop(id(request), None)
+        if started is None:
+            return
+        name = '%s.%s' % (service, call)
+        count, seconds = self.calls.get(name, (0, 0.0))
+        self.calls[name] = (count + 1, seconds + time.time() - started)
+        if error is not None:
+            self.errors += 1
+
+    def report(self):
+        """Return a table of the calls made, the slowest first."""
+        if not self.calls:
+            return 'No API calls\n'
+
+        rows = sorted(self.calls.items(), key=lambda (name, (count, seconds)): -seconds)
+        width = max([len(name) for name in self.calls])
+        lines = ['%-*s  %6s  %10s  %10s' % (width, 'API call', 'count', 'total ms', 'per call')]
+        for name, (count, seconds) in rows:
+            lines.append('%-*s  %6d  %10.1f  %10.2f' % (width, name, count, seconds * 1000,
+                                                        seconds * 1000 / count))
+        total = sum([count for count, seconds in self.calls.values()])
+        total_seconds = sum([seconds for count, seconds in self.calls.values()])
+        lines.append('%d API calls in %.1f ms' % (total, total_seconds * 1000))
+        if self.errors:
+            lines[-1] += ' (%d failed)' % self.errors
+        return '\n'.join(lines) + '\n'
+
+def preCall(service, call, request, response):
+    recorder = APICallRecorder.active
+    if recorder is not None:
+        recorder.before(request)
+
+def postCall(service, call, request, response, rpc, error):
+    recorder = APICallRecorder.active
+    if recorder is not None:
+        recorder.after(service, call, request, error)
+
+def prun(bytecode, namespace):
+    """Run bytecode in a namespace under the profiler, and return the report."""
+    profiler = profile.Profile()
+    recorder = APICallRecorder()
+    recorder.start()
+    started = time.time()
+    try:
+        profiler.runctx(bytecode, namespace, namespace)
+    finally:
+        elapsed = time.time() - started
+        recorder.stop()
+        profiler.create_stats()
+    return formatProfile(profiler, elapsed) + '\n' + recorder.report()
+
+def formatProfile(profiler, elapsed):
+    out = StringIO()
+    try:
+        stats = pstats.Stats(profiler, stream=out)
+    except TypeError:
+        # Python 2.5 has no stream argument.
+        stats = pstats.Stats(profiler)
+        stats.stream = out
+    stats.strip_dirs().sort_stats('cumulative', 'time').print_stats(PRUN_LINES)
+    return 'Profiled in %.1f ms\n%s' % (elapsed * 1000, out.getvalue().strip('\n') + '\n')
+
+class Discard(object):
+    """A file-like object ignoring everything written to it."""
+    def write(self, text):
+        pass
+
+    def writelines(self, lines):
+        pass
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+def timeit(bytecode, namespace):
+    """Run bytecode in a namespace repeatedly, and return the timing report.  Only
+    the output of the first run is kept.
+    """
+    times = []
+    recorder = APICallRecorder()
+    recorder.start()
+    old_stdout = sys.stdout
+    old_stderr = sys.stderr
+    try:
+        deadline = time.time() + TIMEIT_TIME_LIMIT
+        while len(times) < TIMEIT_RUNS:
+            started = time.time()
+            exec bytecode in namespace
+            times.append(time.time() - started)
+            if time.time() >= deadline:
+                break
+            sys.stdout = sys.stderr = Discard()
+    finally:
+        sys.stdout = old_stdout
+        sys.stderr = old_stderr
+        recorder.stop()
+
+    best = min(times)
+    average = sum(times) / len(times)
+    return ('%d runs: best %s, average %s per run\n' % (len(times), formatTime(best), formatTime(average))
+            + recorder.report())
+
+def formatTime(seconds):
+    if seconds >= 1:
+        return '%.2f s' % seconds
+    if seconds >= 0.001:
+        return '%.2f ms' % (seconds * 1000)
+    return '%.2f us' % (seconds * 1000000)
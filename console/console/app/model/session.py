@@ -26,27 +26,89 @@ across commands.
 TODO: unit tests!
 """
 
-import logging
-import pickle
 import types
+import hashlib
+import logging
+import cPickle
 
 from google.appengine.ext import db
 
 # The entity kind for shell sessions. Feel free to rename to suit your app.
 _SESSION_KIND = '_Console_Session'
 
+# The entity kind for the stored globals of shell sessions.
+_GLOBAL_KIND = '_Console_Global'
+
+# The most pickled data stored in one global entity, or written in one batch
+# put.  Larger globals are split into several entities, so this must leave
+# room for the rest of the request under the API's one megabyte limit.
+GLOBAL_CHUNK_SIZE = 1000 * 1000 - 64 * 1024
+
+class ShellGlobal(db.Model):
+  """One chunk of the pickled value of a session global.
+
+  Globals are stored as children of their session, with key names made by
+  global_key_name(), so that they can be fetched by key without a query.
+  """
+  value = db.BlobProperty()
+
+  @classmethod
+  def kind(cls):
+    return _GLOBAL_KIND
+
+def global_key_name(name, chunk):
+  """Returns the key name of one chunk of a global.
+
+  Args:
+    name: string, the name of the global
+    chunk: int, the index of the chunk
+  """
+  return 'global:%s:%d' % (name, chunk)
+
+# The most entities deleted, or child keys fetched, in one datastore call.
+DELETE_BATCH_SIZE = 500
+
+def delete_sessions(keys):
+  """Deletes sessions, with the entities storing their globals.
+
+  Args:
+    keys: list of db.Key, the sessions to delete
+  """
+  doomed = []
+  for key in keys:
+    query = ShellGlobal.all(keys_only=True).ancestor(key).order('__key__')
+    children = query.fetch(DELETE_BATCH_SIZE)
+    while children:
+      doomed.extend(children)
+      query = ShellGlobal.all(keys_only=True).ancestor(key).order('__key__')
+      children = query.filter('__key__ >', children[-1]).fetch(DELETE_BATCH_SIZE)
+  doomed.extend(keys)
+
+  for start in range(0, len(doomed), DELETE_BATCH_SIZE):
+    db.delete(doomed[start:start + DELETE_BATCH_SIZE])
+
 class ShellSession(db.Model):
   """A shell session. Stores the session's globals.
 
   Each session globals is stored in one of two places:
 
-  If the global is picklable, it's stored in the parallel globals and
-  global_names list properties. (They're parallel lists to work around the
-  unfortunate fact that the datastore can't store dictionaries natively.)
+  If the global is picklable, it's stored in its own ShellGlobal child
+  entities, split into chunks of at most GLOBAL_CHUNK_SIZE bytes. The session
+  keeps the global's name, number of chunks and size in bytes in the parallel
+  global_names, global_chunks and global_sizes list properties. (They're parallel lists to work around
+  the unfortunate fact that the datastore can't store dictionaries natively.)
+  Sessions from before globals were stored this way kept the pickles in the
+  parallel globals list property; they are moved to child entities on the
+  session's next put().
 
-  If the global is not picklable (e.g. modules, classes, and functions), or if
-  it was created by the same statement that created an unpicklable global,
-  it's not stored directly. Instead, the statement is stored in the
+  If the global is not picklable (e.g. modules, classes, and functions), a
+  snapshot of it is stored, if possible, in the parallel snapshots and
+  snapshot_names list properties. The snapshot is restored by name, without
+  re-running the statement that created the global.
+
+  Otherwise, if the global can't be captured in a snapshot, or if it was
+  created by the same statement that created such a global, it's not stored
+  directly. Instead, the statement is stored in the
   unpicklables list property. On each request, before executing the current
   statement, the unpicklable statements are evaluated to recreate the
   unpicklable globals.
@@ -55,15 +117,93 @@ class ShellSession(db.Model):
   added by unpicklable statements. When we pickle and store the globals after
   executing a statement, we skip the ones in unpicklable_names.
 
+  Globals are fetched lazily, in one batch get by prefetch_globals(), and
+  unpickled one name at a time by get_global(). A hash of each stored pickle
+  is cached so that callers can cheaply tell whether a value they have used
+  actually changed before writing it back. Only changed globals are written
+  by put().
+
   Using Text instead of string is an optimization. We don't query on any of
   these properties, so they don't need to be indexed.
   """
   global_names = db.ListProperty(db.Text)
+  global_chunks = db.ListProperty(int)
+  global_sizes = db.ListProperty(int)
   globals = db.ListProperty(db.Blob)
+  snapshot_names = db.ListProperty(db.Text)
+  snapshots = db.ListProperty(db.Blob)
   unpicklable_names = db.ListProperty(db.Text)
   unpicklables = db.ListProperty(db.Text)
 
-  def set_global(self, name, value):
+  def __init__(self, *args, **kw):
+    db.Model.__init__(self, *args, **kw)
+    self._global_pickles = {}
+    self._global_hashes = {}
+    self._dirty_globals = set()
+    self._stale_chunks = set()
+
+    if self.globals:
+      # Upgrade a session which stored its globals inline.
+      for name, blob in zip(self.global_names, self.globals):
+        self._global_pickles[name] = str(blob)
+        self._dirty_globals.add(name)
+      self.global_chunks = [0] * len(self.global_names)
+      self.global_sizes = [len(blob) for blob in self.globals]
+      self.globals = []
+    elif len(self.global_sizes) != len(self.global_names):
+      self.global_sizes = [0] * len(self.global_names)
+
+  @staticmethod
+  def pickle_global(value):
+    """Returns the pickled string which would be stored for a value."""
+    return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+  @staticmethod
+  def hash_pickle(pickled):
+    """Returns the content hash of a pickled string."""
+    return hashlib.md5(pickled).digest()
+
+  def global_keys(self, name):
+    """Returns the keys of the stored chunks of a global.
+
+    Args:
+      name: string, the name of the global
+    """
+    chunks = self.global_chunks[self.global_names.index(name)]
+    return [db.Key.from_path(_GLOBAL_KIND, global_key_name(name, chunk),
+                             parent=self.key())
+            for chunk in range(chunks)]
+
+  def prefetch_globals(self, names):
+    """Fetches the stored pickles of several globals in one batch.
+
+    Names which are unknown or already fetched are skipped.
+
+    Args:
+      names: list of strings, the names of the globals
+    """
+    names = [name for name in names
+             if name in self.global_names and name not in self._global_pickles]
+    if not names:
+      return
+
+    keys = []
+    for name in names:
+      keys.extend(self.global_keys(name))
+    entities = iter(db.get(keys))
+
+    for name in names:
+      chunks = self.global_chunks[self.global_names.index(name)]
+      pickled = []
+      for chunk in range(chunks):
+        entity = entities.next()
+        if entity is None:
+          logging.warning('Missing chunk %d of global %s' % (chunk, name))
+        else:
+          pickled.append(str(entity.value))
+      self._global_pickles[name] = ''.join(pickled)
+
+  def set_global(self, name, value, pickled=None):
     """Adds a global, or updates it if it already exists.
 
     Also removes the global from the list of unpicklable names.
@@ -71,18 +211,53 @@ class ShellSession(db.Model):
     Args:
       name: the name of the global to remove
       value: any picklable value
+      pickled: optional string, value as already returned by pickle_global()
     """
-    blob = db.Blob(pickle.dumps(value))
+    if pickled is None:
+      pickled = self.pickle_global(value)
 
-    if name in self.global_names:
-      index = self.global_names.index(name)
-      self.globals[index] = blob
-    else:
+    if name not in self.global_names:
       self.global_names.append(db.Text(name))
-      self.globals.append(blob)
+      self.global_chunks.append(0)
+      self.global_sizes.append(0)
+    self.global_sizes[self.global_names.index(name)] = len(pickled)
+    self._global_pickles[name] = pickled
+    self._global_hashes[name] = self.hash_pickle(pickled)
+    self._dirty_globals.add(name)
 
+    self.remove_snapshot(name)
     self.remove_unpicklable_name(name)
 
+  def get_global(self, name):
+    """Unpickles and returns a single global.
+
+    Args:
+      name: string, the name of the global
+
+    Raises:
+      KeyError if there is no such global.
+    """
+    if name not in self.global_names:
+      raise KeyError(name)
+    self.prefetch_globals([name])
+    return cPickle.loads(self._global_pickles[name])
+
+  def global_hash(self, name):
+    """Returns the cached content hash of a global's stored pickle.
+
+    Args:
+      name: string, the name of the global
+
+    Raises:
+      KeyError if there is no such global.
+    """
+    if name not in self._global_hashes:
+      if name not in self.global_names:
+        raise KeyError(name)
+      self.prefetch_globals([name])
+      self._global_hashes[name] = self.hash_pickle(self._global_pickles[name])
+    return self._global_hashes[name]
+
   def remove_global(self, name):
     """Removes a global, if it exists.
 
@@ -90,20 +265,114 @@ class ShellSession(db.Model):
       name: string, the name of the global to remove
     """
     if name in self.global_names:
+      if self.is_saved():
+        self._stale_chunks.update(self.global_keys(name))
       index = self.global_names.index(name)
       del self.global_names[index]
-      del self.globals[index]
+      del self.global_chunks[index]
+      del self.global_sizes[index]
+    self._global_pickles.pop(name, None)
+    self._global_hashes.pop(name, None)
+    self._dirty_globals.discard(name)
+
+  def stored_size(self):
+    """Returns the approximate number of bytes the session's state takes."""
+    return (sum(self.global_sizes) +
+            sum([len(snapshot) for snapshot in self.snapshots]) +
+            sum([len(statement) for statement in self.unpicklables]))
 
   def globals_dict(self):
     """Returns a dictionary view of the globals.
+
+    This unpickles every global; prefer get_global() for single names.
+    """
+    self.prefetch_globals(self.global_names)
+    return dict((name, cPickle.loads(self._global_pickles[name]))
+                for name in self.global_names)
+
+  def put(self):
+    """Writes the session, and the chunks of any changed globals.
+
+    The session and its changed chunks are written in as few batch puts as
+    the request size limit allows, and the chunks of removed or shrunken
+    globals in one batch delete.
+    """
+    if not self._dirty_globals and not self._stale_chunks:
+      return db.Model.put(self)
+    if not self.is_saved():
+      db.Model.put(self)
+
+    entities = []
+    for name in self._dirty_globals:
+      pickled = self._global_pickles[name]
+      index = self.global_names.index(name)
+      old_keys = self.global_keys(name)
+
+      chunks = max(1, (len(pickled) + GLOBAL_CHUNK_SIZE - 1) // GLOBAL_CHUNK_SIZE)
+      for chunk in range(chunks):
+        data = pickled[chunk * GLOBAL_CHUNK_SIZE:(chunk + 1) * GLOBAL_CHUNK_SIZE]
+        entities.append(ShellGlobal(parent=self,
+                                    key_name=global_key_name(name, chunk),
+                                    value=db.Blob(data)))
+      self.global_chunks[index] = chunks
+      self._stale_chunks.update(old_keys[chunks:])
+
+    self._stale_chunks.difference_update(entity.key() for entity in entities)
+
+    # Batch the puts, keeping each API request within the size limit.
+    batch, batch_size = [], 0
+    for entity in entities:
+      if batch and batch_size + len(entity.value) > GLOBAL_CHUNK_SIZE:
+        db.put(batch)
+        batch, batch_size = [], 0
+      batch.append(entity)
+      batch_size += len(entity.value)
+    batch.append(self)
+    key = db.put(batch)[-1]
+    if self._stale_chunks:
+      db.delete(list(self._stale_chunks))
+
+    self._dirty_globals.clear()
+    self._stale_chunks.clear()
+    return key
+
+  def set_snapshot(self, name, snapshot):
+    """Adds a snapshot of an unpicklable global, or updates it if it already
+    exists.
+
+    Also removes the global from the globals, and from the list of
+    unpicklable names. Snapshots are kept in the order they were first set,
+    and restored in that order, so that base classes come before the classes
+    derived from them.
+
+    Args:
+      name: string, the name of the global
+      snapshot: string, the snapshot of the global
+    """
+    if name in self.snapshot_names:
+      self.snapshots[self.snapshot_names.index(name)] = db.Blob(snapshot)
+    else:
+      self.snapshot_names.append(db.Text(name))
+      self.snapshots.append(db.Blob(snapshot))
+
+    self.remove_global(name)
+    self.remove_unpicklable_name(name)
+
+  def remove_snapshot(self, name):
+    """Removes the snapshot of a global, if it exists.
+
+    Args:
+      name: string, the name of the global
     """
-    return dict((name, pickle.loads(val))
-                for name, val in zip(self.global_names, self.globals))
+    if name in self.snapshot_names:
+      index = self.snapshot_names.index(name)
+      del self.snapshot_names[index]
+      del self.snapshots[index]
 
   def add_unpicklable(self, statement, names):
     """Adds a statement and list of names to the unpicklables.
 
-    Also removes the names from the globals.
+    Also removes the names from the globals and snapshots.
 
     Args:
       statement: string, the statement that created new unpicklable global(s).
@@ -113,6 +382,7 @@ class ShellSession(db.Model):
 
     for name in names:
       self.remove_global(name)
+      self.remove_snapshot(name)
       if name not in self.unpicklable_names:
         self.unpicklable_names.append(db.Text(name))
 
@@ -0,0 +1,210 @@
+# Snapshots of unpicklable console globals
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Snapshots of the globals which pickle can not store.
+
+Modules, and functions and classes defined elsewhere, are recorded by name
+and re-imported.  Functions and classes defined in the console are recorded
+by their marshalled code objects, and rebuilt in the console namespace.
+Anything else, for example a function with a closure or a class with a
+custom metaclass, can not be captured, and the statement which created it
+must be replayed instead.
+"""
+
+import sys
+import types
+import marshal
+import cPickle
+
+class SnapshotError(Exception):
+    """A value can not be captured, or a snapshot can not be restored"""
+
+# Marshalled code is only readable by the Python version which wrote it.
+PYTHON_VERSION = tuple(sys.version_info[:2])
+
+CLASS_TYPES = (types.TypeType, types.ClassType)
+
+# Class attributes which the class machinery creates by itself.
+SKIPPED_MEMBER_TYPES = (types.MemberDescriptorType, types.GetSetDescriptorType)
+
+def reference(value):
+    """Return a snapshot of a value importable from another module, or None."""
+    if isinstance(value, types.ModuleType):
+        if sys.modules.get(value.__name__) is value:
+            return ('module', value.__name__)
+        return None
+
+    module_name = getattr(value, '__module__', None)
+    name = getattr(value, '__name__', None)
+    if not module_name or not name or module_name == '__main__':
+        return None
+    module = sys.modules.get(module_name)
+    if module is None or getattr(module, name, None) is not value:
+        return None
+    return ('import', module_name, name)
+
+def capture_function(func, namespace):
+    if func.func_closure is not None:
+        raise SnapshotError('%s has a closure' % func.__name__)
+    if func.func_globals is not namespace:
+        raise SnapshotError('%s belongs to another namespace' % func.__name__)
+    return ('function', PYTHON_VERSION, marshal.dumps(func.func_code),
+            func.__name__, func.func_defaults, func.__dict__ or None)
+
+def capture_member(value, namespace):
+    if isinstance(value, types.FunctionType):
+        return capture_function(value, namespace)
+    if isinstance(value, staticmethod):
+        return ('staticmethod', capture_member(value.__get__(None, object), namespace))
+    if isinstance(value, classmethod):
+        return ('classmethod', capture_member(value.__get__(None, object).im_func, namespace))
+    if isinstance(value, property):
+        accessors = [(f is not None and capture_member(f, namespace) or None)
+                     for f in (value.fget, value.fset, value.fdel)]
+        return ('property', accessors, value.__doc__)
+    if isinstance(value, CLASS_TYPES + (types.ModuleType,)):
+        ref = reference(value)
+        if ref is None:
+            raise SnapshotError('%r can not be captured' % value)
+        return ref
+    return ('value', value)
+
+def capture_class(cls, name, namespace, replayed):
+    if cls.__module__ != '__main__' or cls.__name__ != name:
+        raise SnapshotError('%s is not a console class' % name)
+    if type(cls) not in CLASS_TYPES:
+        raise SnapshotError('%s has a custom metaclass' % name)
+
+    bases = []
+    for base in cls.__bases__:
+        ref = reference(base)
+        if ref is None:
+            if namespace.get(base.__name__) is not base:
+                raise SnapshotError('%s has an unknown base class' % name)
+            if base.__name__ in replayed:
+                # Snapshots are restored before statements are replayed.
+                raise SnapshotError('%s has a replayed base class' % name)
+            ref = ('global', base.__name__)
+        bases.append(ref)
+
+    members = []
+    for attr, value in cls.__dict__.items():
+        if attr in ('__dict__', '__weakref__'):
+            continue
+        if isinstance(value, SKIPPED_MEMBER_TYPES):
+            continue
+        members.append((attr, capture_member(value, namespace)))
+
+    return ('class', type(cls) is types.ClassType, name, bases, members)
+
+def capture(name, value, namespace, replayed=()):
+    """Return a string snapshot of a global, which restore() can rebuild in
+    the given namespace.  Raise SnapshotError if it can't be done.  The
+    replayed names are globals recreated by replaying statements, which are
+    not available yet when snapshots are restored.
+    """
+    snapshot = reference(value)
+    if snapshot is None:
+        if isinstance(value, types.FunctionType):
+            snapshot = capture_function(value, namespace)
+        elif isinstance(value, CLASS_TYPES):
+            snapshot = capture_class(value, name, namespace, replayed)
+        else:
+            raise SnapshotError('%s can not be captured' % name)
+
+    try:
+        return cPickle.dumps(snapshot, cPickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+        raise SnapshotError('%s can not be captured: %s' % (name, e))
+
+def rebuild(snapshot, namespace):
+    kind = snapshot[0]
+    if kind == 'module':
+        __import__(snapshot[1])
+        return sys.modules[snapshot[1]]
+
+    if kind == 'import':
+        module_name, name = snapshot[1:]
+        __import__(module_name)
+        return getattr(sys.modules[module_name], name)
+
+    if kind == 'global':
+        if snapshot[1] not in namespace:
+            raise SnapshotError('%s is not defined' % snapshot[1])
+        return namespace[snapshot[1]]
+
+    if kind == 'function':
+        version, code, name, defaults, attrs = snapshot[1:]
+        if version != PYTHON_VERSION:
+            raise SnapshotError('%s was captured by Python %d.%d' % ((name,) + version))
+        func = types.FunctionType(marshal.loads(code), namespace, name, defaults)
+        if attrs:
+            func.__dict__.update(attrs)
+        return func
+
+    if kind == 'staticmethod':
+        return staticmethod(rebuild(snapshot[1], namespace))
+
+    if kind == 'classmethod':
+        return classmethod(rebuild(snapshot[1], namespace))
+
+    if kind == 'property':
+        accessors, doc = snapshot[1:]
+        accessors = [(f is not None and rebuild(f, namespace) or None) for f in accessors]
+        return property(accessors[0], accessors[1], accessors[2], doc)
+
+    if kind == 'value':
+        return snapshot[1]
+
+    if kind == 'class':
+        classic, name, bases, members = snapshot[1:]
+        bases = tuple([rebuild(base, namespace) for base in bases])
+        members = dict([(attr, rebuild(member, namespace)) for attr, member in members])
+        if classic:
+            return types.ClassType(name, bases, members)
+        return type(name, bases, members)
+
+    raise SnapshotError('Unknown snapshot kind: %s' % kind)
+
+def restore(snapshot, namespace):
+    """Return the global rebuilt from a snapshot made by capture().  Raise
+    SnapshotError if it can't be done.
+    """
+    try:
+        return rebuild(cPickle.loads(snapshot), namespace)
+    except SnapshotError:
+        raise
+    except Exception, e:
+        raise SnapshotError(str(e))
+
+def code_objects(value):
+    """Return the code objects a restored global may run."""
+    if isinstance(value, types.FunctionType):
+        return [value.func_code]
+
+    codes = []
+    if isinstance(value, CLASS_TYPES) and value.__module__ == '__main__':
+        for member in value.__dict__.values():
+            if isinstance(member, (staticmethod, classmethod)):
+                member = member.__get__(None, object)
+                member = getattr(member, 'im_func', member)
+            if isinstance(member, property):
+                codes.extend([f.func_code for f in (member.fget, member.fset, member.fdel)
+                              if isinstance(f, types.FunctionType)])
+            elif isinstance(member, types.FunctionType):
+                codes.append(member.func_code)
+    return codes
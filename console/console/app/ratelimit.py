@@ -0,0 +1,135 @@
+# App Engine Console rate limiting
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Rate limiting over a sliding window, with counters in memcache.
+
+Usage is counted in fixed windows, and the count over the last window's
+length is estimated by weighting the previous window by how much of it is
+still within the sliding window.  That avoids both the burst allowed at the
+edge of a fixed window and the cost of recording every request.
+
+Each window's count is split over several memcache counters (shards), which
+are incremented at random, so that a busy subject doesn't make one key hot.
+"""
+
+import os
+import time
+import random
+import logging
+
+from google.appengine.api import users
+from google.appengine.api import memcache
+
+# How the subject being limited is identified.
+BY_IP   = 'ip'      # The client's IP address.
+BY_USER = 'user'    # The logged-in user, or the IP address for anonymous users.
+
+# Every rate limiter, by name, for monitoring.
+limiters = {}
+
+def remote_addr():
+    # Ideally, the REMOTE_ADDR combined with HTTP_X_FORWARDED_FOR reasonably identifies a unique user.  But
+    # someone could just change their FORWARDED_FOR header all the time and get around this limit, so we
+    # just make everybody behind the same proxy suffer.
+    return os.environ.get('REMOTE_ADDR', 'unknown')
+
+class RateLimiter(object):
+    """Limits something to at most limit uses, per subject, in any window seconds."""
+    def __init__(self, name, limit, window=60, policy=BY_IP, shards=4):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.policy = policy
+        self.shards = shards
+
+        # Decisions made by this instance; see stats().
+        self.allowed = 0
+        self.denied = 0
+
+        limiters[name] = self
+
+    def subject(self):
+        """Return the identity of the requester, per the policy."""
+        if self.policy == BY_USER:
+            user = users.get_current_user()
+            if user:
+                return 'user:%s' % user.email()
+        return 'ip:%s' % remote_addr()
+
+    def key(self, subject, window, shard):
+        return 'ratelimit:%s:%s:%d:%d' % (self.name, subject, window, shard)
+
+    def attempt(self, cost=1, subject=None):
+        """Count a use of the given cost, and return whether it is within the limit.
+        Uses over the limit are counted too, so a subject has to slow down to get
+        under it again.  Return None if memcache failed, so nothing is known.
+        """
+        if subject is None:
+            subject = self.subject()
+
+        now = time.time()
+        window = int(now // self.window)
+        shard = random.randrange(self.shards)
+
+        key = self.key(subject, window, shard)
+        count = memcache.incr(key, cost)
+        if count is None:
+            # The counter's first use in this window.  Adding it can only fail
+            # if another request just did, and either way it is then counted.
+            memcache.add(key, 0, time=self.window * 2)
+            count = memcache.incr(key, cost)
+            if count is None:
+                logging.error('Rate limiter %s failed to count %s' % (self.name, subject))
+                return None
+
+        keys = [self.key(subject, w, s) for w in (window - 1, window)
+                                        for s in range(self.shards)
+                                        if (w, s) != (window, shard)]
+        counts = memcache.get_multi(keys)
+        current = count + sum([counts.get(self.key(subject, window, s), 0) for s in range(self.shards)
+                               if s != shard])
+        previous = sum([counts.get(self.key(subject, window - 1, s), 0) for s in range(self.shards)])
+
+        # The part of the previous window still within the sliding window.
+        overlap = 1.0 - (now % self.window) / self.window
+        used = current + previous * overlap
+
+        if used > self.limit:
+            logging.info('Rate limiter %s denying %s (%.1f uses)' % (self.name, subject, used))
+            self.denied += 1
+            self.record('denied')
+            return False
+
+        self.allowed += 1
+        self.record('allowed')
+        return True
+
+    def record(self, decision):
+        """Count a decision across all instances, for monitoring."""
+        key = 'ratelimit:%s:%s' % (self.name, decision)
+        if memcache.incr(key) is None:
+            memcache.add(key, 0)
+            memcache.incr(key)
+
+    def stats(self):
+        """Return a dictionary of the limiter's settings and decisions, by this
+        instance and (as far as memcache remembers) by all of them.
+        """
+        totals = memcache.get_multi(['allowed', 'denied'], key_prefix='ratelimit:%s:' % self.name)
+        return {'name': self.name, 'limit': self.limit, 'window': self.window, 'policy': self.policy,
+                'allowed': self.allowed, 'denied': self.denied,
+                'total_allowed': totals.get('allowed', 0), 'total_denied': totals.get('denied', 0)}
@@ -1,10 +1,56 @@
-
 from __future__ import absolute_import
 
+import time
+import logging
+import mimetypes
+import email.Utils
+
 from google.appengine.ext.zipserve import ZipHandler
 
+import util
 from console import APPZIPPATH
 
+# Files served from zip files, by (zip path, name, zip mtime): a dict of the
+# decompressed body and the headers describing it.  Only the files of the
+# current version of each zip file are kept.
+_files = {}
+
+def load_file(zipfilename, name):
+    """Return the cached file (see _files) for a member of a zip file, or None
+    if it is missing.
+    """
+    try:
+        mtime, zipfile_object = util.open_zipfile(zipfilename)
+    except (IOError, OSError, RuntimeError), err:
+        logging.error('Can\'t open zipfile %s: %s', zipfilename, err)
+        return None
+
+    key = (zipfilename, name, mtime)
+    cached = _files.get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        info = zipfile_object.getinfo(name)
+        body = zipfile_object.read(name)
+    except (KeyError, RuntimeError):
+        return None
+
+    # The CRC and size identify the content; the date is the member's own.
+    modified = time.mktime(info.date_time + (0, 0, -1))
+    cached = {
+        'body'         : body,
+        'etag'         : '"%08x-%x"' % (info.CRC & 0xffffffff, info.file_size),
+        'modified'     : modified,
+        'last_modified': email.Utils.formatdate(modified, usegmt=True),
+        'content_type' : mimetypes.guess_type(name)[0],
+    }
+
+    for old in [old for old in _files if old[:2] == key[:2]]:
+        del _files[old]
+    _files[key] = cached
+    return cached
+
 def make_zip_handler(zipfilename, max_age=None, public=None, subpath=''):
     """Factory function to construct a custom ZipHandler instance.
   Args:
@@ -16,15 +62,61 @@ def make_zip_handler(zipfilename, max_age=None, public=None, subpath=''):
   Returns:
     A ZipHandler subclass.
     """
-    
+
     class StaticSubpathZipHandler(ZipHandler):
         # Subpath of zipfile to our dir of static content
         SUBPATH = subpath
-        
+
+        if max_age is not None:
+            MAX_AGE = max_age
+        if public is not None:
+            PUBLIC = public
+
         def get(self, name):
             name = '/'.join([self.SUBPATH, name.lstrip('/')])
-            ZipHandler.ServeFromZipFile(self, zipfilename, name)
-    
+            self.ServeCachedFromZipFile(zipfilename, name)
+
+        def ServeCachedFromZipFile(self, zipfilename, name):
+            """Like ZipHandler.ServeFromZipFile(), but from memory after the first
+            request, and answering conditional requests with 304 Not Modified.
+
+            (App Engine compresses responses itself, and drops any
+            Content-Encoding header set here, so the body is sent as it is.)
+            """
+            cached = load_file(zipfilename, name)
+            if cached is None:
+                self.error(404)
+                self.response.out.write('Not found')
+                return
+
+            self.response.headers['ETag'] = cached['etag']
+            self.response.headers['Last-Modified'] = cached['last_modified']
+            self.SetCachingHeaders()
+
+            if self.NotModified(cached):
+                self.response.set_status(304)
+                return
+
+            if cached['content_type']:
+                self.response.headers['Content-Type'] = cached['content_type']
+            self.response.out.write(cached['body'])
+
+        def NotModified(self, cached):
+            """Return whether the client's copy, per the request's conditional
+            headers, is current.
+            """
+            if_none_match = self.request.headers.get('If-None-Match')
+            if if_none_match:
+                etags = [etag.strip() for etag in if_none_match.split(',')]
+                return (cached['etag'] in etags) or ('*' in etags)
+
+            if_modified_since = self.request.headers.get('If-Modified-Since')
+            if if_modified_since:
+                since = email.Utils.parsedate_tz(if_modified_since)
+                if since is not None:
+                    return int(cached['modified']) <= email.Utils.mktime_tz(since)
+            return False
+
     return StaticSubpathZipHandler
 
 ConsoleStaticZipHandler = make_zip_handler(APPZIPPATH, subpath='app/view/static')
@@ -19,6 +19,8 @@
 
 import os
 import sys
+import logging
+import zipfile
 
 def is_dev():
     """Return whether the application environment is in development mode."""
@@ -62,3 +64,147 @@ def trim(docstring):
         trimmed.pop(0)
     # Return a single string:
     return '\n'.join(trimmed)
+
+def once(func):
+    """Decorate a function of no arguments to run only on the first call, and
+    return the same value after that.
+    """
+    results = []
+    def wrapper():
+        if not results:
+            results.append(func())
+        return results[0]
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+class lazy(object):
+    """A class attribute whose value is made by a function of no arguments the
+    first time it is used, and replaces it in the class which defined it.
+    """
+    def __init__(self, make):
+        self.make = make
+        self.__doc__ = make.__doc__
+
+    def __get__(self, obj, cls):
+        value = self.make()
+        for klass in cls.__mro__:
+            for name, attr in klass.__dict__.items():
+                if attr is self:
+                    setattr(klass, name, value)
+                    return value
+        return value
+
+# Open zip files, by path: (mtime, ZipFile).  Opening one reads its whole
+# central directory, so it is only done again when the file changes.
+zipfiles = {}
+
+def open_zipfile(zfname):
+    """Return (mtime, ZipFile) for a zip file, reopening it if it has changed."""
+    mtime = os.stat(zfname).st_mtime
+    cached = zipfiles.get(zfname)
+    if cached and cached[0] == mtime:
+        return cached
+
+    if cached:
+        logging.info('Reopening changed zip file: %s' % zfname)
+        cached[1].close()
+
+    z = zipfile.ZipFile(zfname)
+    zipfiles[zfname] = (mtime, z)
+    return mtime, z
+
+class LRUCache(object):
+    """A least-recently-used cache, bounded by its number of items and, optionally,
+    by the total "weight" the caller gives to the items.
+
+    Items are kept in a circular doubly linked list, from the least recently used
+    after the root link to the most recently used before it, so that using and
+    evicting one takes constant time.
+    """
+    PREV, NEXT, KEY, VALUE, WEIGHT = range(5)
+
+    def __init__(self, max_items, max_weight=None):
+        self.max_items = max_items
+        self.max_weight = max_weight
+        self.items = {}     # key -> [prev, next, key, value, weight]
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, 0]
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def unlink(self, link):
+        prev, next = link[self.PREV], link[self.NEXT]
+        prev[self.NEXT] = next
+        next[self.PREV] = prev
+
+    def append(self, link):
+        """Link an item in as the most recently used."""
+        last = self.root[self.PREV]
+        link[self.PREV], link[self.NEXT] = last, self.root
+        last[self.NEXT] = self.root[self.PREV] = link
+
+    def get(self, key, default=None):
+        """Return the value for a key, marking it as just used."""
+        link = self.items.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.unlink(link)
+        self.append(link)
+        return link[self.VALUE]
+
+    def pop(self, key, default=None):
+        """Remove a key and return its value, counting it as a hit or miss."""
+        link = self.items.pop(key, None)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.unlink(link)
+        self.weight -= link[self.WEIGHT]
+        return link[self.VALUE]
+
+    def put(self, key, value, weight=1):
+        """Store a value, evicting the least-recently-used items if needed.  Return
+        whether it was stored; an item heavier than the whole cache is not.
+        """
+        link = self.items.pop(key, None)
+        if link is not None:
+            self.unlink(link)
+            self.weight -= link[self.WEIGHT]
+        if self.max_items < 1 or (self.max_weight is not None and weight > self.max_weight):
+            return False
+
+        while self.items and (len(self.items) >= self.max_items or
+                              (self.max_weight is not None and self.weight + weight > self.max_weight)):
+            oldest = self.root[self.NEXT]
+            self.unlink(oldest)
+            del self.items[oldest[self.KEY]]
+            self.weight -= oldest[self.WEIGHT]
+            self.evictions += 1
+
+        link = [None, None, key, value, weight]
+        self.append(link)
+        self.items[key] = link
+        self.weight += weight
+        return True
+
+    def clear(self):
+        self.items.clear()
+        self.root[:] = [self.root, self.root, None, None, 0]
+        self.weight = 0
+
+    def stats(self):
+        """Return a dictionary of the cache's size and usage counters."""
+        return {'items': len(self.items), 'weight': self.weight,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
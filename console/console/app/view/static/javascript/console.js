@@ -25,9 +25,15 @@ var promptType = 'ps1';
 var hist = {
     'buffer'  : [],
     'position': -1,
-    'pending' : ''
+    'pending' : '',
+    'start'   : 0,      // The number, in the stored history, of the first statement in the buffer.
+    'loading' : false,
+    'search'  : null    // The Ctrl-R search in progress, if any.
 };
 
+/* How often, in milliseconds, to poll for the output of a running statement. */
+var STREAM_POLL_INTERVAL = 1000;
+
 /* Change this to false to use alert popups for Safari logging. */
 var SILENT_ALERTS = true;
 
@@ -48,14 +54,19 @@ var main = function() {
     // Event handlers
     $('#console_form').submit(statementSubmit);
     $('#console_statement').keyup(statementKeyUp);
+    $('#console_statement').keydown(statementKeyDown);
+    $('#console_statement').bind('paste', statementPaste);
     $('#setting_teamwork').change(setTeamwork);
     $('#setting_dash_type').change(setDashboard);
 
     // Some browsers cache the <select> option, so do the teamwork thing now.
+    if($('#setting_shared').val() == '1')
+        $('#setting_teamwork').val('Sharing');
     setTeamwork();
     setDashboard();
 
     fetchBanner();
+    fetchHistory();
 
     var input = $('#console_statement').get(0);
     if(input != null)
@@ -76,16 +87,14 @@ var statementSubmit = function(event) {
             return;
         }
 
-        // First put the prompt there so it looks like a standard Python console session.
-        var promptStr = '>>> ';
-        if(promptType == 'ps2')
-            promptStr = '... ';
+        // A pasted script arrives as several lines.  Run them all in one request.
+        var lines = statement.split(/\r\n|\r|\n/);
+        if(lines.length > 1) {
+            statementsSubmit(lines);
+            return;
+        }
 
-        // Due to IE 6 support, not pure jQuery anymore.
-        if(!is_ie)
-            $('#console_output').append($('<span>').addClass('prompt').append(promptStr));
-        else
-            $('#console_output').append($('<span class="prompt">' + promptStr + '</span>'));
+        appendPrompt();
 
         // This is a temporary representation of the code.  When the server replies,
         // it will re-send the code that it processed (possibly marked up with syntax
@@ -104,18 +113,19 @@ var statementSubmit = function(event) {
         hist.pending  = '';
 
         // POST the statement to the servre.
-        var highlight = ( $('#setting_highlight').val() == 'Highlighting' )
-            ? 1
-            : 0;
+        var highlight = highlighting();
 
+        var streaming = streamOutput();
         var values = {
             'session'  : $('#setting_session').val(),
             'highlight': highlight,
+            'stream'   : streaming.id,
             'code'     : statement
         };
 
         var returnedStatement = function(response, textStatus) {
             // Handle the response returned from Python on the server.
+            streaming.stop();
             switch(textStatus) {
                 case 'timeout':
                 case 'error':
@@ -126,22 +136,15 @@ var statementSubmit = function(event) {
                     break;
             }
 
+            if(highlight == 'tokens')
+                renderTokens(response);
+
             // Replace the old temporarary code with the server's version.
             statementContainer.html(response['in']);
             if(highlight)
                 statementContainer.addClass('pygments').removeClass('plain');
 
-            // Append the server output.  For non-highlighting mode, the response is manually appended inside
-            // the PRE tag to fix a rendering bug with IE.
-            var output;
-            if(highlight)
-                output = $('<div>').addClass('pygments').append(response.out);
-            else
-                output = $('<pre>' + response.out + '</pre>');
-
-            output.addClass('output');
-            $('#console_output').append(output);
-
+            appendOutput(response, highlight);
             scrollOutput();
 
             if(response.result != null)
@@ -157,6 +160,181 @@ var statementSubmit = function(event) {
     }
 };
 
+var statementPaste = function(event) {
+    // The one-line input would drop the line breaks of a pasted script, so take it from the clipboard.
+    var orig = event.originalEvent;
+    var text = null;
+    if(orig && orig.clipboardData && orig.clipboardData.getData)
+        text = orig.clipboardData.getData('text/plain');
+    else if(window.clipboardData)
+        text = window.clipboardData.getData('Text');
+
+    if(!text || !text.match(/[\r\n]/))
+        return;     // Let the browser paste it.
+
+    event.preventDefault();
+    var input = $('#console_statement');
+    var lines = (input.val() + text).split(/\r\n|\r|\n/);
+    input.val('');
+    statementsSubmit(lines);
+};
+
+var statementsSubmit = function(lines) {
+    // Show the lines as they were given until the server replies with each statement and its output.
+    var placeholder = $('<pre>').addClass('statement').addClass('plain').text(lines.join('\n'));
+    $('#console_output').append(placeholder);
+
+    for(var i = 0; i < lines.length; i++)
+        hist.buffer.push(lines[i]);
+    hist.position = -1;
+    hist.pending  = '';
+
+    var highlight = highlighting();
+    var streaming = streamOutput();
+    var values = {
+        'session'  : $('#setting_session').val(),
+        'highlight': highlight,
+        'stream'   : streaming.id,
+        'code'     : lines
+    };
+
+    var returnedStatements = function(response, textStatus) {
+        streaming.stop();
+        switch(textStatus) {
+            case 'timeout':
+            case 'error':
+            case 'notmodified':
+            case 'parseerror':
+                console.error('Statements error: %s; response=%s', textStatus, response);
+                return;
+                break;
+        }
+
+        placeholder.remove();
+        $.each(response.results, function(i, result) {
+            if(highlight == 'tokens')
+                renderTokens(result);
+
+            appendPrompt();
+
+            var statementContainer = $('<span>').addClass('statement').append(result['in']);
+            statementContainer.addClass(highlight ? 'pygments' : 'plain');
+            $('#console_output').append(statementContainer);
+
+            appendOutput(result, highlight);
+            if(result.result != null)
+                showPrompt(result.result);
+        });
+
+        scrollOutput();
+    };
+
+    $.post('/console/statements', values, returnedStatements, 'json');
+
+    scrollOutput();
+};
+
+var streamOutput = function() {
+    // Show the output of a statement as it runs, by polling for it until stop() is called.  The output
+    // is shown in a temporary element, which stop() removes in favor of the final response.
+    var stream  = uid() + '-' + new Date().getTime() + '-' + Math.floor(Math.random() * 1000000000);
+    var chunk   = 0;
+    var running = true;
+    var live    = $('<pre>').addClass('output').addClass('streaming');
+    $('#console_output').append(live);
+
+    var gotOutput = function(response) {
+        if(running && response.out) {
+            live.append(document.createTextNode(response.out));
+            scrollOutput();
+        }
+        if(response.chunk != null)
+            chunk = response.chunk;
+    };
+
+    var poll = function() {
+        if(!running)
+            return;
+        $.ajax({
+            'url'     : '/console/output',
+            'data'    : {'stream': stream, 'chunk': chunk},
+            'dataType': 'json',
+            'success' : gotOutput,
+            'complete': function() { setTimeout(poll, STREAM_POLL_INTERVAL); }
+        });
+    };
+    setTimeout(poll, STREAM_POLL_INTERVAL);
+
+    return {
+        'id'  : stream,
+        'stop': function() {
+            running = false;
+            live.remove();
+        }
+    };
+};
+
+var highlighting = function() {
+    switch($('#setting_highlight').val()) {
+        case 'Highlighting':
+            return 1;
+        case 'Browser highlighting':
+            return 'tokens';
+    }
+    return 0;
+};
+
+var tokenClasses = null;
+
+var tokensHtml = function(tokens, cssclass) {
+    // Return the HTML Pygments would make of [token ID, text] pairs sent by the server.  The
+    // IDs index the CSS classes listed in the page.
+    if(tokenClasses == null)
+        tokenClasses = $('#setting_tokens').val().split(' ');
+
+    var html = [];
+    for(var i = 0; i < tokens.length; i++) {
+        var cls  = tokenClasses[tokens[i][0]];
+        var text = tokens[i][1].replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;')
+                               .replace(/"/g, '&quot;').replace(/'/g, '&#39;');
+        html.push(cls ? '<span class="' + cls + '">' + text + '</span>' : text);
+    }
+    return '<div class="' + cssclass + '"><pre>' + html.join('') + '</pre></div>';
+};
+
+var renderTokens = function(response) {
+    // Turn a response in tokens into the highlighted HTML the server would have sent.
+    response['in'] = tokensHtml(response['in'], 'statement');
+    response.out = (response.out.length ? tokensHtml(response.out, 'stdout') : '') +
+                   (response.err.length ? tokensHtml(response.err, 'stderr') : '');
+};
+
+var appendPrompt = function() {
+    // First put the prompt there so it looks like a standard Python console session.
+    var promptStr = '>>> ';
+    if(promptType == 'ps2')
+        promptStr = '... ';
+
+    // Due to IE 6 support, not pure jQuery anymore.
+    if(!is_ie)
+        $('#console_output').append($('<span>').addClass('prompt').append(promptStr));
+    else
+        $('#console_output').append($('<span class="prompt">' + promptStr + '</span>'));
+};
+
+var appendOutput = function(response, highlight) {
+    // Append the server output.  For non-highlighting mode, the response is manually appended inside
+    // the PRE tag to fix a rendering bug with IE.
+    var output;
+    if(highlight)
+        output = $('<div>').addClass('pygments').append(response.out);
+    else
+        output = $('<pre>' + response.out + '</pre>');
+
+    output.addClass('output');
+    $('#console_output').append(output);
+};
+
 var statementKeyUp = function(event) {
     var orig = event.originalEvent;
     var key = event.charCode || event.keyCode || 0;
@@ -180,6 +358,75 @@ var statementKeyUp = function(event) {
         moveHistory(1);
 };
 
+var statementKeyDown = function(event) {
+    // Tab completes the name before the cursor, and Ctrl-R searches the history.  They have to be
+    // caught before the browser moves the focus or reloads the page.
+    var orig = event.originalEvent;
+    var key = event.charCode || event.keyCode || 0;
+    if(orig.ctrlKey && key == 82 && !(orig.shiftKey || orig.altKey || orig.metaKey)) {
+        event.preventDefault();
+        searchHistory();
+        return;
+    }
+
+    if(key != 17)
+        // Anything but Ctrl itself ends the search, keeping what it found.
+        hist.search = null;
+
+    if(key != 9 || orig.shiftKey || orig.altKey || orig.metaKey || orig.ctrlKey)
+        return;
+
+    event.preventDefault();
+    completeStatement();
+};
+
+var commonPrefix = function(names) {
+    var prefix = names[0];
+    for(var i = 1; i < names.length; i++)
+        while(names[i].indexOf(prefix) != 0)
+            prefix = prefix.substring(0, prefix.length - 1);
+    return prefix;
+};
+
+var completeStatement = function() {
+    var input = $('#console_statement');
+    var field = input.get(0);
+    var text = input.val();
+    var cursor = (field.selectionStart != null) ? field.selectionStart : text.length;
+    var before = text.substring(0, cursor);
+    var after = text.substring(cursor);
+
+    var gotCompletions = function(response, textStatus) {
+        if(textStatus != 'success' || input.val() != text) {
+            // Failed, or the statement changed while waiting.
+            return;
+        }
+
+        var names = response.completions;
+        if(names.length == 0)
+            return;
+
+        // Fill in as much as all of the completions have in common, and list them if there are several.
+        var completed = before.substring(0, response.start) + commonPrefix(names);
+        if(completed.length < before.length)
+            completed = before;
+        input.val(completed + after);
+        if(field.setSelectionRange)
+            field.setSelectionRange(completed.length, completed.length);
+
+        if(names.length > 1) {
+            $('#console_output').append($('<pre>').addClass('completions').text(names.join('  ')));
+            scrollOutput();
+        }
+    };
+
+    var values = {
+        'session': $('#setting_session').val(),
+        'text'   : before
+    };
+    $.get('/console/complete', values, gotCompletions, 'json');
+};
+
 var scroll = function(dir) {
     //console.debug('Scrolling: %s', dir);
     var area = $('#console_area').get(0);
@@ -243,11 +490,88 @@ var cls = function() {
     console.debug('Clearing screen');
 };
 
+var fetchHistory = function(callback) {
+    // Fetch the page of the stored history before the statements in the buffer.
+    if($('#console_interface').length == 0 || hist.loading)
+        return;
+
+    var values = {};
+    if(hist.buffer.length > 0) {
+        if(hist.start == 0)
+            return;
+        values.before = hist.start;
+    }
+
+    var gotHistory = function(response, textStatus) {
+        hist.loading = false;
+        if(textStatus != 'success') {
+            console.error('History error: %s; response=%s', textStatus, response);
+            return;
+        }
+
+        // Statements entered while this was loading are already in the buffer.
+        hist.buffer = response.statements.concat(hist.buffer);
+        if(hist.position != -1)
+            hist.position += response.statements.length;
+        hist.start = response.start;
+        if(callback)
+            callback();
+    };
+
+    hist.loading = true;
+    $.get('/console/history', values, gotHistory, 'json');
+};
+
+var searchHistory = function() {
+    // Search backward through the stored history for the text at the prompt, like readline's Ctrl-R.  Each
+    // Ctrl-R goes on to the next older match.
+    var input = $('#console_statement');
+    if(hist.search == null) {
+        if(input.val() == '')
+            return;
+        hist.search = {'query': input.val(), 'results': [], 'index': -1, 'done': false};
+    }
+    var search = hist.search;
+
+    var showMatch = function() {
+        if(search.index + 1 < search.results.length) {
+            search.index += 1;
+            input.val(search.results[search.index][1]);
+        }
+    };
+
+    if(search.index + 1 < search.results.length || search.done) {
+        showMatch();
+        return;
+    }
+
+    var values = {'q': search.query};
+    if(search.results.length > 0)
+        values.before = search.results[search.results.length - 1][0];
+
+    var gotResults = function(response, textStatus) {
+        if(textStatus != 'success' || hist.search !== search)
+            return;
+        if(response.results.length == 0)
+            search.done = true;
+        search.results = search.results.concat(response.results);
+        showMatch();
+    };
+
+    $.get('/console/history/search', values, gotResults, 'json');
+};
+
 var moveHistory = function(delta) {
     // totally bogus value
     if (delta == 0 || hist.buffer.length == 0)
         return;
 
+    if (hist.position == 0 && delta < 0 && hist.start > 0) {
+        // Fetch older statements from the stored history, then move on to them.
+        fetchHistory(function() { moveHistory(delta); });
+        return;
+    }
+
     var input = $('#console_statement');
 
     if (hist.position == -1) {
@@ -339,6 +663,32 @@ var setTeamwork = function(event) {
         pastebin.css('display', 'none');
     };
 
+    /* Sharing the session */
+    var shareSession = function(shared) {
+        var sharing = $('#sharing');
+        if(shared) {
+            var url = location.protocol + '//' + location.host + '/console/?session=' + $('#setting_session').val();
+            sharing.html('Anybody allowed to use this console can join this session at <a href="' + url + '">' + url + '</a>');
+            sharing.css('display', 'block');
+        }
+        else {
+            sharing.html('');
+            sharing.css('display', 'none');
+        }
+
+        if(shared == ($('#setting_shared').val() == '1'))
+            return;
+        var values = {
+            'session': $('#setting_session').val(),
+            'shared' : shared ? '1' : '0'
+        };
+        $.post('/console/share', values, function(response) {
+            $('#setting_shared').val(response.shared ? '1' : '0');
+        }, 'json');
+    };
+
+    shareSession(choice == 'Sharing');
+
     if(choice == 'Chatting') {
         hidePastebin();
         showTalkinator();
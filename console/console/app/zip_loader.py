@@ -1,8 +1,7 @@
+from __future__ import absolute_import
 
 import os
 import re
-import logging
-import zipfile
 from django.conf import settings
 from django.template import TemplateDoesNotExist
 try:
@@ -11,27 +10,30 @@ try:
 except ImportError:
     class BaseLoader(object): pass
 
+from util import open_zipfile
+
 
 class Loader(BaseLoader):
     is_usable = True
     zfname_re = re.compile("^(/.*/[^/]+.zip)(?:/(.*))?")
-    
+
     #~ def get_template_sources(self, template_name, template_dirs=None):
         #~ pass
-    
-    def load_template_source(self, template_name, template_dirs=None):
-        """Template loader that loads templates from a ZIP file."""
-        
+
+    def find_template(self, template_name, template_dirs=None):
+        """Return (zip path, member, zip mtime, ZipFile) of a template, or raise
+        TemplateDoesNotExist."""
+
         if template_dirs is None:
             template_dirs = getattr(settings, "TEMPLATE_DIRS", tuple())
-        
+
         # template_dirs is given by google as the dirname of the requested
         # template_path.  If the dir has a zipfile in a component of its
         # path, then we need to read it from the zipfile.
         zfname_re = self.zfname_re
         tried = []
         for dir in template_dirs:
-            
+
             # Does the dir indicate that it has a zipfile component?
             m = zfname_re.match(dir)
             if m:
@@ -39,20 +41,24 @@ class Loader(BaseLoader):
                 template_dir = m.group(2)
                 template_path = os.path.join(template_dir, template_name)
                 try:
-                    z = zipfile.ZipFile(zfname)
-                    source = z.read(template_path)
-                except (IOError, KeyError):
+                    mtime, z = open_zipfile(zfname)
+                    z.getinfo(template_path)
+                except (IOError, OSError, KeyError):
                     tried.append(dir)
                     continue
 
-                # We found a template, so return the source.
-                template_path = "%s:%s" % (zfname, template_path)
-                return (source, template_path)
-        else:
-            errmsg = "Failed to find %s in %s"%(template_name, tried)
-        
+                return (zfname, template_path, mtime, z)
+
         # If we reach here, the template couldn't be loaded
-        raise TemplateDoesNotExist(errmsg)
+        raise TemplateDoesNotExist("Failed to find %s in %s" % (template_name, tried))
+
+    def load_template_source(self, template_name, template_dirs=None):
+        """Template loader that loads templates from a ZIP file."""
+        zfname, template_path, mtime, z = self.find_template(template_name, template_dirs)
+        source = z.read(template_path)
+
+        # We found a template, so return the source.
+        return (source, "%s:%s" % (zfname, template_path))
 
 _loader = Loader()
 
@@ -29,6 +29,10 @@ require_login_during_development = False
 # exceptions, types, modules, etc.
 python_doc_linking = True
 
+# Set this to False to keep syntax-highlighted output only in each instance's
+# memory, rather than also sharing it between instances through memcache.
+highlight_memcache = True
+
 # The location of the newer (Sphinx) Python documentation.  If you have a local
 # copy, you can set this to use your own version instead.
 python_doc = 'http://docs.python.org'
@@ -38,5 +42,38 @@ python_doc = 'http://docs.python.org'
 # otherwise, currently supported version are (0, 96), (1, 0), and (1, 1).
 django_version = (1, 1)
 
+# Each instance keeps the live interpreter state of this many recently used
+# console sessions in memory, so that consecutive statements in a session don't
+# have to reload it.  Set this to 0 to disable it.
+warm_sessions = 20
+
+# The most memory, in bytes of pickled session data, which the warm sessions of
+# one instance may take.
+warm_session_bytes = 16 * 1024 * 1024
+
+# Console sessions unused for this many days are deleted by the cron job which
+# requests /console/sweep (see cron.yaml).  Set this to None to keep them forever.
+session_max_idle_days = 30
+
+# The most output, in characters, kept from one statement.  A statement which
+# outputs more than that is aborted.
+max_output_size = 1024 * 1024
+
+# A statement running for longer than this many seconds is aborted, keeping
+# what it did so far, so that it ends well before App Engine would kill the
+# whole request.  Set this to None to let statements run as long as they can.
+statement_deadline = 20
+
+# A statement growing the memory use by more than this many bytes is aborted.
+# (Memory use can't be measured on App Engine itself, only under the SDK.)
+# Set this to None to disable it.
+statement_max_memory = 128 * 1024 * 1024
+
+# Set this to True to log how long each module took to import when the console
+# started (also shown to admins on the dashboard).  Used to find what slows down
+# new instances.
+profile_imports = False
+
 # Allow debug logging of console. Used for development of console.
 debug = False
+
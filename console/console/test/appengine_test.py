@@ -27,6 +27,7 @@ import test_environment
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import datastore_file_stub
 from google.appengine.api import mail_stub
+from google.appengine.api.memcache import memcache_stub
 from google.appengine.api import urlfetch_stub
 from google.appengine.api import user_service_stub
 #from google3.apphosting.api import urlfetch_stub
@@ -67,4 +68,7 @@ class AppEngineTest(unittest.TestCase):
         # Use a fresh mail stub.
         apiproxy_stub_map.apiproxy.RegisterStub('mail', mail_stub.MailServiceStub()) 
 
+        # Use a fresh memcache stub.
+        apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+
 initialSetup()
@@ -19,12 +19,19 @@
 # along with App Engine Console; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import os
 import sys
+import urllib
+import subprocess
+import datetime
 import unittest
+import StringIO
 import test_environment
 
-from appengine_test import AppEngineTest
+from appengine_test import AppEngineTest, LOGGED_IN_USER
 from console.app import model
+from django.utils import simplejson
+from model import session
 
 class AppEngineConsoleTestCase(AppEngineTest):
     def setUp(self):
@@ -88,9 +95,657 @@ class AppEngineConsoleTestCase(AppEngineTest):
         self.engine.runsource('print a.y')
         self.assertOutput('12')
 
+    def testDeletedGlobalsAreForgotten(self):
+        self.engine.runsource('foo = 23')
+        self.engine.runsource('del foo')
+        self.engine.runsource('foo')
+        self.assert_('NameError' in self.engine.err)
+
+    def testOnlyReferencedGlobalsAreUnpickled(self):
+        self.engine.runsource('foo = [1, 2]')
+        self.engine.runsource('bar = {"a": 1}')
+        model.console.warmSessions.clear()
+
+        unpickled = []
+        get_global = self.engine.get_global
+        def counting_get_global(name):
+            unpickled.append(name)
+            return get_global(name)
+        self.engine.get_global = counting_get_global
+
+        self.engine.runsource('foo.append(3)')
+        self.assertEqual(unpickled, ['foo'])
+        self.engine.runsource('foo')
+        self.assertOutput('[1, 2, 3]')
+
+    def testFunctionsSeeGlobals(self):
+        self.engine.runsource('data = [1, 2]')
+        self.engine.runsource('def grow(): data.append(len(data) + 1)')
+        self.engine.runsource('')
+        self.engine.runsource('grow()')
+        self.engine.runsource('data')
+        self.assertOutput('[1, 2, 3]')
+
+    def testNamespaceInspectionSeesAllGlobals(self):
+        self.engine.runsource('foo = 23')
+        self.engine.runsource('"foo" in globals()')
+        self.assertOutput('True')
+
+        self.engine.runsource('eval("foo + 1")')
+        self.assertOutput('24')
+
+    def testGlobalsAreStoredAsChildEntities(self):
+        self.engine.runsource('foo = 23')
+        self.engine.runsource('bar = "x" * 10')
+        self.assertEqual(len(session.ShellGlobal.all().ancestor(self.engine).fetch(10)), 2)
+
+        self.engine.runsource('del bar')
+        self.assertEqual(len(session.ShellGlobal.all().ancestor(self.engine).fetch(10)), 1)
+
+        engine = model.AppEngineConsole.get(self.engine.key())
+        engine.runsource('foo')
+        self.assertEqual(engine.out.strip(), '23')
+
+    def testLargeGlobalsAreChunked(self):
+        size = session.GLOBAL_CHUNK_SIZE
+        self.engine.runsource('big = "x" * %d' % (size * 2))
+        self.assertEqual(len(session.ShellGlobal.all().ancestor(self.engine).fetch(10)), 3)
+
+        engine = model.AppEngineConsole.get(self.engine.key())
+        engine.runsource('len(big)')
+        self.assertEqual(engine.out.strip(), str(size * 2))
+
+        engine.runsource('big = ""')
+        self.assertEqual(len(session.ShellGlobal.all().ancestor(self.engine).fetch(10)), 1)
+
+    def testInlineGlobalsAreUpgraded(self):
+        import cPickle
+        from google.appengine.ext import db
+        engine = model.AppEngineConsole(global_names=[db.Text('foo')],
+                                        globals=[db.Blob(cPickle.dumps(23))])
+        engine.put()
+
+        engine = model.AppEngineConsole.get(engine.key())
+        self.assertEqual(engine.globals, [])
+        engine.runsource('foo')
+        self.assertEqual(engine.out.strip(), '23')
+
+    def testSessionsAreLoadedFromCache(self):
+        self.engine.runsource('foo = 23')
+        engine = model.AppEngineConsole.load(self.engine.key())
+        self.assertEqual(engine.version, self.engine.version)
+        engine.runsource('foo')
+        self.assertEqual(engine.out.strip(), '23')
+
+    def testPendingSourceIsOnlyCached(self):
+        self.engine.runsource('foo = 1')
+        stored_version = self.engine.version
+
+        self.engine.runsource('if True:')
+        self.assertEqual(model.AppEngineConsole.get(self.engine.key()).version, stored_version)
+
+        engine = model.AppEngineConsole.load(self.engine.key())
+        self.assertEqual(engine.getPending(), 'if True:\n')
+        engine.runsource('  foo = 2')
+        engine.runsource('')
+        self.assertEqual(model.AppEngineConsole.get(self.engine.key()).version, engine.version)
+
+        engine = model.AppEngineConsole.load(self.engine.key())
+        engine.runsource('foo')
+        self.assertEqual(engine.out.strip(), '2')
+
+    def testFunctionsAreRestoredFromSnapshots(self):
+        self.engine.runsource('def double(x): return x * 2')
+        self.engine.runsource('')
+        self.assertEqual(self.engine.unpicklables, [])
+        self.assertEqual(self.engine.snapshot_names, ['double'])
+
+        self.engine.runsource('double(21)')
+        self.assertOutput('42')
+
+    def testClassesAndModulesAreRestoredFromSnapshots(self):
+        self.engine.runsource('import os.path')
+        self.engine.runsource('from os.path import join as j')
+        self.engine.runsource('class Base(object): greeting = "hi"')
+        self.engine.runsource('')
+        self.engine.runsource('class Derived(Base):')
+        self.engine.runsource(' @staticmethod')
+        self.engine.runsource(' def greet(): return Base.greeting')
+        self.engine.runsource('')
+        self.assertEqual(self.engine.unpicklables, [])
+
+        self.engine.runsource('d = Derived()')
+        self.engine.runsource('isinstance(d, Base), d.greet(), j("a", "b"), os.path.sep')
+        self.assertOutput("(True, 'hi', 'a/b', '/')")
+
+    def testClosuresAreReplayed(self):
+        self.engine.runsource('def adder(n):')
+        self.engine.runsource(' def add(x): return x + n')
+        self.engine.runsource(' return add')
+        self.engine.runsource('')
+        self.engine.runsource('add2 = adder(2)')
+        self.assertEqual(self.engine.unpicklables, ['add2 = adder(2)'])
+
+        self.engine.runsource('add2(40)')
+        self.assertOutput('42')
+
+    def testBatchesRunInOrderAndSaveOnce(self):
+        self.engine.runsource('foo = 1')
+        version = self.engine.version
+
+        results = self.engine.runsources(['for i in range(3):', '  foo += i', '', 'foo', '1/0', 'foo'])
+        self.assertEqual([result for result, out, err, exc_type in results],
+                         [True, True, False, False, False, False])
+        self.assertEqual(results[3][1].strip(), '4')
+        self.assert_('ZeroDivisionError' in results[4][2])
+        self.assertEqual(results[5][1].strip(), '4')
+        self.assertEqual(self.engine.version, version + 1)
+
+        engine = model.AppEngineConsole.load(self.engine.key())
+        engine.runsource('foo')
+        self.assertEqual(engine.out.strip(), '4')
+
+    def testOutputIsStreamed(self):
+        from model import output
+        self.engine.runsources(['for i in range(3): print i', ''], stream='test-stream')
+        self.assertOutput('0\n1\n2')
+
+        out, chunk = output.fetchChunks('test-stream', 0)
+        self.assertEqual(out, '0\n1\n2\n')
+        self.assertEqual(output.fetchChunks('test-stream', chunk), ('', chunk))
+
+    def testOutputIsLimited(self):
+        from console import config
+        self.engine.runsource('print "x" * %d' % (config.max_output_size * 2))
+        self.assert_(len(self.engine.out) < config.max_output_size + 100)
+        self.assert_(self.engine.out.endswith('[Output truncated after %d characters]\n' % config.max_output_size))
+
+    def testStatementsAreProfiled(self):
+        self.engine.runsource('from google.appengine.api import memcache')
+        self.engine.runsource('%prun memcache.get("foo"); memcache.get("bar")')
+        self.assert_(self.engine.out.startswith('Profiled in '))
+        self.assert_('memcache.Get       2' in self.engine.out)
+        self.assert_('2 API calls in' in self.engine.out)
+
+        self.engine.runsource('%prun def timed(): pass')
+        self.engine.runsource('')
+        self.assert_(self.engine.out.startswith('Profiled in '))
+        self.engine.runsource('timed')
+        self.assert_(self.engine.out.startswith('<function timed'))
+
+    def testStatementsAreTimed(self):
+        self.engine.runsource('runs = []')
+        self.engine.runsource('%timeit runs.append(1); print len(runs)')
+        lines = self.engine.out.splitlines()
+        self.assertEqual(lines[0], '1')
+        self.assert_(' runs: best ' in lines[1])
+        self.assertEqual(lines[2], 'No API calls')
+
+        self.engine.runsource('len(runs) > 1')
+        self.assertOutput('True')
+
+    def testRunawayStatementsAreAbortedAndKept(self):
+        from console import config
+        old_deadline = config.statement_deadline
+        config.statement_deadline = 0.1
+        try:
+            self.engine.runsources(['n = 0', 'while True:', '  n += 1', ''])
+        finally:
+            config.statement_deadline = old_deadline
+        self.assert_('StatementAborted: Statement ran for more than 0.1 seconds' in self.engine.err)
+        self.assertEqual(self.engine.getPending(), '')
+
+        engine = model.AppEngineConsole.load(self.engine.key())
+        engine.runsource('n > 0')
+        self.assertEqual(engine.out.strip(), 'True')
+
+    def testAbortedStatementsAreNotReplayed(self):
+        from console import config
+        self.engine.runsources(['def adder(n):', ' def add(x): return x + n', ' return add', ''])
+        old_deadline = config.statement_deadline
+        config.statement_deadline = 0.1
+        try:
+            self.engine.runsources(['if True:', '  add1 = adder(1)', '  while True: pass', ''])
+        finally:
+            config.statement_deadline = old_deadline
+        self.assert_('Dropping add1' in self.engine.out)
+        self.assertEqual(self.engine.unpicklables, [])
+
+        model.console.warmSessions.clear()
+        self.engine.runsource('add1')
+        self.assert_('NameError' in self.engine.err)
+
+    def testRunawayFunctionsAreAborted(self):
+        from console import config
+        self.engine.runsources(['def spin():', '  while True: pass', ''])
+        old_deadline = config.statement_deadline
+        config.statement_deadline = 0.1
+        try:
+            self.engine.runsource('spin()')
+        finally:
+            config.statement_deadline = old_deadline
+        self.assert_('at line 2 of spin' in self.engine.err, self.engine.err)
+
+    def testOnlyLoopingCodeIsTraced(self):
+        from model import guard
+        def code(source):
+            return compile(source, guard.CONSOLE_FILENAME, 'exec')
+        self.assertEqual(guard.loops(code('x = 1\nif x: y = 2\nelse: y = 3\n')), False)
+        self.assertEqual(guard.loops(code('while x: pass\n')), True)
+        self.assertEqual(guard.loops(code('for i in x: pass\n')), True)
+        self.assertEqual(guard.loops(code('y = [i for i in x]\n')), True)
+        self.assertEqual(guard.loops(code('y = a and b or c\n')), False)
+
+    def testEndlessOutputIsAborted(self):
+        from console import config
+        old_size = config.max_output_size
+        config.max_output_size = 100
+        try:
+            self.engine.runsources(['while True:', '  print "x"', ''])
+        finally:
+            config.max_output_size = old_size
+        self.assert_(self.engine.out.endswith('[Output truncated after 100 characters]\n'))
+        self.assert_('StatementAborted: Statement output more than 100 characters' in self.engine.err)
+
+class WarmSessionTestCase(AppEngineTest):
+    """Tests of keeping the live namespaces of sessions between statements."""
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        self.engine = model.AppEngineConsole()
+        model.console.warmSessions.clear()
+
+    def assertOutput(self, str, msg=''):
+        self.assertEqual(self.engine.out.strip(), str, msg)
+
+    def testWarmSessionsAreReused(self):
+        self.engine.runsource('foo = [1]')
+        self.engine.runsource('def f(): return foo')
+        self.engine.runsource('')
+
+        engine = model.AppEngineConsole.load(self.engine.key())
+        engine.get_global = None        # Nothing may be unpickled.
+        engine.runsource('f().append(2)')
+        engine.runsource('f()')
+        self.assertEqual(engine.out.strip(), '[1, 2]')
+
+        model.console.warmSessions.clear()
+        engine = model.AppEngineConsole.load(self.engine.key())
+        engine.runsource('f()')
+        self.assertEqual(engine.out.strip(), '[1, 2]')
+
+    def testFailedStatementsAreNotKeptWarm(self):
+        self.engine.runsource('foo = [1]')
+        self.engine.runsource('foo.append(2); 1/0')
+        self.assert_('ZeroDivisionError' in self.engine.err)
+        self.engine.runsource('foo')
+        self.assertOutput('[1]')
+
+    def testStaleWarmSessionsAreNotUsed(self):
+        self.engine.runsource('foo = 1')
+        key = str(self.engine.key())
+        stale = model.console.warmSessions.pop(key)
+
+        # Another instance runs a statement.
+        other = model.AppEngineConsole.load(key)
+        other.runsource('foo = 2')
+        model.console.warmSessions.put(key, stale)
+
+        engine = model.AppEngineConsole.load(key)
+        engine.runsource('foo')
+        self.assertEqual(engine.out.strip(), '2')
+
+    def concurrentSessions(self):
+        """Return two copies of the session, as two concurrent requests load it."""
+        key = self.engine.key()
+        return model.AppEngineConsole.load(key), model.AppEngineConsole.load(key)
+
+    def testLeastRecentlyUsedSessionsAreEvicted(self):
+        import util
+        cache = util.LRUCache(3, 10)
+        for key in 'abc':
+            cache.put(key, key, 2)
+        cache.get('a')
+        cache.put('d', 'd')
+        self.assertEqual(sorted(cache.items), ['a', 'c', 'd'])
+        self.assertTrue(cache.put('e', 'e', 9))
+        self.assertEqual(sorted(cache.items), ['d', 'e'])
+        self.assertEqual((cache.weight, cache.stats()['evictions']), (10, 3))
+        self.assertFalse(cache.put('f', 'f', 11))
+
+    def testDisjointConcurrentChangesAreMerged(self):
+        self.engine.runsource('foo = 1')
+        self.engine.runsource('bar = 1')
+        first, second = self.concurrentSessions()
+
+        first.runsource('foo = 2')
+        first.runsource('def f(): return foo')
+        first.runsource('')
+        second.runsource('bar = 2')
+        self.assertEqual(second.err, '')
+        self.assertEqual(second.revision, first.revision + 1)
+
+        engine = model.AppEngineConsole.load(self.engine.key())
+        engine.runsource('f(), bar')
+        self.assertEqual(engine.out.strip(), '(2, 2)')
+
+    def testRebasesReplayEachEditOnce(self):
+        self.engine.runsource('foo = 1')
+        first, second = self.concurrentSessions()
+        first.runsource('foo = 2')
+
+        second.set_global('bar', 2)
+        second.set_global('baz', 3)
+        second.remove_global('bar')
+        second.add_unpicklable('import os', ['os'])
+        edits = list(second.edits)
+        self.assertEqual([method for method, args, names in edits],
+                         ['set_global', 'set_global', 'remove_global', 'add_unpicklable'])
+        second.rebase()
+        self.assertEqual(second.edits, edits)
+        second.rebase()
+        self.assertEqual(second.edits, edits)
+        second.put()
+
+        engine = model.AppEngineConsole.load(self.engine.key())
+        engine.runsource('foo, baz, "bar" in globals(), os.sep')
+        self.assertEqual(engine.out.strip(), "(2, 3, False, '/')")
+
+    def testClashingConcurrentChangesAreRejected(self):
+        self.engine.runsource('foo = 1')
+        self.engine.runsource('bar = 1')
+        first, second = self.concurrentSessions()
+
+        first.runsource('foo = 2')
+        self.assertEqual(second.runsource('foo = 3'), False)
+        self.assert_('SessionConflict: Another statement changed foo meanwhile' in second.err)
+
+        # A statement which only used a changed global clashes too.
+        first, second = self.concurrentSessions()
+        first.runsource('foo = 4')
+        second.runsource('bar = foo + 1')
+        self.assert_('SessionConflict' in second.err)
+
+        engine = model.AppEngineConsole.load(self.engine.key())
+        engine.runsource('foo, bar')
+        self.assertEqual(engine.out.strip(), '(4, 1)')
+
+    def testChangesOlderThanTheLogClash(self):
+        self.engine.runsource('foo = 1')
+        first, second = self.concurrentSessions()
+        for i in range(model.console.CHANGE_LOG_REVISIONS + 1):
+            first.runsource('bar = %d' % i)
+        second.runsource('baz = 1')
+        self.assert_('SessionConflict: Other statements changed' in second.err)
+
+    def testSessionsAreOnlySharedWhenAsked(self):
+        self.engine.owner = 'user:owner@example.com'
+        self.engine.put()
+        self.failIf(self.engine.mayUse('user:other@example.com'))
+        self.assert_(self.engine.mayUse('user:owner@example.com'))
+
+        first, second = self.concurrentSessions()
+        first.runsource('foo = 1')
+        second.share(True)
+        second.put()
+        engine = model.AppEngineConsole.load(self.engine.key())
+        self.assert_(engine.mayUse('user:other@example.com'))
+
+class SweepTestCase(AppEngineTest):
+    """Tests of deleting idle sessions."""
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        self.max_idle = datetime.timedelta(days=30)
+
+    def idleSession(self, days):
+        engine = model.AppEngineConsole()
+        engine.runsource('foo = "x" * 100')
+        engine.last_used = datetime.datetime.now() - datetime.timedelta(days=days)
+        engine.put()
+        return engine.key()
+
+    def testIdleSessionsAreDeleted(self):
+        idle = self.idleSession(31)
+        active = self.idleSession(1)
+
+        result = model.AppEngineConsole.sweep(self.max_idle)
+        self.assertEqual(result['deleted'], 1)
+        self.assert_(result['bytes'] > 100)
+        self.assert_(result['finished'])
+
+        self.assertEqual(model.AppEngineConsole.load(idle), None)
+        self.assertEqual(session.ShellGlobal.all().ancestor(idle).count(), 0)
+
+        engine = model.AppEngineConsole.load(active)
+        engine.runsource('len(foo)')
+        self.assertEqual(engine.out.strip(), '100')
+
+    def testSweepingIsBatched(self):
+        for i in range(5):
+            self.idleSession(31 + i)
+
+        result = model.AppEngineConsole.sweep(self.max_idle, batch_size=2)
+        self.assertEqual(result['deleted'], 5)
+        self.assertEqual(model.AppEngineConsole.all().count(), 0)
+
+        result = model.AppEngineConsole.sweep(self.max_idle, time_limit=0)
+        self.assertEqual(result['deleted'], 0)
+        self.failIf(result['finished'])
+
+    def testUnusedSessionsAreStamped(self):
+        engine = model.AppEngineConsole()
+        engine.put()
+        self.assert_(engine.last_used is not None)
+
+        engine.last_used = None
+        engine.put()
+        result = model.AppEngineConsole.sweep(self.max_idle)
+        self.assertEqual(result['stamped'], 1)
+        self.assertEqual(result['deleted'], 0)
+        self.assert_(model.AppEngineConsole.get(engine.key()).last_used is not None)
+
+class CompletionTestCase(AppEngineTest):
+    """Tests of completing names in a session."""
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        # Completion is used from the application's own modules.
+        from console.app.model import complete
+        self.complete = complete
+        self.engine = model.AppEngineConsole()
+        self.engine.runsource('import os')
+        self.engine.runsource('food = {"a": 1}')
+        self.engine.runsource('class Fool(object): fooling = 1')
+        self.engine.runsource('')
+        self.key = str(self.engine.key())
+
+    def testSymbolIndex(self):
+        index = self.complete.SymbolIndex(['b', 'ab', 'abc', '_a', 'a', 'ac'])
+        self.assertEqual(index.complete('ab'), ['ab', 'abc'])
+        self.assertEqual(index.complete('a', limit=2), ['a', 'ab'])
+        self.assertEqual(index.complete(''), ['a', 'ab', 'abc', 'ac', 'b'])
+        self.assertEqual(index.complete('_'), ['_a'])
+        self.assertEqual(index.complete('z'), [])
+
+    def testGlobalsAndBuiltinsAreCompleted(self):
+        self.assertEqual(self.complete.complete(self.key, 'x = foo', None), (4, ['food']))
+        self.assertEqual(self.complete.complete(self.key, 'Foo', None), (0, ['Fool']))
+        self.assertEqual(self.complete.complete(self.key, 'print len(ord', None), (10, ['ord']))
+
+    def testAttributesAreCompleted(self):
+        self.assertEqual(self.complete.complete(self.key, 'os.pathse', None), (3, ['pathsep']))
+        self.assertEqual(self.complete.complete(self.key, 'os.path.jo', None), (8, ['join']))
+        self.assertEqual(self.complete.complete(self.key, 'food.has_', None), (5, ['has_key']))
+        self.assertEqual(self.complete.complete(self.key, 'Fool.fo', None), (5, ['fooling']))
+        self.assertEqual(self.complete.complete(self.key, 'missing.x', None), (8, []))
+
+    def testCompletionDoesNotLoadTheSession(self):
+        self.complete.complete(self.key, 'foo', None)
+        AppEngineConsole = model.AppEngineConsole
+        load = AppEngineConsole.load
+        def failing_load(session_key):
+            self.fail('The session was loaded')
+        AppEngineConsole.load = staticmethod(failing_load)
+        try:
+            self.assertEqual(self.complete.complete(self.key, 'Foo', None), (0, ['Fool']))
+            self.engine.runsource('Football = 1')
+            self.assertEqual(self.complete.complete(self.key, 'Foo', None), (0, ['Fool', 'Football']))
+        finally:
+            AppEngineConsole.load = load
+
+    def testUncachedSessionsAreLoadedOnce(self):
+        from google.appengine.api import memcache
+        memcache.flush_all()
+        model.console.warmSessions.clear()
+        AppEngineConsole = model.AppEngineConsole
+        load = AppEngineConsole.load
+        loads = []
+        def counting_load(session_key):
+            loads.append(session_key)
+            return load(session_key)
+        AppEngineConsole.load = staticmethod(counting_load)
+        try:
+            self.assertEqual(self.complete.complete(self.key, 'Foo', None), (0, ['Fool']))
+            # The stored global is not live here, but the module stands in for it.
+            self.assertEqual(self.complete.complete(self.key, 'os.pathse', None), (3, ['pathsep']))
+            self.assertEqual(self.complete.complete(self.key, 'food.has_', None), (5, []))
+        finally:
+            AppEngineConsole.load = load
+        self.assertEqual(len(loads), 1)
+
+    def testOnlyUsersOfTheSessionComplete(self):
+        engine = model.AppEngineConsole(owner='user:a@example.com')
+        engine.runsource('food = 1')
+        key = str(engine.put())
+        self.assertEqual(self.complete.complete(key, 'foo', 'user:a@example.com'), (0, ['food']))
+        self.assertRaises(self.complete.NotShared, self.complete.complete, key, 'foo', 'user:b@example.com')
+        engine.share(True)
+        engine.put()
+        self.assertEqual(self.complete.complete(key, 'foo', 'user:b@example.com'), (0, ['food']))
+
+    def testCompletionRunsNoSessionCode(self):
+        self.engine.runsource('class Trap(object):\n'
+                              '    trapped = []\n'
+                              '    def __dir__(self):\n'
+                              '        Trap.trapped.append("__dir__")\n'
+                              '        return []\n'
+                              '    def __getattr__(self, name):\n'
+                              '        Trap.trapped.append(name)\n'
+                              '        raise AttributeError(name)\n')
+        self.engine.runsource('trap = Trap()')
+        self.engine.runsource('trap.caught = 1')
+        # Pickling the session asks for some attributes, but completion mustn't.
+        trapped = model.console.warmSessions.get(self.key)[1].__dict__['Trap'].trapped
+        del trapped[:]
+        self.assertEqual(self.complete.complete(self.key, 'trap.ca', None), (5, ['caught']))
+        self.assertEqual(self.complete.complete(self.key, 'trap.__di', None), (5, ['__dict__', '__dir__']))
+        self.assertEqual(self.complete.complete(self.key, 'trap.x.', None), (7, []))
+        self.assertEqual(trapped, [])
+
+    def testModelsImportOnTheirOwn(self):
+        for name in ('model', 'controller'):
+            status = subprocess.call([sys.executable, '-c', 'import test_environment; import %s' % name],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+            self.assertEqual(status, 0, 'import %s failed' % name)
+
+class ControllerTestCase(AppEngineTest):
+    """Runs requests through the application's handlers."""
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        from console.app import console
+        self.application = console.application
+        self.environ = dict(os.environ)
+        engine = model.AppEngineConsole(owner='user:%s' % LOGGED_IN_USER)
+        self.key = str(engine.put())
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def request(self, method, path, params={}):
+        """Return the status and the body of the response to a request by an admin."""
+        body = urllib.urlencode(params, True)
+        query = ''
+        if method == 'GET':
+            body, query = '', body
+        # The stubs read the request from the environment, like CGI.
+        os.environ.update({'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query,
+                           'SERVER_NAME': 'localhost', 'SERVER_PORT': '8080', 'USER_IS_ADMIN': '1',
+                           'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                           'CONTENT_LENGTH': str(len(body))})
+        environ = dict(os.environ)
+        environ.update({'wsgi.url_scheme': 'http', 'wsgi.input': StringIO.StringIO(body)})
+
+        status = []
+        out = StringIO.StringIO()
+        def start_response(s, headers, exc_info=None):
+            status.append(s)
+            return out.write
+        for chunk in self.application(environ, start_response):
+            out.write(chunk)
+        return status[0], out.getvalue()
+
+    def testStatementsAreRun(self):
+        self.assertEqual(self.request('POST', '/console/statement', {'session': self.key, 'code': 'x = 6 * 7', 'highlight': '0'}),
+                         ('200 OK', '{"out": "", "result": false, "in": "x = 6 * 7"}'))
+        status, body = self.request('POST', '/console/statements', {'session': self.key, 'code': ['y = x', 'print y'], 'highlight': '0'})
+        self.assertEqual(status, '200 OK')
+        self.assert_('"out": "42\\n"' in body, body)
+
+    def testPagesAreServed(self):
+        status, body = self.request('GET', '/console/banner')
+        self.assertEqual(status, '200 OK')
+        self.assert_(body.startswith('{"banner": "Python '), body)
+
+        self.request('POST', '/console/statement', {'session': self.key, 'code': 'x = 1'})
+        self.assertEqual(self.request('GET', '/console/history'),
+                         ('200 OK', '{"start": 0, "statements": ["x = 1"]}'))
+        self.assertEqual(self.request('GET', '/console/complete', {'session': self.key, 'text': 'print x'}),
+                         ('200 OK', '{"start": 6, "completions": ["x", "xrange"]}'))
+
+    def testNonAsciiOutputIsHighlighted(self):
+        code = 'print "\\xc3\\xa9"'
+        status, body = self.request('POST', '/console/statement', {'session': self.key, 'code': code})
+        self.assertEqual(status, '200 OK')
+        self.assert_('stdout' in simplejson.loads(body)['out'], body)
+
+    def testNonAsciiOutputIsTokenized(self):
+        code = 'print "\\xc3\\xa9"'
+        status, body = self.request('POST', '/console/statement', {'session': self.key, 'code': code, 'highlight': 'tokens'})
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(len(''.join([text for id, text in simplejson.loads(body)['out']])), 3, body)
+
+    def testTokenClassesMatchPygments(self):
+        from pygments.token import Token
+        from console.app.controller import console
+        classes = console.htmlFormatter('').ttype2class
+        types = [Token] + sorted([t for t in classes if t is not Token])
+        self.assertEqual(console.TOKEN_CLASSES, [classes[t] for t in types])
+
+    def testOtherUsersSessionsAreRefused(self):
+        key = str(model.AppEngineConsole(owner='user:other@example.com').put())
+        status, body = self.request('POST', '/console/statement', {'session': key, 'code': 'x = 1', 'highlight': '0'})
+        self.assert_('NotSharedError' in body, body)
+        status, body = self.request('GET', '/console/complete', {'session': key, 'text': 'x'})
+        self.assertEqual(status, '403 Forbidden')
+        self.assert_('no longer shared' in body, body)
+
+class ColdAppEngineConsoleTestCase(AppEngineConsoleTestCase):
+    """Runs all of the console tests without keeping sessions warm."""
+    def setUp(self):
+        AppEngineConsoleTestCase.setUp(self)
+        self.max_items = model.console.warmSessions.max_items
+        model.console.warmSessions.max_items = 0
+
+    def tearDown(self):
+        model.console.warmSessions.max_items = self.max_items
+
 def suite():
     s = unittest.TestSuite()
     s.addTest( unittest.makeSuite(AppEngineConsoleTestCase, 'test') )
+    s.addTest( unittest.makeSuite(WarmSessionTestCase, 'test') )
+    s.addTest( unittest.makeSuite(SweepTestCase, 'test') )
+    s.addTest( unittest.makeSuite(CompletionTestCase, 'test') )
+    s.addTest( unittest.makeSuite(ControllerTestCase, 'test') )
+    s.addTest( unittest.makeSuite(ColdAppEngineConsoleTestCase, 'test') )
     return s
 
 if __name__ == "__main__":
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+#
+# datastore_stub.py - Unit tests for the SDK's datastore file stub
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import random
+import shutil
+import datetime
+import tempfile
+import unittest
+import test_environment
+
+from appengine_test import AppEngineTest
+from google.appengine.api import users
+from google.appengine.api import datastore
+from google.appengine.api import datastore_admin
+from google.appengine.api import datastore_types
+from google.appengine.api import datastore_file_stub
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import db
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import datastore_index
+
+# Property values of every type, some of them equal across types.  IM values are
+# left out: they compare with other strings by their addresses in memory.
+VALUES = [
+    None, True, False, 0, 1, -5, 7L, 2 ** 40, 1.0, 1.5, -0.25,
+    'abc', 'b', u'abc', u'\xe9t\xe9', u'',
+    datastore_types.Category(u'abc'), datastore_types.Email(u'a@example.com'),
+    datastore_types.Link(u'http://example.com/'), datastore_types.PhoneNumber(u'555-1234'),
+    datastore_types.PostalAddress(u'1 Main St'), datastore_types.Rating(50),
+    datastore_types.GeoPt(1.5, -2.0), datastore_types.GeoPt(1.5, 3.0),
+    users.User('a@example.com'), users.User('b@example.com'),
+    datastore_types.Key.from_path('Kind', 1, _app=u'test_app'),
+    datastore_types.Key.from_path('Kind', 'name', _app=u'test_app'),
+    datetime.datetime(2009, 10, 1, 12, 30), datetime.datetime(1970, 1, 1),
+]
+
+OPERATORS = {
+    datastore_pb.Query_Filter.LESS_THAN:             '<',
+    datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:    '<=',
+    datastore_pb.Query_Filter.GREATER_THAN:          '>',
+    datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
+    datastore_pb.Query_Filter.EQUAL:                 '==',
+}
+
+QUERY_OPERATORS = dict([(op.replace('==', '='), code) for code, op in OPERATORS.items()])
+
+def evalFilter(stub, filt, entity):
+    """The stub's original filter evaluation, which compares values by evaluating
+    their reprs, as the reference for the compiled filters."""
+    prop = filt.property(0).name().decode('utf-8')
+    op = OPERATORS[filt.op()]
+    filter_val_list = [datastore_types.FromPropertyPb(filter_prop)
+                       for filter_prop in filt.property_list()]
+
+    if not stub._HasPropIndexed(entity, prop):
+        return False
+    try:
+        entity_vals = datastore._GetPropertyValue(entity, prop)
+    except KeyError:
+        entity_vals = []
+    if not isinstance(entity_vals, list):
+        entity_vals = [entity_vals]
+
+    for fixed_entity_val in entity_vals:
+        for filter_val in filter_val_list:
+            fixed_entity_type = stub._PROPERTY_TYPE_TAGS.get(fixed_entity_val.__class__)
+            filter_type = stub._PROPERTY_TYPE_TAGS.get(filter_val.__class__)
+            if fixed_entity_type == filter_type:
+                comp = u'%r %s %r' % (fixed_entity_val, op, filter_val)
+            elif op != '==':
+                comp = '%r %s %r' % (fixed_entity_type, op, filter_type)
+            else:
+                continue
+            try:
+                ret = eval(comp, vars(datastore_file_stub))
+                if ret and ret != NotImplementedError:
+                    return True
+            except TypeError:
+                pass
+    return False
+
+def compareEntities(stub, orders, a, b):
+    """The stub's original comparison of entities by a query's orderings, as the
+    reference for the sort keys."""
+    def compare_properties(x, y):
+        if isinstance(x, datetime.datetime):
+            x = datastore_types.DatetimeToTimestamp(x)
+        if isinstance(y, datetime.datetime):
+            y = datastore_types.DatetimeToTimestamp(y)
+        x_type = stub._PROPERTY_TYPE_TAGS.get(x.__class__)
+        y_type = stub._PROPERTY_TYPE_TAGS.get(y.__class__)
+        if x_type == y_type:
+            try:
+                return cmp(x, y)
+            except TypeError:
+                return 0
+        return cmp(x_type, y_type)
+
+    for o in orders:
+        prop = o.property().decode('utf-8')
+        reverse = (o.direction() == datastore_pb.Query_Order.DESCENDING)
+        a_val = datastore._GetPropertyValue(a, prop)
+        if isinstance(a_val, list):
+            a_val = sorted(a_val, compare_properties, reverse=reverse)[0]
+        b_val = datastore._GetPropertyValue(b, prop)
+        if isinstance(b_val, list):
+            b_val = sorted(b_val, compare_properties, reverse=reverse)[0]
+        cmped = compare_properties(a_val, b_val)
+        if reverse:
+            cmped = -cmped
+        if cmped != 0:
+            return cmped
+    return cmp(a.key(), b.key())
+
+def makeFilter(prop, op, values):
+    filt = datastore_pb.Query_Filter()
+    filt.set_op(op)
+    for value in values:
+        filt.add_property().CopyFrom(datastore_types.ToPropertyPb(prop, value))
+    return filt
+
+class FilterTestCase(AppEngineTest):
+    """Tests that the compiled query filters agree with the original ones."""
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        self.stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+
+        self.entities = []
+        for value in VALUES:
+            entity = datastore.Entity('Kind')
+            entity['prop'] = value
+            self.entities.append(entity)
+        for i in range(0, len(VALUES) - 2, 3):
+            entity = datastore.Entity('Kind')
+            entity['prop'] = VALUES[i:i + 3]
+            self.entities.append(entity)
+
+        entity = datastore.Entity('Kind', unindexed_properties=['prop'])
+        entity['prop'] = 1
+        self.entities.append(entity)
+        entity = datastore.Entity('Kind')
+        entity['prop'] = datastore_types.Text(u'abc')
+        self.entities.append(entity)
+        self.entities.append(datastore.Entity('Kind'))
+        datastore.Put(self.entities)
+
+    def filters(self):
+        for op in OPERATORS:
+            for value in VALUES:
+                yield makeFilter('prop', op, [value])
+            yield makeFilter('prop', op, [1, u'abc'])
+
+    def testFiltersAgreeWithEval(self):
+        for filt in self.filters():
+            passes = self.stub._CompileFilter(filt)
+            for entity in self.entities:
+                self.assertEqual(passes(entity), evalFilter(self.stub, filt, entity),
+                                 '%s %r on %r' % (OPERATORS[filt.op()], filt.property_list(), entity))
+
+    def testQueriesAgreeWithEval(self):
+        for op, value in [('=', 1), ('<', u'b'), ('>=', 1.0), ('>', None), ('<=', users.User('a@example.com')),
+                          ('>', datetime.datetime(2000, 1, 1)), ('=', datastore_types.Category(u'abc'))]:
+            query = datastore.Query('Kind', {'prop %s' % op: value})
+            found = set([entity.key() for entity in query.Get(1000)])
+
+            filt = makeFilter('prop', QUERY_OPERATORS[op], [value])
+            expected = set([entity.key() for entity in self.entities if evalFilter(self.stub, filt, entity)])
+            self.assertEqual(found, expected, 'prop %s %r' % (op, value))
+
+class IndexTestCase(AppEngineTest):
+    """Tests that queries narrowed down by the stub's indexes find what full scans do."""
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        self.stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        self.random = random.Random(42)
+        datastore.Put([self.makeItem() for i in range(120)])
+
+    def makeItem(self, **values):
+        r = self.random
+        item = datastore.Entity('Item')
+        item['n'] = r.randrange(20)
+        item['name'] = u'item %03d' % r.randrange(1000)
+        item['tags'] = r.sample([u'red', u'green', u'blue', u'big', u'small'], r.randrange(1, 4))
+        item['when'] = datetime.datetime(2009, 1, 1) + datetime.timedelta(hours=r.randrange(1000))
+        item['mixed'] = r.choice([None, 3, 7L, 2.5, u'text', True, datastore_types.Category(u'cat'),
+                                  datetime.datetime(2009, 6, 1), users.User('a@example.com')])
+        item.update(values)
+        return item
+
+    def queries(self):
+        return [
+            {'n =': 3},
+            {'n >': 15},
+            {'n >=': 5, 'n <': 8},
+            {'n >': 5, 'n >=': 5, 'n <=': 8, 'n <': 100},
+            {'tags =': u'red', 'n =': 2},
+            {'tags =': u'red', 'tags >': u'big'},
+            {'name >=': u'item 5', 'name <': u'item 6'},
+            {'when <': datetime.datetime(2009, 1, 10)},
+            {'mixed =': 3},
+            {'mixed =': None},
+            {'mixed >': 3},
+            {'mixed <': u'text'},
+            {'mixed >=': datetime.datetime(2009, 1, 1)},
+            {'n =': 100},
+        ]
+
+    def query(self, filters, orders=()):
+        query = datastore.Query('Item', filters, keys_only=True)
+        query.Order(*orders)
+        return query.Get(1000)
+
+    def scan(self, filters, orders=()):
+        self.stub._PlanQuery = lambda app_kind, filters, orders: None
+        try:
+            return self.query(filters, orders)
+        finally:
+            del self.stub._PlanQuery
+
+    def assertQueriesAgree(self):
+        for filters in self.queries():
+            # The first ordering must be by the inequality filter's property.
+            inequalities = [f.split()[0] for f in filters if f.split()[1] != '=']
+            if inequalities:
+                prop = inequalities[0]
+                orderings = [(), (prop,), ((prop, datastore.Query.DESCENDING), 'name')]
+            else:
+                orderings = [(), ('name',), (('when', datastore.Query.DESCENDING), 'n')]
+            for orders in orderings:
+                self.assertEqual(self.query(filters, orders), self.scan(filters, orders),
+                                 '%r ordered by %r' % (filters, orders))
+        self.assertEqual(self.query({}, ['mixed']), self.scan({}, ['mixed']))
+
+    def testQueriesAgreeWithScans(self):
+        self.assertQueriesAgree()
+
+    def testIndexesNarrowQueries(self):
+        plan = self.stub._PlanQuery((u'test_app', 'Item'), datastore.Query('Item', {'n =': 3})._ToPb().filter_list(), [])
+        self.assertEqual(len(plan), len(self.query({'n =': 3})))
+
+        plan = self.stub._PlanQuery((u'test_app', 'Item'), datastore.Query('Item', {'n >=': 18})._ToPb().filter_list(), [])
+        self.assertEqual(len(plan), len(self.query({'n >=': 18})))
+
+    def testIndexesFollowWrites(self):
+        self.assertQueriesAgree()
+
+        items = datastore.Query('Item').Get(1000)
+        for item in items[:50]:
+            item['n'] = self.random.randrange(20)
+            item['tags'] = [u'red']
+        datastore.Put(items[:50])
+        datastore.Delete(items[50:100])
+        datastore.Put([self.makeItem(n=3) for i in range(20)])
+        self.assertQueriesAgree()
+
+    def testRolledBackWritesAreForgotten(self):
+        self.assertQueriesAgree()
+        parent = datastore.Query('Item').Get(1)[0]
+
+        def txn():
+            datastore.Put(self.makeItem(n=3, parent=parent.key()))
+            raise ZeroDivisionError()
+        self.assertRaises(ZeroDivisionError, datastore.RunInTransaction, txn)
+        self.assertQueriesAgree()
+
+    def testCompositeIndexesNarrowQueries(self):
+        index = datastore_index.Index(kind='Item', properties=[datastore_index.Property(name='n'),
+                                                               datastore_index.Property(name='name')])
+        datastore_admin.CreateIndex(datastore_admin.IndexDefinitionToProto(u'test_app', index))
+
+        filters = {'n =': 3, 'name >=': u'item 5'}
+        plan = self.stub._PlanQuery((u'test_app', 'Item'), datastore.Query('Item', filters)._ToPb().filter_list(), [])
+        self.assertEqual(len(plan), len(self.query(filters)))
+        self.assertQueriesAgree()
+
+class OrderTestCase(AppEngineTest):
+    """Tests that query results are sorted as the original comparison sorted them,
+    and that limits, offsets and batches cut the same results out of them."""
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        self.stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+
+        self.entities = []
+        for i, value in enumerate(VALUES * 2):
+            entity = datastore.Entity('Kind')
+            entity['prop'] = value
+            entity['n'] = i % 3
+            self.entities.append(entity)
+        for i in range(0, len(VALUES) - 2, 3):
+            entity = datastore.Entity('Kind', name='list%d' % i)
+            entity['prop'] = VALUES[i:i + 3]
+            entity['n'] = [i % 3, 5]
+            self.entities.append(entity)
+        datastore.Put(self.entities)
+
+    def orderings(self):
+        return [(), ('prop',), (('prop', datastore.Query.DESCENDING),), ('n', 'prop'),
+                (('n', datastore.Query.DESCENDING), ('prop', datastore.Query.DESCENDING)),
+                ('__key__',), (('__key__', datastore.Query.DESCENDING),)]
+
+    def query(self, orders):
+        query = datastore.Query('Kind')
+        query.Order(*orders)
+        return query
+
+    def testResultsAgreeWithComparison(self):
+        for orders in self.orderings():
+            query = self.query(orders)
+            order_pbs = query._ToPb().order_list()
+            expected = sorted(self.entities, lambda a, b: compareEntities(self.stub, order_pbs, a, b))
+            self.assertEqual([e.key() for e in query.Get(1000)], [e.key() for e in expected],
+                             'ordered by %r' % (orders,))
+
+    def testLimitsAndOffsetsCutSortedResults(self):
+        for orders in self.orderings():
+            keys = [e.key() for e in self.query(orders).Get(1000)]
+            for limit, offset in [(1, 0), (10, 0), (10, 25), (len(keys), 0), (5, len(keys) - 2), (5, len(keys))]:
+                found = [e.key() for e in self.query(orders).Get(limit, offset)]
+                self.assertEqual(found, keys[offset:offset + limit], 'ordered by %r' % (orders,))
+            self.assertEqual(self.query(orders).Count(), len(keys))
+            self.assertEqual(self.query(orders).Count(7), 7)
+
+    def testBatchesFollowEachOther(self):
+        keys = [e.key() for e in self.query(['prop']).Get(1000)]
+        self.assertEqual([e.key() for e in self.query(['prop']).Run()], keys)
+
+class Numbered(db.Model):
+    n = db.IntegerProperty()
+
+class CursorTestCase(AppEngineTest):
+    """Tests that cursors resume limited queries past their limit."""
+    def testCursorsPageThroughResults(self):
+        db.put([Numbered(n=n) for n in random.sample(range(25), 25)])
+        pages = []
+        cursor = None
+        for page in range(4):
+            query = Numbered.all().order('n')
+            if cursor is not None:
+                query.with_cursor(cursor)
+            pages.append([m.n for m in query.fetch(10)])
+            cursor = query.cursor()
+            if cursor is None:
+                break
+        self.assertEqual(pages, [range(10), range(10, 20), range(20, 25)])
+
+class JournalTestCase(AppEngineTest):
+    """Tests that the file stub journals its writes and recovers them."""
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'datastore')
+        self.journal = datastore_file_stub.JournalFilename(self.path)
+        self.restart()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def restart(self, **options):
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        self.stub = datastore_file_stub.DatastoreFileStub(u'test_app', self.path, **options)
+        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', self.stub)
+
+    def stored(self):
+        return dict([(e.key(), e['n']) for e in datastore.Query('Item').Get(1000)])
+
+    def put(self, n, **options):
+        entity = datastore.Entity('Item', **options)
+        entity['n'] = n
+        datastore.Put(entity)
+        return entity
+
+    def testWritesAreJournaled(self):
+        items = [self.put(i) for i in range(10)]
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(os.path.getsize(self.journal) > 0)
+
+        datastore.Delete([items[3].key(), items[5].key()])
+        items[7]['n'] = 70
+        datastore.Put(items[7])
+        expected = self.stored()
+        self.assertEqual(len(expected), 8)
+
+        self.restart()
+        self.assertEqual(self.stored(), expected)
+        self.assertTrue(self.put(10).key().id() > max([key.id() for key in expected]))
+
+    def testIncompleteWritesAreDropped(self):
+        first = self.put(1)
+        size = os.path.getsize(self.journal)
+        self.put(2)
+        journal = open(self.journal, 'r+b')
+        journal.truncate(os.path.getsize(self.journal) - 3)
+        journal.close()
+
+        self.restart()
+        self.assertEqual(self.stored(), {first.key(): 1})
+        self.assertEqual(os.path.getsize(self.journal), size)
+
+        third = self.put(3)
+        self.restart()
+        self.assertEqual(self.stored(), {first.key(): 1, third.key(): 3})
+
+    def testCorruptWritesAreDropped(self):
+        first = self.put(1)
+        self.put(2)
+        journal = open(self.journal, 'r+b')
+        journal.seek(-1, 2)
+        last = journal.read(1)
+        journal.seek(-1, 2)
+        journal.write(chr(ord(last) ^ 1))
+        journal.close()
+
+        self.restart()
+        self.assertEqual(self.stored(), {first.key(): 1})
+
+    def testJournalIsCompacted(self):
+        compact_min_bytes = datastore_file_stub._COMPACT_MIN_BYTES
+        datastore_file_stub._COMPACT_MIN_BYTES = 1000
+        try:
+            items = [self.put(i) for i in range(100)]
+        finally:
+            datastore_file_stub._COMPACT_MIN_BYTES = compact_min_bytes
+        self.assertTrue(os.path.exists(self.path))
+        self.assertTrue(os.path.getsize(self.journal) < os.path.getsize(self.path))
+        expected = self.stored()
+
+        self.restart()
+        self.assertEqual(self.stored(), expected)
+
+        datastore.Delete([item.key() for item in items])
+        self.stub.Write()
+        self.assertFalse(os.path.exists(self.journal))
+        self.restart()
+        self.assertEqual(self.stored(), {})
+
+    def testTransactionsAreJournaledOnCommit(self):
+        parent = self.put(0)
+
+        def txn(n):
+            size = os.path.getsize(self.journal)
+            self.put(n, parent=parent.key())
+            self.assertEqual(os.path.getsize(self.journal), size)
+            if n < 0:
+                raise ZeroDivisionError()
+        datastore.RunInTransaction(txn, 1)
+        self.assertRaises(ZeroDivisionError, datastore.RunInTransaction, txn, -1)
+        expected = self.stored()
+        self.assertEqual(sorted(expected.values()), [0, 1])
+
+        self.restart()
+        self.assertEqual(self.stored(), expected)
+
+    def testSyncPolicies(self):
+        syncs = []
+        fsync = os.fsync
+        os.fsync = syncs.append
+        try:
+            for policy, count in [(datastore_file_stub.SYNC_ALWAYS, 5), (datastore_file_stub.SYNC_PERIODIC, 1),
+                                  (datastore_file_stub.SYNC_NEVER, 0)]:
+                self.restart(journal_sync=policy)
+                del syncs[:]
+                for i in range(5):
+                    self.put(i)
+                self.assertEqual(len(syncs), count, policy)
+        finally:
+            os.fsync = fsync
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTest( unittest.makeSuite(FilterTestCase, 'test') )
+    s.addTest( unittest.makeSuite(IndexTestCase, 'test') )
+    s.addTest( unittest.makeSuite(OrderTestCase, 'test') )
+    s.addTest( unittest.makeSuite(CursorTestCase, 'test') )
+    s.addTest( unittest.makeSuite(JournalTestCase, 'test') )
+    return s
+
+if __name__ == "__main__":
+    unittest.main()
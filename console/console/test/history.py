@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# history.py - Unit tests for the statement history
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import unittest
+import test_environment
+
+from appengine_test import AppEngineTest
+from console.app import model
+from model import history
+
+OWNER = 'user:test@example.com'
+
+class HistoryTestCase(AppEngineTest):
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        history.chunkCache.clear()
+
+    def fill(self, count, batch=7):
+        statements = ['x%d = %d' % (i, i) for i in range(count)]
+        for start in range(0, count, batch):
+            history.append(OWNER, statements[start:start + batch])
+        return statements
+
+    def testStatementsAreChunked(self):
+        statements = self.fill(history.CHUNK_SIZE * 2 + 5)
+        history.flush(OWNER)
+        head = history.HistoryHead.get_by_key_name(OWNER)
+        self.assertEqual(head.count, len(statements))
+        self.assertEqual(head.recent, statements[-5:])
+        self.assertEqual(history.HistoryChunk.all().ancestor(head).count(), 2)
+
+    def testBlankStatementsAreSkipped(self):
+        self.assertEqual(history.append(OWNER, ['', '  ']), None)
+        history.append(OWNER, ['a', '', 'b'])
+        self.assertEqual(history.page(OWNER), (0, ['a', 'b']))
+
+    def testAppendsAreFlushedInBatches(self):
+        for i in range(history.FLUSH_BATCH - 1):
+            history.append(OWNER, ['x%d' % i])
+        self.assertEqual(history.HistoryHead.get_by_key_name(OWNER), None)
+        history.append(OWNER, ['last'])
+        head = history.HistoryHead.get_by_key_name(OWNER)
+        self.assertEqual((head.count, head.flushed), (history.FLUSH_BATCH, history.FLUSH_BATCH))
+
+        # Reading the history flushes what is waiting.
+        history.append(OWNER, ['waiting'])
+        self.assertEqual(history.search(OWNER, 'waiting'), [(history.FLUSH_BATCH, 'waiting')])
+
+        # Appends count on from the head if memcache loses their count.
+        from google.appengine.api import memcache
+        memcache.flush_all()
+        self.assertEqual(history.append(OWNER, ['evicted']), history.FLUSH_BATCH + 2)
+        self.assertEqual(history.page(OWNER, count=2), (history.FLUSH_BATCH, ['waiting', 'evicted']))
+
+    def testAppendsWaitingAreKeptIfTheirCountIsLost(self):
+        from google.appengine.api import memcache
+        for i in range(history.FLUSH_BATCH + 3):
+            history.append(OWNER, ['x%d' % i])
+        memcache.delete(history.pendingKey(OWNER))
+        self.assertEqual(history.append(OWNER, ['after']), history.FLUSH_BATCH + 4)
+        self.assertEqual(history.page(OWNER, count=4)[1], ['x%d' % i for i in range(history.FLUSH_BATCH, history.FLUSH_BATCH + 3)] + ['after'])
+
+    def testAppendsAreStoredWithoutMemcache(self):
+        from google.appengine.api import memcache
+        incr = memcache.incr
+        memcache.incr = lambda *args, **kwargs: None
+        try:
+            self.assertEqual(history.append(OWNER, ['a', 'b']), None)
+            history.append(OWNER, ['c'])
+        finally:
+            memcache.incr = incr
+        head = history.HistoryHead.get_by_key_name(OWNER)
+        self.assertEqual((head.count, head.recent), (3, ['a', 'b', 'c']))
+
+    def testPaging(self):
+        statements = self.fill(history.CHUNK_SIZE * 2 + 5)
+        self.assertEqual(history.page(OWNER, count=10), (len(statements) - 10, statements[-10:]))
+
+        start, page = history.page(OWNER, before=150, count=80)
+        self.assertEqual((start, page), (70, statements[70:150]))
+
+        start, page = history.page(OWNER, before=3)
+        self.assertEqual((start, page), (0, statements[:3]))
+        self.assertEqual(history.page('user:nobody@example.com'), (0, []))
+
+    def testSearch(self):
+        statements = self.fill(history.CHUNK_SIZE * 3)
+        history.append(OWNER, ['Greeting.all().fetch(10)'])
+
+        self.assertEqual(history.search(OWNER, 'greeting'), [(300, 'Greeting.all().fetch(10)')])
+        self.assertEqual(history.search(OWNER, 'x15 = '), [(15, 'x15 = 15')])
+        self.assertEqual([n for n, s in history.search(OWNER, 'x15')], [159, 158, 157, 156, 155, 154, 153,
+                                                                        152, 151, 150, 15])
+        self.assertEqual([n for n, s in history.search(OWNER, 'x15', before=151)], [150, 15])
+        self.assertEqual([n for n, s in history.search(OWNER, 'x15', count=2)], [159, 158])
+        self.assertEqual([n for n, s in history.search(OWNER, 'x1', before=100, prefix=True)], range(19, 9, -1) + [1])
+        self.assertEqual(history.search(OWNER, 'nothing'), [])
+
+    def testSearchReadsOnlyMatchingChunks(self):
+        self.fill(history.CHUNK_SIZE * 3)
+        history.search(OWNER, 'x250 =')
+        self.assertEqual(sorted([key[1] for key in history.chunkCache.items]), [2])
+
+    def testSearchReadsTheLatestChunks(self):
+        self.fill(history.CHUNK_SIZE * 5, batch=50)
+        max_chunks = history.SEARCH_MAX_CHUNKS
+        history.SEARCH_MAX_CHUNKS = 2
+        try:
+            self.assertEqual([n for n, s in history.search(OWNER, '99 = ')], [499, 399])
+            self.assertEqual([n for n, s in history.search(OWNER, '99 = ', before=400)], [399, 299])
+        finally:
+            history.SEARCH_MAX_CHUNKS = max_chunks
+
+    def testUnindexedChunksAreSearched(self):
+        max_terms = history.MAX_CHUNK_TERMS
+        history.MAX_CHUNK_TERMS = 10
+        try:
+            self.fill(history.CHUNK_SIZE)
+        finally:
+            history.MAX_CHUNK_TERMS = max_terms
+        self.assertEqual(history.search(OWNER, 'x42 ='), [(42, 'x42 = 42')])
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTest( unittest.makeSuite(HistoryTestCase, 'test') )
+    return s
+
+if __name__ == "__main__":
+    unittest.main()
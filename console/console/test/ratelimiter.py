@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# ratelimiter.py - Unit tests for the ratelimit module
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import time
+import unittest
+import test_environment
+
+from appengine_test import AppEngineTest
+import ratelimit
+
+class RateLimiterTestCase(AppEngineTest):
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        self.limiter = ratelimit.RateLimiter('test', 10, window=60)
+        self.time = time.time
+        self.now = 6000.0
+        time.time = lambda: self.now
+
+    def tearDown(self):
+        time.time = self.time
+
+    def testLimit(self):
+        for i in range(10):
+            self.assert_(self.limiter.attempt())
+        self.failIf(self.limiter.attempt())
+
+    def testCost(self):
+        self.assert_(self.limiter.attempt(8))
+        self.failIf(self.limiter.attempt(3))
+
+    def testSubjectsAreSeparate(self):
+        self.assert_(self.limiter.attempt(10, subject='a'))
+        self.failIf(self.limiter.attempt(1, subject='a'))
+        self.assert_(self.limiter.attempt(1, subject='b'))
+
+    def testWindowSlides(self):
+        self.assert_(self.limiter.attempt(10))
+
+        # Halfway through the next window, half of the last one still counts.
+        self.now += 90
+        self.assert_(self.limiter.attempt(5))
+        self.failIf(self.limiter.attempt(1))
+
+        # And once a whole window has passed since, none of it does.
+        self.now += 120
+        self.assert_(self.limiter.attempt(10))
+
+    def testPolicy(self):
+        limiter = ratelimit.RateLimiter('test-users', 1, policy=ratelimit.BY_USER)
+        self.assertEqual(limiter.subject(), 'user:%s' % os.environ['USER_EMAIL'])
+        self.assertEqual(self.limiter.subject(), 'ip:%s' % os.environ['REMOTE_ADDR'])
+
+    def testStats(self):
+        self.limiter.attempt(10)
+        self.limiter.attempt(1)
+        stats = self.limiter.stats()
+        self.assertEqual((stats['allowed'], stats['denied']), (1, 1))
+        self.assertEqual((stats['total_allowed'], stats['total_denied']), (1, 1))
+        self.assert_(ratelimit.limiters['test'] is self.limiter)
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTest( unittest.makeSuite(RateLimiterTestCase, 'test') )
+    return s
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+#
+# sqlite_stub.py - Unit tests for the SDK's SQLite datastore stub
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+import test_environment
+
+from appengine_test import AppEngineTest, APP_ID
+from google.appengine.api import users
+from google.appengine.api import datastore
+from google.appengine.api import datastore_types
+from google.appengine.api import datastore_sqlite_stub
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import db
+
+# Property values of every type, some of them equal across types.  Dates are
+# left out, since the file stub never finds them by integers, nor integers by
+# them, as the datastore (and the SQLite stub) does.
+VALUES = [
+    None, True, False, 0, 1, -5, 7L, 2 ** 40, 1.0, 1.5, -0.25, -0.0,
+    'abc', 'b', u'abc', u'\xe9t\xe9', u'',
+    datastore_types.Category(u'abc'), datastore_types.Email(u'a@example.com'),
+    datastore_types.Link(u'http://example.com/'), datastore_types.Rating(50),
+    datastore_types.GeoPt(1.5, -2.0), datastore_types.GeoPt(1.5, 3.0),
+    users.User('a@example.com'), users.User('b@example.com'),
+    datastore_types.Key.from_path('Kind', 1, _app=APP_ID),
+    datastore_types.Key.from_path('Kind', 'name', _app=APP_ID),
+    datastore_types.Key.from_path('Kind', 'name', 'Child', 2, _app=APP_ID),
+]
+
+class Numbered(db.Model):
+    n = db.IntegerProperty()
+
+class SqliteTestCase(AppEngineTest):
+    """Tests that the SQLite stub finds what the file stub does."""
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        self.file_proxy = apiproxy_stub_map.apiproxy
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'datastore.sqlite')
+        self.open()
+
+    def tearDown(self):
+        self.stub.Close()
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        self.sqlite_proxy = apiproxy_stub_map.APIProxyStubMap()
+        self.stub = datastore_sqlite_stub.DatastoreSqliteStub(APP_ID, self.path)
+        self.sqlite_proxy.RegisterStub('datastore_v3', self.stub)
+        apiproxy_stub_map.apiproxy = self.sqlite_proxy
+
+    def reopen(self):
+        self.stub.Close()
+        self.open()
+
+    def both(self, function, *args):
+        """Return what a function returns with the file stub, and with the SQLite
+        stub."""
+        results = []
+        try:
+            for proxy in (self.file_proxy, self.sqlite_proxy):
+                apiproxy_stub_map.apiproxy = proxy
+                results.append(function(*args))
+        finally:
+            apiproxy_stub_map.apiproxy = self.sqlite_proxy
+        return results
+
+    def assertBothAgree(self, function, *args):
+        file_result, sqlite_result = self.both(function, *args)
+        self.assertEqual(file_result, sqlite_result, '%s%r' % (function.__name__, args))
+        return sqlite_result
+
+    def putValues(self):
+        entities = []
+        for i, value in enumerate(VALUES):
+            entity = datastore.Entity('Kind', name='value%02d' % i)
+            entity['prop'] = value
+            entity['n'] = i % 4
+            entities.append(entity)
+        for i in range(0, len(VALUES) - 2, 3):
+            entity = datastore.Entity('Kind', name='list%02d' % i)
+            entity['prop'] = VALUES[i:i + 3]
+            entity['n'] = [i % 4, 7]
+            entities.append(entity)
+        entity = datastore.Entity('Kind', name='unindexed', unindexed_properties=['prop'])
+        entity['prop'] = 1
+        entities.append(entity)
+        entity = datastore.Entity('Kind', name='text')
+        entity['prop'] = datastore_types.Text(u'abc')
+        entities.append(entity)
+        entity = datastore.Entity('Kind', name='none')
+        entity['when'] = datetime.datetime(2009, 10, 1)
+        entities.append(entity)
+        self.both(datastore.Put, entities)
+        return entities
+
+    def keys(self, filters, orders=(), limit=1000, offset=0):
+        query = datastore.Query('Kind', filters, keys_only=True)
+        query.Order(*orders)
+        return query.Get(limit, offset)
+
+    def testQueriesAgreeWithFileStub(self):
+        self.putValues()
+        for op in ['=', '<', '<=', '>', '>=']:
+            for value in VALUES:
+                filters = {'prop %s' % op: value}
+                self.assertBothAgree(self.keys, filters)
+                self.assertBothAgree(self.keys, filters, ['prop'])
+                self.assertBothAgree(self.keys, filters, [('prop', datastore.Query.DESCENDING), 'n'])
+        self.assertBothAgree(self.keys, {'n =': 1}, ['prop'])
+        self.assertBothAgree(self.keys, {'n =': 7, 'prop >': 0}, ['prop'])
+        self.assertBothAgree(self.keys, {}, [('n', datastore.Query.DESCENDING), 'prop'])
+        self.assertBothAgree(self.keys, {'__key__ >': datastore_types.Key.from_path('Kind', 'list05', _app=APP_ID)})
+        self.assertBothAgree(self.keys, {}, [('__key__', datastore.Query.DESCENDING)])
+        self.assertBothAgree(self.keys, {'when <': datetime.datetime(2010, 1, 1)})
+
+    def testLimitsOffsetsAndBatches(self):
+        self.putValues()
+        orders = [('prop', datastore.Query.DESCENDING)]
+        for limit, offset in [(1, 0), (10, 5), (1000, 20), (5, 1000)]:
+            self.assertBothAgree(self.keys, {}, orders, limit, offset)
+
+        def count(limit=None):
+            return datastore.Query('Kind', {'n =': 1}).Count(limit)
+        self.assertEqual(self.assertBothAgree(count), 9)
+        self.assertBothAgree(count, 3)
+
+        def run():
+            query = datastore.Query('Kind', keys_only=True)
+            query.Order('prop')
+            return list(query.Run())
+        self.assertEqual(len(self.assertBothAgree(run)), len(VALUES) + 9)
+
+    def testOpenCursorsSeeWrites(self):
+        self.putValues()
+        query = datastore.Query('Kind')
+        query.Order('n')
+        results = query.Run()
+        first = results.next()
+        entity = datastore.Entity('Kind', name='later')
+        entity['n'] = 999
+        datastore.Put(entity)
+        self.assertEqual(datastore.Get(entity.key()), entity)
+        self.assertEqual(datastore.Query('Kind', {'n =': 999}).Count(), 1)
+        self.assertEqual(len([first] + list(results)), len(VALUES) + 10)
+
+    def testCursorsPageThroughResults(self):
+        def pages():
+            db.put([Numbered(n=n) for n in range(25)])
+            pages = []
+            cursor = None
+            for page in range(4):
+                query = Numbered.all().order('n')
+                if cursor is not None:
+                    query.with_cursor(cursor)
+                pages.append([m.n for m in query.fetch(10)])
+                cursor = query.cursor()
+                if cursor is None:
+                    break
+            return pages
+        self.assertEqual(self.assertBothAgree(pages), [range(10), range(10, 20), range(20, 25)])
+
+    def testAncestorsAndTransactions(self):
+        parent = datastore.Entity('Parent', name='parent')
+        self.both(datastore.Put, parent)
+
+        def txn(n):
+            child = datastore.Entity('Child', parent=parent.key(), name='child%d' % n)
+            child['n'] = n
+            datastore.Put(child)
+            if n < 0:
+                raise ZeroDivisionError()
+
+        for n in [1, 2]:
+            self.both(datastore.RunInTransaction, txn, n)
+        apiproxy_stub_map.apiproxy = self.file_proxy
+        self.assertRaises(ZeroDivisionError, datastore.RunInTransaction, txn, -1)
+        apiproxy_stub_map.apiproxy = self.sqlite_proxy
+        self.assertRaises(ZeroDivisionError, datastore.RunInTransaction, txn, -1)
+
+        def children():
+            return [e.key() for e in datastore.Query('Child').Ancestor(parent.key()).Get(100)]
+        self.assertEqual(len(self.assertBothAgree(children)), 2)
+
+        def family():
+            return [e.key() for e in datastore.Query().Ancestor(parent.key()).Get(100)]
+        self.assertEqual(len(self.assertBothAgree(family)), 3)
+
+    def testEntitiesPersist(self):
+        entities = self.putValues()
+        entity = datastore.Entity('Numbered')
+        datastore.Put(entity)
+
+        self.reopen()
+        self.assertEqual(datastore.Get(entities[0].key()), entities[0])
+        self.assertEqual(len(self.keys({})), len(entities))
+        later = datastore.Entity('Numbered')
+        datastore.Put(later)
+        self.assertTrue(later.key().id() > entity.key().id())
+
+        self.stub.Clear()
+        self.assertEqual(self.keys({}), [])
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTest( unittest.makeSuite(SqliteTestCase, 'test') )
+    return s
+
+if __name__ == "__main__":
+    unittest.main()
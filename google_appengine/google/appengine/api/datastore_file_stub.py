@@ -17,12 +17,17 @@
 
 """
 In-memory persistent stub for the Python datastore API. Gets, queries,
-and searches are implemented as in-memory scans over all entities.
-
-Stores entities across sessions as pickled proto bufs in a single file. On
-startup, all entities are read from the file and loaded into memory. On
-every Put(), the file is wiped and all entities are written from scratch.
-Clients can also manually Read() and Write() the file themselves.
+and searches are implemented in memory.  Queries use sorted indexes of the
+entities by their properties, built as they are needed, to narrow down the
+entities they scan.
+
+Stores entities across sessions as pickled proto bufs in a single file, and
+the writes made since it was written in a journal next to it, which each
+Put() and Delete() appends to. On startup, all entities are read from the
+file and loaded into memory, and the journal's writes are replayed over them.
+Once the journal grows as large as the file, the file is written from scratch
+and the journal emptied. Clients can also manually Read() and Write() the
+files themselves.
 
 Transactions are serialized through __tx_lock. Each transaction acquires it
 when it begins and releases it when it commits or rolls back. This is
@@ -35,15 +40,20 @@ per-transaction, so they should only be used by one tx at a time.
 
 
 
+import bisect
 import datetime
+import heapq
 import logging
 import md5
+import operator
 import os
 import struct
 import sys
 import tempfile
 import threading
+import time
 import warnings
+import zlib
 
 import cPickle as pickle
 
@@ -77,6 +87,90 @@ _MAX_QUERY_COMPONENTS = 100
 
 _BATCH_SIZE = 20
 
+
+SYNC_ALWAYS = 'always'
+SYNC_PERIODIC = 'periodic'
+SYNC_NEVER = 'never'
+
+_SYNC_INTERVAL = 1.0
+
+
+_JOURNAL_SUFFIX = '.journal'
+
+_JOURNAL_HEADER = '>II'
+_JOURNAL_ENTRY = '>cI'
+
+_JOURNAL_PUT = 'P'
+_JOURNAL_DELETE = 'D'
+
+
+_COMPACT_MIN_BYTES = 1024 * 1024
+
+
+def JournalFilename(datastore_file):
+  """Returns the name of the journal kept next to a datastore file."""
+  return datastore_file + _JOURNAL_SUFFIX
+
+
+def _EncodeJournalRecord(entries):
+  """Encodes writes into one journal record.
+
+  A record is its payload's length and CRC-32, followed by the payload: each
+  write's operation, length and data.  Records are replayed whole or not at
+  all, so the writes of one call or transaction are never partly recovered.
+
+  Args:
+    entries: list of (_JOURNAL_PUT, encoded entity_pb.EntityProto) or
+      (_JOURNAL_DELETE, encoded entity_pb.Reference)
+
+  Returns:
+    string
+  """
+  payload = ''.join([struct.pack(_JOURNAL_ENTRY, op, len(data)) + data
+                     for op, data in entries])
+  return struct.pack(_JOURNAL_HEADER, len(payload),
+                     zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def _DecodeJournal(data):
+  """Decodes the records of a journal, up to the first incomplete or corrupt
+  one, which a crash may have left at its end.
+
+  Args:
+    data: string, the contents of a journal
+
+  Returns:
+    (entries, length): the list of (operation, data) of the intact records,
+    in order, and the length of the journal they take up.
+  """
+  entries = []
+  header_size = struct.calcsize(_JOURNAL_HEADER)
+  entry_size = struct.calcsize(_JOURNAL_ENTRY)
+  offset = 0
+  while offset + header_size <= len(data):
+    length, crc = struct.unpack(_JOURNAL_HEADER,
+                                data[offset:offset + header_size])
+    start = offset + header_size
+    payload = data[start:start + length]
+    if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+      break
+
+    record = []
+    position = 0
+    while position + entry_size <= length:
+      op, size = struct.unpack(_JOURNAL_ENTRY,
+                               payload[position:position + entry_size])
+      position += entry_size
+      record.append((op, payload[position:position + size]))
+      position += size
+    if position != length:
+      break
+
+    entries.extend(record)
+    offset = start + length
+  return entries, offset
+
+
 class _StoredEntity(object):
   """Simple wrapper around an entity stored by the stub.
 
@@ -114,19 +208,29 @@ class _Cursor(object):
   _next_cursor = 1
   _next_cursor_lock = threading.Lock()
 
-  def __init__(self, results, keys_only):
+  def __init__(self, results, keys_only, offset=0, total=None, sort_rest=None):
     """Constructor.
 
     Args:
-      # the query results, in order, such that results[self.offset:] is
-      # the next result
-      results: list of entity_pb.EntityProto
+      # the query results, in order, such that results[self._offset:] are
+      # the next results
+      results: list of datastore.Entity
       keys_only: integer
+      # the number of results to skip
+      offset: integer
+      # the number of results, if results holds only the first of them
+      total: integer
+      # returns all of the results in order, once they are read past results
+      sort_rest: callable
     """
+    if total is None:
+      total = len(results)
     self.__results = results
-    self.count = len(results)
+    self.__total = total
+    self.__sort_rest = sort_rest
+    self.count = max(0, total - offset)
     self.keys_only = keys_only
-    self._offset = 0
+    self._offset = offset
 
     self._next_cursor_lock.acquire()
     try:
@@ -153,15 +257,20 @@ class _Cursor(object):
     result.mutable_cursor().set_cursor(self.cursor)
     result.set_keys_only(self.keys_only)
 
-    self.count = len(self.__results[_offset:_offset + count])
+    end = min(_offset + count, self.__total)
+    self.count = max(0, end - _offset)
+    if end > len(self.__results):
+      self.__results = self.__sort_rest()
+      self.__sort_rest = None
 
-    results_pbs = [r._ToPb() for r in self.__results[_offset:_offset + count]]
-    result.result_list().extend(results_pbs)
+    result_list = result.result_list()
+    for i in xrange(_offset, end):
+      result_list.append(self.__results[i]._ToPb())
 
     if offset is None:
       self._offset += self.count
 
-    result.set_more_results(len(self.__results[_offset + self.count:]) > 0)
+    result.set_more_results(_offset + self.count < self.__total)
     if compiled and result.more_results():
       compiled_query = _FakeCompiledQuery(cursor=self.cursor,
                                           offset=_offset + self.count,
@@ -184,6 +293,283 @@ class _FakeCompiledQuery(object):
     compiled_pb.set_offset(self.offset)
     return compiled_pb
 
+class _MaxKey(object):
+  """Compares greater than anything else, to bound ranges of index entries."""
+
+  def __lt__(self, other):
+    return False
+
+  def __le__(self, other):
+    return other is self
+
+  def __gt__(self, other):
+    return other is not self
+
+  def __ge__(self, other):
+    return True
+
+  def __eq__(self, other):
+    return other is self
+
+  def __ne__(self, other):
+    return other is not self
+
+_MAX_KEY = _MaxKey()
+
+
+class _Reversed(object):
+  """Wraps a sort key so that it orders the other way round."""
+
+  __slots__ = ('key',)
+
+  def __init__(self, key):
+    self.key = key
+
+  def __lt__(self, other):
+    return other.key < self.key
+
+  def __le__(self, other):
+    return other.key <= self.key
+
+  def __gt__(self, other):
+    return other.key > self.key
+
+  def __ge__(self, other):
+    return other.key >= self.key
+
+  def __eq__(self, other):
+    return self.key == other.key
+
+  def __ne__(self, other):
+    return self.key != other.key
+
+
+def _IndexValue(value):
+  """Returns the sort key of a property value in an _EntityIndex, or None if it
+  has none.
+
+  Keys are ordered by type tag first, as the datastore orders values of
+  different types, and then by value.  Dates are kept apart from the integers
+  they share their tag with, since the two never compare.  Values which don't
+  compare consistently with the others of their tag get no key.
+  """
+  tag = DatastoreFileStub._PROPERTY_TYPE_TAGS.get(value.__class__)
+  if tag is None or isinstance(value, datastore_types.IM):
+    return None
+  if isinstance(value, datetime.datetime):
+    return (tag, 1, datastore_types.DatetimeToTimestamp(value))
+  if isinstance(value, str):
+    try:
+      value.decode('ascii')
+    except UnicodeDecodeError:
+      return None
+  elif isinstance(value, float) and value != value:
+    return None
+  return (tag, 0, value)
+
+
+class _EntityIndex(object):
+  """A sorted index of the entities of a kind, by the values of one or more
+  properties, for narrowing down the entities a query has to look at.
+
+  The entries are (tuple of _IndexValue keys, encoded entity key) pairs.  An
+  entity has an entry for every combination of its values of the properties,
+  provided it has them all indexed.  Entities with a value which has no sort
+  key are kept apart, as candidates for any range.
+
+  Public properties:
+    properties: tuple of the property names
+    entries: sorted list of the entries
+    unsorted: set of encoded keys of entities with values that have no key
+  """
+
+  def __init__(self, properties):
+    self.properties = properties
+    self.entries = []
+    self.unsorted = set()
+
+  def __Entries(self, encoded_key, entity):
+    """Returns the entries of an entity, or None if it belongs in unsorted."""
+    combinations = [()]
+    for prop in self.properties:
+      if not DatastoreFileStub._HasPropIndexed(entity, prop):
+        return []
+      values = entity[prop]
+      if not isinstance(values, list):
+        values = [values]
+      keys = []
+      for value in values:
+        key = _IndexValue(value)
+        if key is None:
+          return None
+        keys.append(key)
+      combinations = [combination + (key,)
+                      for combination in combinations for key in keys]
+    return [(combination, encoded_key) for combination in combinations]
+
+  def Add(self, encoded_key, entity):
+    entries = self.__Entries(encoded_key, entity)
+    if entries is None:
+      self.unsorted.add(encoded_key)
+    else:
+      for entry in entries:
+        bisect.insort(self.entries, entry)
+
+  def Remove(self, encoded_key, entity):
+    entries = self.__Entries(encoded_key, entity)
+    if entries is None:
+      self.unsorted.discard(encoded_key)
+    else:
+      for entry in entries:
+        i = bisect.bisect_left(self.entries, entry)
+        if i < len(self.entries) and self.entries[i] == entry:
+          del self.entries[i]
+
+  def Range(self, prefix, lower=None, upper=None):
+    """Returns the (start, end) slice of the entries whose keys start with the
+    given prefix, and whose next key is within the bounds.
+
+    Args:
+      prefix: tuple of keys
+      lower: (key, inclusive) or None
+      upper: (key, inclusive) or None
+    """
+    if lower is None:
+      start = (prefix,)
+    elif lower[1]:
+      start = (prefix + (lower[0],),)
+    else:
+      start = (prefix + (lower[0], _MAX_KEY),)
+
+    if upper is None:
+      end = (prefix + (_MAX_KEY,),)
+    elif upper[1]:
+      end = (prefix + (upper[0], _MAX_KEY),)
+    else:
+      end = (prefix + (upper[0],),)
+
+    start = bisect.bisect_left(self.entries, start)
+    return start, max(start, bisect.bisect_left(self.entries, end))
+
+  def Build(self, entities):
+    """Adds many entities at once.
+
+    Args:
+      entities: iterable of (encoded key, datastore.Entity) pairs
+    """
+    for encoded_key, entity in entities:
+      entries = self.__Entries(encoded_key, entity)
+      if entries is None:
+        self.unsorted.add(encoded_key)
+      else:
+        self.entries.extend(entries)
+    self.entries.sort()
+
+  def Keys(self, start, end):
+    """Returns the set of encoded keys of the entries in a range, along with the
+    unsorted ones."""
+    keys = set(self.unsorted)
+    keys.update([encoded_key for values, encoded_key in self.entries[start:end]])
+    return keys
+
+
+def _CheckCompositeIndexes(query, indexes):
+  """Checks that the composite index a query needs, if any, is defined.
+
+  Args:
+    query: datastore_pb.Query
+    indexes: list of entity_pb.CompositeIndex of the query's app, or None
+
+  Raises:
+    apiproxy_errors.ApplicationError: NEED_INDEX, if it isn't.
+  """
+  required, kind, ancestor, props, num_eq_filters = datastore_index.CompositeIndexForQuery(query)
+  if required:
+    required_key = kind, ancestor, props
+    if not indexes:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.NEED_INDEX,
+          "This query requires a composite index, but none are defined. "
+          "You must create an index.yaml file in your application root.")
+    eq_filters_set = set(props[:num_eq_filters])
+    remaining_filters = props[num_eq_filters:]
+    for index in indexes:
+      definition = datastore_admin.ProtoToIndexDefinition(index)
+      index_key = datastore_index.IndexToKey(definition)
+      if required_key == index_key:
+        break
+      if num_eq_filters > 1 and (kind, ancestor) == index_key[:2]:
+        this_props = index_key[2]
+        this_eq_filters_set = set(this_props[:num_eq_filters])
+        this_remaining_filters = this_props[num_eq_filters:]
+        if (eq_filters_set == this_eq_filters_set and
+            remaining_filters == this_remaining_filters):
+          break
+    else:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.NEED_INDEX,
+          "This query requires a composite index that is not defined. "
+          "You must update the index.yaml file in your application root.")
+
+
+def _KindSchema(kind, entities):
+  """Returns the schema of a kind: an EntityProto with a property of each name
+  its entities have, whose value has a placeholder of each type they have.
+
+  Args:
+    kind: string
+    entities: iterable of entity_pb.EntityProto of the kind
+
+  Returns:
+    entity_pb.EntityProto
+  """
+  kind_pb = entity_pb.EntityProto()
+  kind_pb.mutable_key().set_app('')
+  kind_pb.mutable_key().mutable_path().add_element().set_type(kind)
+  kind_pb.mutable_entity_group()
+
+  props = {}
+
+  for entity in entities:
+    for prop in entity.property_list():
+      if prop.name() not in props:
+        props[prop.name()] = entity_pb.PropertyValue()
+      props[prop.name()].MergeFrom(prop.value())
+
+  for value_pb in props.values():
+    if value_pb.has_int64value():
+      value_pb.set_int64value(0)
+    if value_pb.has_booleanvalue():
+      value_pb.set_booleanvalue(False)
+    if value_pb.has_stringvalue():
+      value_pb.set_stringvalue('none')
+    if value_pb.has_doublevalue():
+      value_pb.set_doublevalue(0.0)
+    if value_pb.has_pointvalue():
+      value_pb.mutable_pointvalue().set_x(0.0)
+      value_pb.mutable_pointvalue().set_y(0.0)
+    if value_pb.has_uservalue():
+      value_pb.mutable_uservalue().set_gaiaid(0)
+      value_pb.mutable_uservalue().set_email('none')
+      value_pb.mutable_uservalue().set_auth_domain('none')
+      value_pb.mutable_uservalue().clear_nickname()
+      value_pb.mutable_uservalue().clear_obfuscated_gaiaid()
+    if value_pb.has_referencevalue():
+      value_pb.clear_referencevalue()
+      value_pb.mutable_referencevalue().set_app('none')
+      pathelem = value_pb.mutable_referencevalue().add_pathelement()
+      pathelem.set_type('none')
+      pathelem.set_name('none')
+
+  for name, value_pb in props.items():
+    prop_pb = kind_pb.add_property()
+    prop_pb.set_name(name)
+    prop_pb.set_multiple(False)
+    prop_pb.mutable_value().CopyFrom(value_pb)
+
+  return kind_pb
+
+
 class DatastoreFileStub(apiproxy_stub.APIProxyStub):
   """ Persistent stub for the Python datastore API.
 
@@ -233,7 +619,8 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
                history_file=None,
                require_indexes=False,
                service_name='datastore_v3',
-               trusted=False):
+               trusted=False,
+               journal_sync=SYNC_PERIODIC):
     """Constructor.
 
     Initializes and loads the datastore from the backing files, if they exist.
@@ -248,6 +635,10 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
       service_name: Service name expected for all calls.
       trusted: bool, default False.  If True, this stub allows an app to
         access the data of another app.
+      journal_sync: when writes are synced to disk: SYNC_ALWAYS, after each
+        one; SYNC_PERIODIC, at most every _SYNC_INTERVAL seconds; SYNC_NEVER,
+        whenever the operating system does.  Writes survive the process
+        crashing in any case.
     """
     super(DatastoreFileStub, self).__init__(service_name)
 
@@ -257,8 +648,20 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     self.__datastore_file = datastore_file
     self.SetTrusted(trusted)
 
+    assert journal_sync in (SYNC_ALWAYS, SYNC_PERIODIC, SYNC_NEVER)
+    self.__journal_sync = journal_sync
+    self.__journal = None
+    self.__journal_size = 0
+    self.__journal_synced = 0
+    self.__snapshot_size = 0
+    self.__snapshot_stale = False
+
+    self.__tx_journal = []
+
     self.__entities = {}
 
+    self.__entity_indexes = {}
+
     self.__schema_cache = {}
 
     self.__tx_snapshot = {}
@@ -280,7 +683,7 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     self.__index_id_lock = threading.Lock()
     self.__tx_lock = threading.Lock()
     self.__entities_lock = threading.Lock()
-    self.__file_lock = threading.Lock()
+    self.__file_lock = threading.RLock()
     self.__indexes_lock = threading.Lock()
 
     self.Read()
@@ -289,10 +692,13 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     """ Clears the datastore by deleting all currently stored entities and
     queries. """
     self.__entities = {}
+    self.__entity_indexes = {}
     self.__queries = {}
     self.__transactions = {}
     self.__query_history = {}
     self.__schema_cache = {}
+    self.__tx_journal = []
+    self.__snapshot_stale = True
 
   def SetTrusted(self, trusted):
     """Set/clear the trusted bit in the stub.
@@ -356,16 +762,54 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
 
     Args:
       entity: entity_pb.EntityProto
+
+    Returns:
+      _StoredEntity
     """
     key = entity.key()
     app_kind = self._AppIdNamespaceKindForKey(key)
     if app_kind not in self.__entities:
       self.__entities[app_kind] = {}
-    self.__entities[app_kind][key] = _StoredEntity(entity)
+    old_entity = self.__entities[app_kind].get(key)
+    stored_entity = _StoredEntity(entity)
+    self.__entities[app_kind][key] = stored_entity
+
+    indexes = self.__entity_indexes.get(app_kind)
+    if indexes:
+      encoded_key = key.Encode()
+      for index in indexes.values():
+        if old_entity is not None:
+          index.Remove(encoded_key, old_entity.native)
+        index.Add(encoded_key, stored_entity.native)
 
     if app_kind in self.__schema_cache:
       del self.__schema_cache[app_kind]
 
+    return stored_entity
+
+  def __RemoveEntity(self, key):
+    """ Remove the entity with the given key, if there is one.
+
+    Args:
+      key: entity_pb.Reference
+
+    Returns:
+      the removed _StoredEntity, or None
+    """
+    app_kind = self._AppIdNamespaceKindForKey(key)
+    stored_entity = self.__entities.get(app_kind, {}).pop(key, None)
+    if stored_entity is None:
+      return None
+
+    for index in self.__entity_indexes.get(app_kind, {}).values():
+      index.Remove(key.Encode(), stored_entity.native)
+    if not self.__entities[app_kind]:
+      del self.__entities[app_kind]
+
+    if app_kind in self.__schema_cache:
+      del self.__schema_cache[app_kind]
+    return stored_entity
+
   READ_PB_EXCEPTIONS = (ProtocolBuffer.ProtocolBufferDecodeError, LookupError,
                         TypeError, ValueError)
   READ_ERROR_MSG = ('Data in %s is corrupt or a different version. '
@@ -388,29 +832,88 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     key as an entity already in the datastore, the entity from the file
     overwrites the entity in the datastore.
 
+    The writes in the journal are then replayed over the datastore file's
+    entities.  An incomplete record at the end of the journal, left by a crash
+    while it was written, is dropped.
+
     Also sets __next_id to one greater than the highest id allocated so far.
     """
     if self.__datastore_file and self.__datastore_file != '/dev/null':
-      for encoded_entity in self.__ReadPickled(self.__datastore_file):
+      if (os.path.isfile(self.__datastore_file) or
+          not os.path.isfile(JournalFilename(self.__datastore_file))):
+        for encoded_entity in self.__ReadPickled(self.__datastore_file):
+          self.__RestoreEntity(encoded_entity, self.__datastore_file)
+      if os.path.isfile(self.__datastore_file):
+        self.__snapshot_size = os.path.getsize(self.__datastore_file)
+
+      self.__ReadJournal()
+
+  def __RestoreEntity(self, encoded_entity, filename):
+    """Stores an entity read from a file.
+
+    Args:
+      encoded_entity: encoded entity_pb.EntityProto
+      filename: string, the file it was read from
+    """
+    try:
+      entity = entity_pb.EntityProto(encoded_entity)
+    except self.READ_PB_EXCEPTIONS, e:
+      raise datastore_errors.InternalError(self.READ_ERROR_MSG %
+                                           (filename, e))
+    except struct.error, e:
+      if (sys.version_info[0:3] == (2, 5, 0)
+          and e.message.startswith('unpack requires a string argument')):
+        raise datastore_errors.InternalError(self.READ_PY250_MSG +
+                                             self.READ_ERROR_MSG %
+                                             (filename, e))
+      else:
+        raise
+
+    self._StoreEntity(entity)
+
+    last_path = entity.key().path().element_list()[-1]
+    if last_path.has_id() and last_path.id() >= self.__next_id:
+      self.__next_id = last_path.id() + 1
+
+  def __ReadJournal(self):
+    """Replays the journal's writes, and cuts off its incomplete end if any."""
+    filename = JournalFilename(self.__datastore_file)
+    self.__file_lock.acquire()
+    try:
+      if not os.path.isfile(filename):
+        return
+      journal = open(filename, 'rb')
+      try:
+        data = journal.read()
+      finally:
+        journal.close()
+
+      entries, length = _DecodeJournal(data)
+      if length < len(data):
+        logging.warning('Dropping %d bytes of an incomplete write at the end '
+                        'of %s', len(data) - length, filename)
+        journal = open(filename, 'r+b')
+        try:
+          journal.truncate(length)
+        finally:
+          journal.close()
+      self.__journal_size = length
+    finally:
+      self.__file_lock.release()
+
+    for op, data in entries:
+      if op == _JOURNAL_PUT:
+        self.__RestoreEntity(data, filename)
+      elif op == _JOURNAL_DELETE:
         try:
-          entity = entity_pb.EntityProto(encoded_entity)
+          key = entity_pb.Reference(data)
         except self.READ_PB_EXCEPTIONS, e:
           raise datastore_errors.InternalError(self.READ_ERROR_MSG %
-                                               (self.__datastore_file, e))
-        except struct.error, e:
-          if (sys.version_info[0:3] == (2, 5, 0)
-              and e.message.startswith('unpack requires a string argument')):
-            raise datastore_errors.InternalError(self.READ_PY250_MSG +
-                                                 self.READ_ERROR_MSG %
-                                                 (self.__datastore_file, e))
-          else:
-            raise
-
-        self._StoreEntity(entity)
-
-        last_path = entity.key().path().element_list()[-1]
-        if last_path.has_id() and last_path.id() >= self.__next_id:
-          self.__next_id = last_path.id() + 1
+                                               (filename, e))
+        self.__RemoveEntity(key)
+      else:
+        raise datastore_errors.InternalError(
+            self.READ_ERROR_MSG % (filename, 'unknown journal entry %r' % op))
 
   def Write(self):
     """ Writes out the datastore and history files. Be careful! If the files
@@ -419,16 +922,85 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     self.__WriteDatastore()
 
   def __WriteDatastore(self):
-    """ Writes out the datastore file. Be careful! If the file already exist,
-    this method overwrites it!
+    """ Writes out the datastore file, and empties the journal, whose writes it
+    holds. Be careful! If the file already exist, this method overwrites it!
     """
     if self.__datastore_file and self.__datastore_file != '/dev/null':
-      encoded = []
-      for kind_dict in self.__entities.values():
-        for entity in kind_dict.values():
-          encoded.append(entity.encoded_protobuf)
+      self.__entities_lock.acquire()
+      try:
+        encoded = []
+        for kind_dict in self.__entities.values():
+          for entity in kind_dict.values():
+            encoded.append(entity.encoded_protobuf)
 
-      self.__WritePickled(encoded, self.__datastore_file)
+        self.__file_lock.acquire()
+        try:
+          self.__WritePickled(encoded, self.__datastore_file)
+          if os.path.isfile(self.__datastore_file):
+            self.__snapshot_size = os.path.getsize(self.__datastore_file)
+          self.__snapshot_stale = False
+
+          if self.__journal is not None:
+            self.__journal.close()
+            self.__journal = None
+          try:
+            os.remove(JournalFilename(self.__datastore_file))
+          except OSError:
+            pass
+          self.__journal_size = 0
+        finally:
+          self.__file_lock.release()
+      finally:
+        self.__entities_lock.release()
+
+  def __AppendJournal(self, entries):
+    """Appends writes to the journal, as one record.
+
+    Callers hold __entities_lock, so that writes are journaled in the order
+    they were made.
+
+    Args:
+      entries: list of (_JOURNAL_PUT or _JOURNAL_DELETE, data), as for
+        _EncodeJournalRecord
+    """
+    if (not entries or not self.__datastore_file or
+        self.__datastore_file == '/dev/null'):
+      return
+
+    record = _EncodeJournalRecord(entries)
+    self.__file_lock.acquire()
+    try:
+      if self.__journal is None:
+        self.__journal = open(JournalFilename(self.__datastore_file), 'ab')
+      self.__journal.write(record)
+      self.__journal.flush()
+      self.__journal_size += len(record)
+
+      now = time.time()
+      if (self.__journal_sync == SYNC_ALWAYS or
+          (self.__journal_sync == SYNC_PERIODIC and
+           now - self.__journal_synced >= _SYNC_INTERVAL)):
+        os.fsync(self.__journal.fileno())
+        self.__journal_synced = now
+    finally:
+      self.__file_lock.release()
+
+  def __CompactJournal(self):
+    """Writes out the datastore file once the journal has grown as large as it
+    (or the datastore was cleared), so replaying the journal never takes
+    longer than reading the file.
+
+    Entities written in a transaction are in memory before they are
+    committed, so this waits until no transaction is in progress.
+    """
+    if (not self.__snapshot_stale and
+        self.__journal_size < max(_COMPACT_MIN_BYTES, self.__snapshot_size)):
+      return
+    if self.__tx_lock.acquire(False):
+      try:
+        self.__WriteDatastore()
+      finally:
+        self.__tx_lock.release()
 
   def __ReadPickled(self, filename):
     """Reads a pickled object from the given file and returns it.
@@ -454,7 +1026,8 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
   def __WritePickled(self, obj, filename, openfile=file):
     """Pickles the object and writes it to the given file.
     """
-    if not filename or filename == '/dev/null' or not obj:
+    if (not filename or filename == '/dev/null' or
+        (not obj and not os.path.exists(filename))):
       return
 
     tmpfile = openfile(os.tempnam(os.path.dirname(filename)), 'wb')
@@ -463,6 +1036,9 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     pickler.fast = True
     pickler.dump(obj)
 
+    if self.__journal_sync != SYNC_NEVER:
+      tmpfile.flush()
+      os.fsync(tmpfile.fileno())
     tmpfile.close()
 
     self.__file_lock.acquire()
@@ -539,13 +1115,19 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     self.__entities_lock.acquire()
 
     try:
+      entries = []
       for clone in clones:
-        self._StoreEntity(clone)
+        stored_entity = self._StoreEntity(clone)
+        entries.append((_JOURNAL_PUT, stored_entity.encoded_protobuf))
+
+      if put_request.has_transaction():
+        self.__tx_journal.extend(entries)
+      else:
+        self.__AppendJournal(entries)
     finally:
       self.__entities_lock.release()
 
-    if not put_request.has_transaction():
-      self.__WriteDatastore()
+    self.__CompactJournal()
 
     put_response.key_list().extend([c.key() for c in clones])
 
@@ -573,23 +1155,267 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
   def _Dynamic_Delete(self, delete_request, delete_response):
     self.__entities_lock.acquire()
     try:
+      entries = []
       for key in delete_request.key_list():
         self.__ValidateAppId(key.app())
-        app_kind = self._AppIdNamespaceKindForKey(key)
-        try:
-          del self.__entities[app_kind][key]
-          if not self.__entities[app_kind]:
-            del self.__entities[app_kind]
-
-          del self.__schema_cache[app_kind]
-        except KeyError:
-          pass
+        if self.__RemoveEntity(key) is not None:
+          entries.append((_JOURNAL_DELETE, key.Encode()))
 
-        if not delete_request.has_transaction():
-          self.__WriteDatastore()
+      if delete_request.has_transaction():
+        self.__tx_journal.extend(entries)
+      else:
+        self.__AppendJournal(entries)
     finally:
       self.__entities_lock.release()
 
+    self.__CompactJournal()
+
+
+  _FILTER_OPERATORS = {
+    datastore_pb.Query_Filter.LESS_THAN: operator.lt,
+    datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL: operator.le,
+    datastore_pb.Query_Filter.GREATER_THAN: operator.gt,
+    datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: operator.ge,
+    datastore_pb.Query_Filter.EQUAL: operator.eq,
+    }
+
+  @staticmethod
+  def _HasPropIndexed(entity, prop):
+    """Returns True if prop is in the entity and is indexed."""
+    if prop in datastore_types._SPECIAL_PROPERTIES:
+      return True
+    elif prop in entity.unindexed_properties():
+      return False
+
+    values = entity.get(prop, [])
+    if not isinstance(values, (tuple, list)):
+      values = [values]
+
+    for value in values:
+      if type(value) not in datastore_types._RAW_PROPERTY_TYPES:
+        return True
+    return False
+
+  def _CompileFilter(self, filt):
+    """Compiles a query filter into a predicate on entities.
+
+    An entity passes the filter if any of its values for the property compares
+    true with any of the filter's values.  Values of the same type are compared
+    natively; values of different types are ordered by their type tags, as in
+    the real datastore, and are never equal.
+
+    Args:
+      filt: datastore_pb.Query_Filter, which may not be an IN filter
+
+    Returns:
+      A function taking a datastore.Entity and returning True if it passes
+      the filter, False otherwise.
+    """
+    assert filt.op() != datastore_pb.Query_Filter.IN
+
+    prop = filt.property(0).name().decode('utf-8')
+    compare = self._FILTER_OPERATORS[filt.op()]
+    is_equality = (filt.op() == datastore_pb.Query_Filter.EQUAL)
+    type_tags = self._PROPERTY_TYPE_TAGS
+    has_prop_indexed = self._HasPropIndexed
+
+    filter_vals = []
+    for filter_prop in filt.property_list():
+      filter_val = datastore_types.FromPropertyPb(filter_prop)
+      filter_vals.append((filter_val, type_tags.get(filter_val.__class__)))
+
+    def passes_filter(entity):
+      if not has_prop_indexed(entity, prop):
+        return False
+
+      try:
+        entity_vals = datastore._GetPropertyValue(entity, prop)
+      except KeyError:
+        entity_vals = []
+
+      if not isinstance(entity_vals, list):
+        entity_vals = [entity_vals]
+
+      for entity_val in entity_vals:
+        entity_type = type_tags.get(entity_val.__class__)
+        for filter_val, filter_type in filter_vals:
+          if entity_type == filter_type:
+            try:
+              if compare(entity_val, filter_val):
+                return True
+            except TypeError:
+              pass
+          elif not is_equality and compare(entity_type, filter_type):
+            return True
+
+      return False
+
+    return passes_filter
+
+  @classmethod
+  def _PropertySortKey(cls, value):
+    """Returns the sort key of a property value for query orderings.
+
+    Values are ordered by type tag first, as in the real datastore, and then
+    natively.  Dates are ordered by their timestamps, among the integers, and
+    keys by their paths, as Key.__cmp__ orders them.
+    """
+    if isinstance(value, datetime.datetime):
+      value = datastore_types.DatetimeToTimestamp(value)
+    tag = cls._PROPERTY_TYPE_TAGS.get(value.__class__)
+    if isinstance(value, datastore_types.Key):
+      value = cls._KeySortKey(value)
+    return (tag, value)
+
+  @staticmethod
+  def _KeySortKey(key):
+    """Returns the sort key of a datastore_types.Key."""
+    return [key._Key__reference.app()] + key.to_path(_default_id=0)
+
+  def _OrderKey(self, orders):
+    """Compiles query orderings into a sort key function.
+
+    Multi-valued properties sort by their smallest value in ascending orders
+    and by their largest in descending ones.  Entities which are otherwise equal
+    are ordered by key.
+
+    Args:
+      orders: list of datastore_pb.Query_Order
+
+    Returns:
+      A function taking a datastore.Entity and returning its sort key.
+    """
+    property_sort_key = self._PropertySortKey
+    key_sort_key = self._KeySortKey
+    orderings = [(order.property().decode('utf-8'),
+                  order.direction() == datastore_pb.Query_Order.DESCENDING)
+                 for order in orders]
+
+    def order_key(entity):
+      sort_key = []
+      for prop, descending in orderings:
+        value = datastore._GetPropertyValue(entity, prop)
+        if isinstance(value, list):
+          values = [property_sort_key(v) for v in value]
+          if descending:
+            sort_key.append(_Reversed(max(values)))
+          else:
+            sort_key.append(min(values))
+        elif descending:
+          sort_key.append(_Reversed(property_sort_key(value)))
+        else:
+          sort_key.append(property_sort_key(value))
+      sort_key.append(key_sort_key(entity.key()))
+      return sort_key
+
+    return order_key
+
+  def __GetEntityIndex(self, app_kind, properties):
+    """Returns the _EntityIndex of a kind by the given properties, building it
+    first if there is none yet."""
+    indexes = self.__entity_indexes.setdefault(app_kind, {})
+    index = indexes.get(properties)
+    if index is None:
+      index = _EntityIndex(properties)
+      index.Build([(key.Encode(), entity.native)
+                   for key, entity in self.__entities[app_kind].items()])
+      indexes[properties] = index
+    return index
+
+  def _PlanQuery(self, app_kind, filters, orders):
+    """Narrows down the entities which a query of one kind may return.
+
+    Indexes of the kind by single properties, and by the composite indexes
+    defined for it, are built when first needed, and kept up to date as entities
+    are stored and deleted.  The index which leaves the fewest entries, given
+    the query's equality filters on a prefix of its properties and the bounds on
+    the next one, is used.  The query's filters must still be applied to the
+    entities returned.
+
+    Args:
+      app_kind: (app, kind) tuple
+      filters: list of datastore_pb.Query_Filter, normalized
+      orders: list of datastore_pb.Query_Order, normalized
+
+    Returns:
+      A set of the encoded keys of the candidate entities, or None if there is
+      no better way than to look at every entity of the kind.
+    """
+    if not self.__entities.get(app_kind):
+      return None
+
+    mentioned = set()
+    equal = {}
+    lower = {}
+    upper = {}
+    for filt in filters:
+      prop = filt.property(0).name().decode('utf-8')
+      if prop in datastore_types._SPECIAL_PROPERTIES:
+        continue
+      mentioned.add(prop)
+      if filt.property_size() != 1:
+        continue
+      key = _IndexValue(datastore_types.FromPropertyPb(filt.property(0)))
+      if key is None:
+        continue
+
+      op = filt.op()
+      if op == datastore_pb.Query_Filter.EQUAL:
+        equal.setdefault(prop, key)
+      elif op in (datastore_pb.Query_Filter.GREATER_THAN,
+                  datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL):
+        inclusive = (op == datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL)
+        if prop not in lower or (key, not inclusive) > (lower[prop][0],
+                                                        not lower[prop][1]):
+          lower[prop] = (key, inclusive)
+      else:
+        inclusive = (op == datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL)
+        if prop not in upper or (key, inclusive) < upper[prop]:
+          upper[prop] = (key, inclusive)
+
+    for order in orders:
+      prop = order.property().decode('utf-8')
+      if prop not in datastore_types._SPECIAL_PROPERTIES:
+        mentioned.add(prop)
+    if not mentioned:
+      return None
+
+    candidates = [(prop,) for prop in mentioned]
+    app, kind = app_kind
+    for composite in self.__indexes.get(app, []):
+      definition = composite.definition()
+      properties = tuple([prop.name().decode('utf-8')
+                          for prop in definition.property_list()])
+      if (composite.state() != self.DELETED and
+          definition.entity_type() == kind and
+          len(properties) > 1 and mentioned.issuperset(properties)):
+        candidates.append(properties)
+
+    self.__entities_lock.acquire()
+    try:
+      best = None
+      for properties in candidates:
+        index = self.__GetEntityIndex(app_kind, properties)
+        prefix = ()
+        for prop in properties:
+          if prop not in equal:
+            break
+          prefix += (equal[prop],)
+        if len(prefix) < len(properties):
+          prop = properties[len(prefix)]
+          start, end = index.Range(prefix, lower.get(prop), upper.get(prop))
+        else:
+          start, end = index.Range(prefix)
+        size = end - start + len(index.unsorted)
+        if best is None or size < best[0]:
+          best = (size, index, start, end)
+
+      size, index, start, end = best
+      if size >= len(self.__entities[app_kind]):
+        return None
+      return index.Keys(start, end)
+    finally:
+      self.__entities_lock.release()
 
   def _Dynamic_RunQuery(self, query, query_result, count=None):
     if not self.__tx_lock.acquire(False):
@@ -623,39 +1449,20 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
                                                   query.order_list())
 
     if self.__require_indexes:
-      required, kind, ancestor, props, num_eq_filters = datastore_index.CompositeIndexForQuery(query)
-      if required:
-        required_key = kind, ancestor, props
-        indexes = self.__indexes.get(app_id)
-        if not indexes:
-          raise apiproxy_errors.ApplicationError(
-              datastore_pb.Error.NEED_INDEX,
-              "This query requires a composite index, but none are defined. "
-              "You must create an index.yaml file in your application root.")
-        eq_filters_set = set(props[:num_eq_filters])
-        remaining_filters = props[num_eq_filters:]
-        for index in indexes:
-          definition = datastore_admin.ProtoToIndexDefinition(index)
-          index_key = datastore_index.IndexToKey(definition)
-          if required_key == index_key:
-            break
-          if num_eq_filters > 1 and (kind, ancestor) == index_key[:2]:
-            this_props = index_key[2]
-            this_eq_filters_set = set(this_props[:num_eq_filters])
-            this_remaining_filters = this_props[num_eq_filters:]
-            if (eq_filters_set == this_eq_filters_set and
-                remaining_filters == this_remaining_filters):
-              break
-        else:
-          raise apiproxy_errors.ApplicationError(
-              datastore_pb.Error.NEED_INDEX,
-              "This query requires a composite index that is not defined. "
-              "You must update the index.yaml file in your application root.")
+      _CheckCompositeIndexes(query, self.__indexes.get(app_id))
 
     try:
       query.set_app(app_id_namespace.to_encoded())
       if query.has_kind():
-        results = entities[app_id_namespace.to_encoded(), query.kind()].values()
+        app_kind = (app_id_namespace.to_encoded(), query.kind())
+        keys = None
+        if entities is self.__entities:
+          keys = self._PlanQuery(app_kind, filters, orders)
+        if keys is None:
+          results = entities[app_kind].values()
+        else:
+          results = [entities[app_kind][entity_pb.Reference(key)]
+                     for key in keys]
         results = [entity.native for entity in results]
       else:
         results = []
@@ -665,155 +1472,40 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     except KeyError:
       results = []
 
+    predicates = [self._CompileFilter(filt) for filt in filters]
+
     if query.has_ancestor():
       ancestor_path = query.ancestor().path().element_list()
       def is_descendant(entity):
         path = entity.key()._Key__reference.path().element_list()
         return path[:len(ancestor_path)] == ancestor_path
-      results = filter(is_descendant, results)
-
-    operators = {datastore_pb.Query_Filter.LESS_THAN:             '<',
-                 datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:    '<=',
-                 datastore_pb.Query_Filter.GREATER_THAN:          '>',
-                 datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
-                 datastore_pb.Query_Filter.EQUAL:                 '==',
-                 }
-
-    def has_prop_indexed(entity, prop):
-      """Returns True if prop is in the entity and is indexed."""
-      if prop in datastore_types._SPECIAL_PROPERTIES:
-        return True
-      elif prop in entity.unindexed_properties():
-        return False
-
-      values = entity.get(prop, [])
-      if not isinstance(values, (tuple, list)):
-        values = [values]
-
-      for value in values:
-        if type(value) not in datastore_types._RAW_PROPERTY_TYPES:
-          return True
-      return False
-
-    for filt in filters:
-      assert filt.op() != datastore_pb.Query_Filter.IN
-
-      prop = filt.property(0).name().decode('utf-8')
-      op = operators[filt.op()]
-
-      filter_val_list = [datastore_types.FromPropertyPb(filter_prop)
-                         for filter_prop in filt.property_list()]
-
-      def passes_filter(entity):
-        """Returns True if the entity passes the filter, False otherwise.
-
-        The filter being evaluated is filt, the current filter that we're on
-        in the list of filters in the query.
-        """
-        if not has_prop_indexed(entity, prop):
-          return False
-
-        try:
-          entity_vals = datastore._GetPropertyValue(entity, prop)
-        except KeyError:
-          entity_vals = []
-
-        if not isinstance(entity_vals, list):
-          entity_vals = [entity_vals]
-
-        for fixed_entity_val in entity_vals:
-          for filter_val in filter_val_list:
-            fixed_entity_type = self._PROPERTY_TYPE_TAGS.get(
-              fixed_entity_val.__class__)
-            filter_type = self._PROPERTY_TYPE_TAGS.get(filter_val.__class__)
-            if fixed_entity_type == filter_type:
-              comp = u'%r %s %r' % (fixed_entity_val, op, filter_val)
-            elif op != '==':
-              comp = '%r %s %r' % (fixed_entity_type, op, filter_type)
-            else:
-              continue
-
-            logging.log(logging.DEBUG - 1,
-                        'Evaling filter expression "%s"', comp)
-
-            try:
-              ret = eval(comp)
-              if ret and ret != NotImplementedError:
-                return True
-            except TypeError:
-              pass
-
-        return False
-
-      results = filter(passes_filter, results)
+      predicates.insert(0, is_descendant)
 
     for order in orders:
       prop = order.property().decode('utf-8')
-      results = [entity for entity in results if has_prop_indexed(entity, prop)]
-
-    def order_compare_entities(a, b):
-      """ Return a negative, zero or positive number depending on whether
-      entity a is considered smaller than, equal to, or larger than b,
-      according to the query's orderings. """
-      cmped = 0
-      for o in orders:
-        prop = o.property().decode('utf-8')
-
-        reverse = (o.direction() is datastore_pb.Query_Order.DESCENDING)
+      predicates.append(lambda entity, prop=prop:
+                        self._HasPropIndexed(entity, prop))
 
-        a_val = datastore._GetPropertyValue(a, prop)
-        if isinstance(a_val, list):
-          a_val = sorted(a_val, order_compare_properties, reverse=reverse)[0]
-
-        b_val = datastore._GetPropertyValue(b, prop)
-        if isinstance(b_val, list):
-          b_val = sorted(b_val, order_compare_properties, reverse=reverse)[0]
-
-        cmped = order_compare_properties(a_val, b_val)
-
-        if o.direction() is datastore_pb.Query_Order.DESCENDING:
-          cmped = -cmped
-
-        if cmped != 0:
-          return cmped
-
-      if cmped == 0:
-        return cmp(a.key(), b.key())
-
-    def order_compare_properties(x, y):
-      """Return a negative, zero or positive number depending on whether
-      property value x is considered smaller than, equal to, or larger than
-      property value y. If x and y are different types, they're compared based
-      on the type ordering used in the real datastore, which is based on the
-      tag numbers in the PropertyValue PB.
-      """
-      if isinstance(x, datetime.datetime):
-        x = datastore_types.DatetimeToTimestamp(x)
-      if isinstance(y, datetime.datetime):
-        y = datastore_types.DatetimeToTimestamp(y)
-
-      x_type = self._PROPERTY_TYPE_TAGS.get(x.__class__)
-      y_type = self._PROPERTY_TYPE_TAGS.get(y.__class__)
-
-      if x_type == y_type:
-        try:
-          return cmp(x, y)
-        except TypeError:
-          return 0
-      else:
-        return cmp(x_type, y_type)
-
-    results.sort(order_compare_entities)
+    if predicates:
+      results = (entity for entity in results
+                 if all(passes(entity) for passes in predicates))
 
     offset = 0
-    limit = len(results)
     if query.has_offset():
       offset = query.offset()
+
+    order_key = self._OrderKey(orders)
+    total = None
+    sort_rest = None
     if query.has_limit():
-      limit = query.limit()
-    if limit > _MAXIMUM_RESULTS:
-      limit = _MAXIMUM_RESULTS
-    results = results[offset:]
+      # Only what the limit asks for is sorted, unless a compiled cursor (or
+      # Next) asks for more.
+      results = list(results)
+      total = len(results)
+      sort_rest = lambda: sorted(results, key=order_key)
+      first = heapq.nsmallest(offset + query.limit(), results, key=order_key)
+    else:
+      first = sorted(results, key=order_key)
 
     clone = datastore_pb.Query()
     clone.CopyFrom(query)
@@ -823,7 +1515,7 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     else:
       self.__query_history[clone] = 1
 
-    cursor = _Cursor(results, query.keys_only())
+    cursor = _Cursor(first, query.keys_only(), offset, total, sort_rest)
     self.__queries[cursor.cursor] = cursor
 
     if count is None:
@@ -887,6 +1579,7 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     transaction.set_handle(handle)
 
     self.__tx_lock.acquire()
+    self.__tx_journal = []
     snapshot = [(app_kind, dict(entities))
                 for app_kind, entities in self.__entities.items()]
     self.__tx_snapshot = dict(snapshot)
@@ -899,10 +1592,17 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
 
     self.__tx_snapshot = {}
     try:
-      self.__WriteDatastore()
+      self.__entities_lock.acquire()
+      try:
+        self.__AppendJournal(self.__tx_journal)
+      finally:
+        self.__entities_lock.release()
+      self.__tx_journal = []
     finally:
       self.__tx_lock.release()
 
+    self.__CompactJournal()
+
   def _Dynamic_Rollback(self, transaction, transaction_response):
     if not self.__transactions.has_key(transaction.handle()):
       raise apiproxy_errors.ApplicationError(
@@ -910,7 +1610,9 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
         'Transaction handle %d not found' % transaction.handle())
 
     self.__entities = self.__tx_snapshot
+    self.__entity_indexes = {}
     self.__tx_snapshot = {}
+    self.__tx_journal = []
     self.__tx_lock.release()
 
   def _Dynamic_GetSchema(self, req, schema):
@@ -930,50 +1632,8 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
         kinds.append(self.__schema_cache[app_kind])
         continue
 
-      kind_pb = entity_pb.EntityProto()
-      kind_pb.mutable_key().set_app('')
-      kind_pb.mutable_key().mutable_path().add_element().set_type(kind)
-      kind_pb.mutable_entity_group()
-
-      props = {}
-
-      for entity in self.__entities[app_kind].values():
-        for prop in entity.protobuf.property_list():
-          if prop.name() not in props:
-            props[prop.name()] = entity_pb.PropertyValue()
-          props[prop.name()].MergeFrom(prop.value())
-
-      for value_pb in props.values():
-        if value_pb.has_int64value():
-          value_pb.set_int64value(0)
-        if value_pb.has_booleanvalue():
-          value_pb.set_booleanvalue(False)
-        if value_pb.has_stringvalue():
-          value_pb.set_stringvalue('none')
-        if value_pb.has_doublevalue():
-          value_pb.set_doublevalue(0.0)
-        if value_pb.has_pointvalue():
-          value_pb.mutable_pointvalue().set_x(0.0)
-          value_pb.mutable_pointvalue().set_y(0.0)
-        if value_pb.has_uservalue():
-          value_pb.mutable_uservalue().set_gaiaid(0)
-          value_pb.mutable_uservalue().set_email('none')
-          value_pb.mutable_uservalue().set_auth_domain('none')
-          value_pb.mutable_uservalue().clear_nickname()
-          value_pb.mutable_uservalue().clear_obfuscated_gaiaid()
-        if value_pb.has_referencevalue():
-          value_pb.clear_referencevalue()
-          value_pb.mutable_referencevalue().set_app('none')
-          pathelem = value_pb.mutable_referencevalue().add_pathelement()
-          pathelem.set_type('none')
-          pathelem.set_name('none')
-
-      for name, value_pb in props.items():
-        prop_pb = kind_pb.add_property()
-        prop_pb.set_name(name)
-        prop_pb.set_multiple(False)
-        prop_pb.mutable_value().CopyFrom(value_pb)
-
+      kind_pb = _KindSchema(kind, [entity.protobuf for entity in
+                                   self.__entities[app_kind].values()])
       kinds.append(kind_pb)
       self.__schema_cache[app_kind] = kind_pb
 
@@ -0,0 +1,1009 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+SQLite-backed stub for the Python datastore API, for datasets which don't fit
+in memory.
+
+Entities are stored as encoded proto bufs in the Entities table, keyed by an
+encoding of their keys which sorts as the keys do. Each indexed property value
+has a row in the EntitiesByProperty table, encoded so that SQLite orders values
+as the datastore does: by type tag first, and then by value. Queries are run
+by SQLite a batch at a time, so memory use doesn't grow with the data.
+
+Transactions are serialized through __tx_lock, as in the file stub. Each one
+is an SQLite transaction of the connection that writes. Gets and queries read
+through a second connection, so they see the entities as they were when the
+transaction began. The database is kept in WAL mode, so that reads don't block
+the writes, nor writes the reads.
+"""
+
+
+
+
+
+
+import datetime
+import logging
+import md5
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+
+from google.appengine.api import apiproxy_stub
+from google.appengine.api import datastore_errors
+from google.appengine.api import datastore_file_stub
+from google.appengine.api import datastore_types
+from google.appengine.api import users
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import datastore_index
+from google.appengine.runtime import apiproxy_errors
+from google.appengine.datastore import entity_pb
+
+
+_MAXIMUM_RESULTS = datastore_file_stub._MAXIMUM_RESULTS
+
+_MAX_QUERY_OFFSET = datastore_file_stub._MAX_QUERY_OFFSET
+
+_MAX_QUERY_COMPONENTS = datastore_file_stub._MAX_QUERY_COMPONENTS
+
+_BATCH_SIZE = datastore_file_stub._BATCH_SIZE
+
+
+_MAX_OPEN_CURSORS = 100
+
+
+_ID_BLOCK = 1000
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS Entities (
+  path BLOB PRIMARY KEY,
+  app TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  entity BLOB NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS EntitiesByKind ON Entities (app, kind, path);
+
+CREATE TABLE IF NOT EXISTS EntitiesByProperty (
+  path BLOB NOT NULL,
+  app TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  name TEXT NOT NULL,
+  value BLOB NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS EntitiesByPropertyValue
+  ON EntitiesByProperty (app, kind, name, value, path);
+
+CREATE INDEX IF NOT EXISTS EntitiesByPropertyPath
+  ON EntitiesByProperty (path, name, value);
+
+CREATE TABLE IF NOT EXISTS Counters (
+  name TEXT PRIMARY KEY,
+  value INTEGER NOT NULL
+);
+"""
+
+
+_PROPERTY_TYPE_TAGS = dict(datastore_file_stub.DatastoreFileStub._PROPERTY_TYPE_TAGS)
+_PROPERTY_TYPE_TAGS[datastore_types.ByteString] = (
+    entity_pb.PropertyValue.kstringValue)
+
+_SQL_OPERATORS = {
+  datastore_pb.Query_Filter.LESS_THAN: '<',
+  datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL: '<=',
+  datastore_pb.Query_Filter.GREATER_THAN: '>',
+  datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
+  datastore_pb.Query_Filter.EQUAL: '=',
+  }
+
+
+def _Utf8(value):
+  """Returns a string as UTF-8 bytes."""
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
+
+
+def _EncodeKey(reference):
+  """Encodes a key so that encoded keys sort as Key.__cmp__ orders keys.
+
+  The encoding starts with the reference type tag, so that it also sorts
+  among the other property values, and a key's descendants all start with
+  its encoding.
+
+  Args:
+    reference: entity_pb.Reference
+
+  Returns:
+    string
+  """
+  parts = [chr(entity_pb.PropertyValue.kReferenceValueGroup),
+           _Utf8(reference.app()), '\x00']
+  for element in reference.path().element_list():
+    parts.append(_Utf8(element.type()))
+    parts.append('\x00')
+    if element.has_name():
+      parts.append('\x02')
+      parts.append(_Utf8(element.name()))
+      parts.append('\x00')
+    else:
+      parts.append('\x01')
+      parts.append(struct.pack('>Q', element.id()))
+  return ''.join(parts)
+
+
+def _EncodeDouble(value):
+  """Encodes a float so that encoded floats sort as the floats do."""
+  if value == 0:
+    value = 0.0
+  bits, = struct.unpack('>Q', struct.pack('>d', value))
+  if bits & 0x8000000000000000:
+    bits ^= 0xffffffffffffffff
+  else:
+    bits |= 0x8000000000000000
+  return struct.pack('>Q', bits)
+
+
+def _EncodeValue(value):
+  """Encodes a property value so that encoded values sort as the datastore
+  orders values: by type tag first, and then by value.
+
+  Args:
+    value: a property value, as returned by datastore_types.FromPropertyPb
+
+  Returns:
+    string, or None if the value isn't indexed
+  """
+  if isinstance(value, datetime.datetime):
+    value = datastore_types.DatetimeToTimestamp(value)
+
+  tag = _PROPERTY_TYPE_TAGS.get(value.__class__)
+  if tag is None or isinstance(value, datastore_types._RAW_PROPERTY_TYPES):
+    return None
+
+  prefix = chr(tag)
+  if value is None:
+    return prefix
+  elif isinstance(value, bool):
+    return prefix + chr(value)
+  elif isinstance(value, (int, long)):
+    return prefix + struct.pack('>Q', value + 0x8000000000000000)
+  elif isinstance(value, float):
+    return prefix + _EncodeDouble(value)
+  elif isinstance(value, datastore_types.GeoPt):
+    return prefix + _EncodeDouble(value.lat) + _EncodeDouble(value.lon)
+  elif isinstance(value, users.User):
+    return (prefix + value.email().encode('utf-8') + '\x00' +
+            value.auth_domain().encode('utf-8'))
+  elif isinstance(value, datastore_types.Key):
+    return _EncodeKey(value._ToPb())
+
+  if isinstance(value, datastore_types.IM):
+    value = unicode(value)
+  return prefix + _Utf8(value)
+
+
+class _Cursor(object):
+  """A query cursor, which runs its query again for each batch of results.
+
+  No SQLite statement is left pending between batches, so each one reads the
+  entities as they are when it is asked for.
+
+  Public properties:
+    cursor: the integer cursor
+    count: the number of results last returned
+    keys_only: whether the query is keys_only
+
+  Class attributes:
+    _next_cursor: the next cursor to allocate
+    _next_cursor_lock: protects _next_cursor
+  """
+  _next_cursor = 1
+  _next_cursor_lock = threading.Lock()
+
+  def __init__(self, connection, sql, params, offset, keys_only):
+    """Constructor.
+
+    Args:
+      connection: sqlite3.Connection to read with
+      # the query's SQL statement, selecting the encoded entities in order,
+      # and its parameters
+      sql: string
+      params: list
+      # the number of results to skip
+      offset: integer
+      keys_only: integer
+    """
+    self.__connection = connection
+    self.__sql = sql
+    self.__params = params
+    self.__offset = offset
+    self.keys_only = keys_only
+    self.count = 0
+    self._offset = 0
+
+    self._next_cursor_lock.acquire()
+    try:
+      self.cursor = _Cursor._next_cursor
+      _Cursor._next_cursor += 1
+    finally:
+      self._next_cursor_lock.release()
+
+  def PopulateQueryResult(self, result, count, offset=None, compiled=False):
+    """Populates a QueryResult with this cursor and the given number of results.
+
+    Args:
+      result: datastore_pb.QueryResult
+      count: integer
+      offset: integer, overrides the internal offset
+      compiled: boolean, whether we are compiling this query
+
+    Returns:
+      boolean, whether there are more results
+    """
+    if count > _MAXIMUM_RESULTS:
+      count = _MAXIMUM_RESULTS
+
+    result.mutable_cursor().set_cursor(self.cursor)
+    result.set_keys_only(self.keys_only)
+
+    _offset = offset
+    if _offset is None:
+      _offset = self._offset
+
+    rows = self.__connection.execute(
+        self.__sql + ' LIMIT ? OFFSET ?',
+        self.__params + [count + 1, self.__offset + _offset]).fetchall()
+
+    more_results = len(rows) > count
+    rows = rows[:count]
+    self.count = len(rows)
+    if offset is None:
+      self._offset += self.count
+
+    result_list = result.result_list()
+    for row in rows:
+      result_list.append(entity_pb.EntityProto(str(row[0])))
+
+    result.set_more_results(more_results)
+    if compiled and more_results:
+      compiled_query = datastore_file_stub._FakeCompiledQuery(
+          cursor=self.cursor, offset=_offset + self.count,
+          keys_only=self.keys_only)
+      result.mutable_compiled_query().CopyFrom(compiled_query._ToPb())
+    return more_results
+
+
+class DatastoreSqliteStub(apiproxy_stub.APIProxyStub):
+  """ Persistent stub for the Python datastore API, backed by SQLite.
+
+  Stores all entities in an SQLite database, and keeps none of them in
+  memory. A DatastoreSqliteStub instance handles a single app's data.
+  """
+
+  _INDEX_STATE_TRANSITIONS = (
+      datastore_file_stub.DatastoreFileStub._INDEX_STATE_TRANSITIONS)
+
+  def __init__(self,
+               app_id,
+               datastore_file,
+               require_indexes=False,
+               service_name='datastore_v3',
+               trusted=False):
+    """Constructor.
+
+    Opens the database, creating it if it doesn't exist.
+
+    Args:
+      app_id: string
+      datastore_file: string, the SQLite database which stores all entities
+          across sessions.  Use None not to keep them, in a temporary file.
+      require_indexes: bool, default False.  If True, composite indexes must
+          exist in index.yaml for queries that need them.
+      service_name: Service name expected for all calls.
+      trusted: bool, default False.  If True, this stub allows an app to
+        access the data of another app.
+    """
+    super(DatastoreSqliteStub, self).__init__(service_name)
+
+    assert isinstance(app_id, basestring) and app_id != ''
+    self.__app_id = app_id
+    self.SetTrusted(trusted)
+
+    self.__temporary_file = None
+    if not datastore_file or datastore_file == '/dev/null':
+      handle, datastore_file = tempfile.mkstemp(suffix='.sqlite')
+      os.close(handle)
+      self.__temporary_file = datastore_file
+    self.__datastore_file = datastore_file
+
+    self.__queries = {}
+
+    self.__transactions = {}
+    self.__in_transaction = False
+
+    self.__indexes = {}
+    self.__require_indexes = require_indexes
+
+    self.__query_history = {}
+
+    self.__next_tx_handle = 1
+    self.__next_index_id = 1
+    self.__tx_handle_lock = threading.Lock()
+    self.__index_id_lock = threading.Lock()
+    self.__tx_lock = threading.Lock()
+    self.__connection_lock = threading.RLock()
+    self.__indexes_lock = threading.Lock()
+
+    self.__writer = self.__Connect()
+    self.__writer.executescript(_SCHEMA)
+    self.__reader = self.__Connect()
+
+    self.__next_id = 1
+    self.__id_limit = 1
+    row = self.__writer.execute(
+        "SELECT value FROM Counters WHERE name = 'next_id'").fetchone()
+    if row is not None:
+      self.__next_id = self.__id_limit = row[0]
+
+  def __Connect(self):
+    """Opens a connection to the database, in WAL mode."""
+    connection = sqlite3.connect(self.__datastore_file, timeout=30,
+                                 isolation_level=None,
+                                 check_same_thread=False)
+    journal_mode, = connection.execute('PRAGMA journal_mode=WAL').fetchone()
+    if journal_mode.lower() != 'wal':
+      logging.warning('Could not use WAL mode for %s: queries may fail while '
+                      'entities are written', self.__datastore_file)
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+  def Close(self):
+    """Closes the database, and removes it if it was a temporary file."""
+    self.__connection_lock.acquire()
+    try:
+      self.__queries = {}
+      self.__reader.close()
+      self.__writer.close()
+      if self.__temporary_file:
+        for suffix in ('', '-wal', '-shm'):
+          try:
+            os.remove(self.__temporary_file + suffix)
+          except OSError:
+            pass
+    finally:
+      self.__connection_lock.release()
+
+  def Clear(self):
+    """ Clears the datastore by deleting all currently stored entities and
+    queries. """
+    self.__connection_lock.acquire()
+    try:
+      self.__queries = {}
+      self.__Write(self.__ClearTables)
+    finally:
+      self.__connection_lock.release()
+    self.__transactions = {}
+    self.__query_history = {}
+
+  def __ClearTables(self):
+    self.__writer.execute('DELETE FROM Entities')
+    self.__writer.execute('DELETE FROM EntitiesByProperty')
+
+  def SetTrusted(self, trusted):
+    """Set/clear the trusted bit in the stub.
+
+    This bit indicates that the app calling the stub is trusted. A
+    trusted app can write to datastores of other apps.
+
+    Args:
+      trusted: boolean.
+    """
+    self.__trusted = trusted
+
+  def __ValidateAppId(self, app_id):
+    """Verify that this is the stub for app_id.
+
+    Args:
+      app_id: An application ID.
+
+    Raises:
+      datastore_errors.BadRequestError: if this is not the stub for app_id.
+    """
+    if not self.__trusted and app_id != self.__app_id:
+      raise datastore_errors.BadRequestError(
+          'app %s cannot access app %s\'s data' % (self.__app_id, app_id))
+
+  def __ValidateKey(self, key):
+    """Validate this key.
+
+    Args:
+      key: entity_pb.Reference
+
+    Raises:
+      datastore_errors.BadRequestError: if the key is invalid
+    """
+    assert isinstance(key, entity_pb.Reference)
+
+    self.__ValidateAppId(key.app())
+
+    for elem in key.path().element_list():
+      if elem.has_id() == elem.has_name():
+        raise datastore_errors.BadRequestError(
+          'each key path element should have id or name but not both: %r' % key)
+
+  def MakeSyncCall(self, service, call, request, response):
+    """ The main RPC entry point. service must be 'datastore_v3'.
+    """
+    self.assertPbIsInitialized(request)
+    super(DatastoreSqliteStub, self).MakeSyncCall(service,
+                                                  call,
+                                                  request,
+                                                  response)
+    self.assertPbIsInitialized(response)
+
+  def assertPbIsInitialized(self, pb):
+    """Raises an exception if the given PB is not initialized and valid."""
+    explanation = []
+    assert pb.IsInitialized(explanation), explanation
+    pb.Encode()
+
+  def QueryHistory(self):
+    """Returns a dict that maps Query PBs to times they've been run.
+    """
+    return dict((pb, times) for pb, times in self.__query_history.items()
+                if pb.app() == self.__app_id)
+
+  def __Write(self, write, *args):
+    """Calls a function which writes through the writer connection, in the
+    transaction in progress if there is one, and otherwise in its own.
+
+    Writes made outside of a transaction while one is in progress are part of
+    it, as the file stub's are lost when it is rolled back.
+    """
+    self.__connection_lock.acquire()
+    try:
+      if self.__in_transaction:
+        return write(*args)
+
+      self.__writer.execute('BEGIN IMMEDIATE')
+      try:
+        result = write(*args)
+      except:
+        self.__writer.execute('ROLLBACK')
+        raise
+      self.__writer.execute('COMMIT')
+      return result
+    finally:
+      self.__connection_lock.release()
+
+  def __AllocateIds(self, size):
+    """Allocates consecutive ids.  They are reserved in the database by the
+    block, so that they are never allocated again.
+
+    Returns:
+      the first id
+    """
+    self.__connection_lock.acquire()
+    try:
+      start = self.__next_id
+      self.__next_id += size
+      if self.__next_id > self.__id_limit:
+        self.__id_limit = self.__next_id + _ID_BLOCK
+        self.__Write(self.__StoreIdLimit)
+      return start
+    finally:
+      self.__connection_lock.release()
+
+  def __StoreIdLimit(self):
+    self.__writer.execute(
+        "INSERT OR REPLACE INTO Counters (name, value) VALUES ('next_id', ?)",
+        (self.__id_limit,))
+
+  def __StoreEntities(self, entities):
+    """Writes entities, and their index rows.
+
+    Args:
+      entities: list of entity_pb.EntityProto
+    """
+    for entity in entities:
+      key = entity.key()
+      path = buffer(_EncodeKey(key))
+      app = key.app().decode('utf-8')
+      kind = key.path().element_list()[-1].type().decode('utf-8')
+
+      self.__writer.execute('DELETE FROM EntitiesByProperty WHERE path = ?',
+                            (path,))
+      self.__writer.execute(
+          'INSERT OR REPLACE INTO Entities (path, app, kind, entity) '
+          'VALUES (?, ?, ?, ?)', (path, app, kind, buffer(entity.Encode())))
+
+      rows = []
+      for prop in entity.property_list():
+        value = _EncodeValue(datastore_types.FromPropertyPb(prop))
+        if value is not None:
+          rows.append((path, app, kind, prop.name().decode('utf-8'),
+                       buffer(value)))
+      self.__writer.executemany(
+          'INSERT INTO EntitiesByProperty (path, app, kind, name, value) '
+          'VALUES (?, ?, ?, ?, ?)', rows)
+
+  def __DeleteEntities(self, keys):
+    """Deletes the entities with the given keys, and their index rows.
+
+    Args:
+      keys: list of entity_pb.Reference
+    """
+    for key in keys:
+      path = buffer(_EncodeKey(key))
+      self.__writer.execute('DELETE FROM Entities WHERE path = ?', (path,))
+      self.__writer.execute('DELETE FROM EntitiesByProperty WHERE path = ?',
+                            (path,))
+
+  def _Dynamic_Put(self, put_request, put_response):
+    clones = []
+    for entity in put_request.entity_list():
+      self.__ValidateKey(entity.key())
+
+      clone = entity_pb.EntityProto()
+      clone.CopyFrom(entity)
+
+      for property in clone.property_list():
+        if property.value().has_uservalue():
+          uid = md5.new(property.value().uservalue().email().lower()).digest()
+          uid = '1' + ''.join(['%02d' % ord(x) for x in uid])[:20]
+          property.mutable_value().mutable_uservalue().set_obfuscated_gaiaid(
+              uid)
+
+      clones.append(clone)
+
+      assert clone.has_key()
+      assert clone.key().path().element_size() > 0
+
+      last_path = clone.key().path().element_list()[-1]
+      if last_path.id() == 0 and not last_path.has_name():
+        last_path.set_id(self.__AllocateIds(1))
+
+        assert clone.entity_group().element_size() == 0
+        group = clone.mutable_entity_group()
+        root = clone.key().path().element(0)
+        group.add_element().CopyFrom(root)
+
+      else:
+        assert (clone.has_entity_group() and
+                clone.entity_group().element_size() > 0)
+
+    self.__Write(self.__StoreEntities, clones)
+
+    put_response.key_list().extend([c.key() for c in clones])
+
+  def _Dynamic_Get(self, get_request, get_response):
+    self.__connection_lock.acquire()
+    try:
+      for key in get_request.key_list():
+        self.__ValidateAppId(key.app())
+
+        group = get_response.add_entity()
+        row = self.__reader.execute('SELECT entity FROM Entities WHERE path = ?',
+                                    (buffer(_EncodeKey(key)),)).fetchone()
+        if row is not None:
+          group.mutable_entity().CopyFrom(entity_pb.EntityProto(str(row[0])))
+    finally:
+      self.__connection_lock.release()
+
+  def _Dynamic_Delete(self, delete_request, delete_response):
+    for key in delete_request.key_list():
+      self.__ValidateAppId(key.app())
+    self.__Write(self.__DeleteEntities, delete_request.key_list())
+
+  def __QuerySql(self, query, filters, orders, ordered=True):
+    """Builds the SQL statement which selects the encoded entities a query
+    returns, in order.
+
+    Args:
+      query: datastore_pb.Query, whose app is encoded with its namespace
+      filters, orders: the query's filters and orders, normalized
+      ordered: boolean, False if the order of the results doesn't matter
+
+    Returns:
+      (sql, params)
+    """
+    app = query.app().decode('utf-8')
+    conditions = ['e.app = ?']
+    params = [app]
+    property_conditions = 'p.app = ?'
+    property_params = [app]
+    if query.has_kind():
+      conditions.append('e.kind = ?')
+      params.append(query.kind().decode('utf-8'))
+      property_conditions += ' AND p.kind = ?'
+      property_params.append(query.kind().decode('utf-8'))
+
+    if query.has_ancestor():
+      ancestor = _EncodeKey(query.ancestor())
+      conditions.append('e.path >= ? AND e.path < ?')
+      params += [buffer(ancestor), buffer(ancestor + '\xff')]
+
+    for filt in filters:
+      assert filt.op() != datastore_pb.Query_Filter.IN
+      prop = filt.property(0).name().decode('utf-8')
+      values = [_EncodeValue(datastore_types.FromPropertyPb(filter_prop))
+                for filter_prop in filt.property_list()]
+      values = [buffer(value) for value in values if value is not None]
+      if not values:
+        conditions.append('0')
+        continue
+
+      column = 'e.path'
+      if prop != datastore_types._KEY_SPECIAL_PROPERTY:
+        column = 'p.value'
+      comparison = ' OR '.join(['%s %s ?' % (column, _SQL_OPERATORS[filt.op()])]
+                               * len(values))
+      if prop == datastore_types._KEY_SPECIAL_PROPERTY:
+        conditions.append('(%s)' % comparison)
+        params += values
+      else:
+        conditions.append('e.path IN (SELECT p.path FROM EntitiesByProperty p '
+                          'WHERE %s AND p.name = ? AND (%s))' %
+                          (property_conditions, comparison))
+        params += property_params + [prop] + values
+
+    columns = ['e.entity AS entity', 'e.path AS path']
+    column_params = []
+    sort_terms = []
+    present = []
+    for i, order in enumerate(orders):
+      prop = order.property().decode('utf-8')
+      descending = (order.direction() == datastore_pb.Query_Order.DESCENDING)
+      direction = ''
+      if descending:
+        direction = ' DESC'
+
+      if prop == datastore_types._KEY_SPECIAL_PROPERTY:
+        sort_terms.append('path' + direction)
+        continue
+
+      function = 'MIN'
+      if descending:
+        function = 'MAX'
+      columns.append('(SELECT %s(p.value) FROM EntitiesByProperty p '
+                     'WHERE p.path = e.path AND p.name = ?) AS o%d' %
+                     (function, i))
+      column_params.append(prop)
+      sort_terms.append('o%d%s' % (i, direction))
+      present.append('o%d IS NOT NULL' % i)
+    sort_terms.append('path')
+
+    sql = 'SELECT %s FROM Entities e WHERE %s' % (', '.join(columns),
+                                                   ' AND '.join(conditions))
+    params = column_params + params
+    if present or ordered:
+      sql = 'SELECT entity FROM (%s)' % sql
+      if present:
+        sql += ' WHERE ' + ' AND '.join(present)
+      if ordered:
+        sql += ' ORDER BY ' + ', '.join(sort_terms)
+    return sql, params
+
+  def __PrepareQuery(self, query):
+    """Validates a query, and encodes its app with its namespace.
+
+    Returns:
+      (filters, orders): the query's filters and orders, normalized
+    """
+    app_id_namespace = datastore_types.parse_app_id_namespace(query.app())
+    app_id = app_id_namespace.app_id()
+    self.__ValidateAppId(app_id)
+
+    if query.has_offset() and query.offset() > _MAX_QUERY_OFFSET:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST, 'Too big query offset.')
+
+    num_components = len(query.filter_list()) + len(query.order_list())
+    if query.has_ancestor():
+      num_components += 1
+    if num_components > _MAX_QUERY_COMPONENTS:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          ('query is too large. may not have more than %s filters'
+           ' + sort orders ancestor total' % _MAX_QUERY_COMPONENTS))
+
+    (filters, orders) = datastore_index.Normalize(query.filter_list(),
+                                                  query.order_list())
+
+    if self.__require_indexes:
+      datastore_file_stub._CheckCompositeIndexes(query,
+                                                 self.__indexes.get(app_id))
+
+    query.set_app(app_id_namespace.to_encoded())
+    return filters, orders
+
+  def _Dynamic_RunQuery(self, query, query_result, count=None):
+    if query.has_transaction() and not query.has_ancestor():
+      raise apiproxy_errors.ApplicationError(
+        datastore_pb.Error.BAD_REQUEST,
+        'Only ancestor queries are allowed inside transactions.')
+
+    filters, orders = self.__PrepareQuery(query)
+    sql, params = self.__QuerySql(query, filters, orders)
+
+    offset = 0
+    if query.has_offset():
+      offset = query.offset()
+
+    clone = datastore_pb.Query()
+    clone.CopyFrom(query)
+    clone.clear_hint()
+    if clone in self.__query_history:
+      self.__query_history[clone] += 1
+    else:
+      self.__query_history[clone] = 1
+
+    if count is None:
+      if query.has_count():
+        count = query.count()
+      elif query.has_limit():
+        count = query.limit()
+      else:
+        count = _BATCH_SIZE
+
+    self.__connection_lock.acquire()
+    try:
+      cursor = _Cursor(self.__reader, sql, params, offset, query.keys_only())
+      if cursor.PopulateQueryResult(query_result, count,
+                                    compiled=query.compile()):
+        self.__queries[cursor.cursor] = cursor
+        if len(self.__queries) > _MAX_OPEN_CURSORS:
+          del self.__queries[min(self.__queries)]
+    finally:
+      self.__connection_lock.release()
+
+  def _Dynamic_RunCompiledQuery(self, compiled_request, query_result):
+    cursor_handle = compiled_request.compiled_query().limit()
+    cursor_offset = compiled_request.compiled_query().offset()
+
+    count = _BATCH_SIZE
+    if compiled_request.has_count():
+      count = compiled_request.count()
+
+    self.__connection_lock.acquire()
+    try:
+      cursor = self.__GetCursor(cursor_handle)
+      cursor.PopulateQueryResult(query_result, count, cursor_offset,
+                                 compiled=True)
+    finally:
+      self.__connection_lock.release()
+
+  def _Dynamic_Next(self, next_request, query_result):
+    cursor_handle = next_request.cursor().cursor()
+
+    count = _BATCH_SIZE
+    if next_request.has_count():
+      count = next_request.count()
+
+    self.__connection_lock.acquire()
+    try:
+      cursor = self.__GetCursor(cursor_handle)
+      if not cursor.PopulateQueryResult(query_result, count):
+        del self.__queries[cursor_handle]
+    finally:
+      self.__connection_lock.release()
+
+  def __GetCursor(self, cursor_handle):
+    try:
+      return self.__queries[cursor_handle]
+    except KeyError:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST, 'Cursor %d not found' % cursor_handle)
+
+  def _Dynamic_Count(self, query, integer64proto):
+    self.__ValidateAppId(query.app())
+    filters, orders = self.__PrepareQuery(query)
+    sql, params = self.__QuerySql(query, filters, orders, ordered=False)
+
+    count = _MAXIMUM_RESULTS
+    if query.has_limit():
+      count = min(query.limit(), _MAXIMUM_RESULTS)
+
+    self.__connection_lock.acquire()
+    try:
+      row = self.__reader.execute(
+          'SELECT COUNT(*) FROM (%s LIMIT ? OFFSET ?)' % sql,
+          params + [count, query.offset()]).fetchone()
+    finally:
+      self.__connection_lock.release()
+    integer64proto.set_value(row[0])
+
+  def _Dynamic_BeginTransaction(self, request, transaction):
+    self.__tx_handle_lock.acquire()
+    handle = self.__next_tx_handle
+    self.__next_tx_handle += 1
+    self.__tx_handle_lock.release()
+
+    self.__transactions[handle] = None
+    transaction.set_handle(handle)
+
+    self.__tx_lock.acquire()
+    self.__connection_lock.acquire()
+    try:
+      self.__writer.execute('BEGIN IMMEDIATE')
+      self.__in_transaction = True
+    finally:
+      self.__connection_lock.release()
+
+  def _Dynamic_Commit(self, transaction, transaction_response):
+    if not self.__transactions.has_key(transaction.handle()):
+      raise apiproxy_errors.ApplicationError(
+        datastore_pb.Error.BAD_REQUEST,
+        'Transaction handle %d not found' % transaction.handle())
+
+    self.__connection_lock.acquire()
+    try:
+      self.__in_transaction = False
+      self.__writer.execute('COMMIT')
+    finally:
+      self.__connection_lock.release()
+      self.__tx_lock.release()
+
+  def _Dynamic_Rollback(self, transaction, transaction_response):
+    if not self.__transactions.has_key(transaction.handle()):
+      raise apiproxy_errors.ApplicationError(
+        datastore_pb.Error.BAD_REQUEST,
+        'Transaction handle %d not found' % transaction.handle())
+
+    self.__connection_lock.acquire()
+    try:
+      self.__in_transaction = False
+      self.__writer.execute('ROLLBACK')
+      self.__Write(self.__StoreIdLimit)
+    finally:
+      self.__connection_lock.release()
+      self.__tx_lock.release()
+
+  def _Dynamic_GetSchema(self, req, schema):
+    app_str = req.app()
+    self.__ValidateAppId(app_str)
+
+    sql = 'SELECT DISTINCT kind FROM Entities WHERE app = ?'
+    params = [app_str.decode('utf-8')]
+    if req.has_start_kind():
+      sql += ' AND kind >= ?'
+      params.append(req.start_kind().decode('utf-8'))
+    if req.has_end_kind():
+      sql += ' AND kind <= ?'
+      params.append(req.end_kind().decode('utf-8'))
+
+    self.__connection_lock.acquire()
+    try:
+      kinds = self.__reader.execute(sql + ' ORDER BY kind', params).fetchall()
+      for kind_name, in kinds:
+        entities = self.__reader.execute(
+            'SELECT entity FROM Entities WHERE app = ? AND kind = ?',
+            (params[0], kind_name))
+        kind_pb = datastore_file_stub._KindSchema(
+            kind_name.encode('utf-8'),
+            (entity_pb.EntityProto(str(row[0])) for row in entities))
+        entities.close()
+
+        kind = schema.add_kind()
+        kind.CopyFrom(kind_pb)
+        if not req.properties():
+          kind.clear_property()
+    finally:
+      self.__connection_lock.release()
+
+    schema.set_more_results(False)
+
+  def _Dynamic_AllocateIds(self, allocate_ids_request, allocate_ids_response):
+    model_key = allocate_ids_request.model_key()
+    size = allocate_ids_request.size()
+
+    self.__ValidateAppId(model_key.app())
+
+    start = self.__AllocateIds(size)
+    allocate_ids_response.set_start(start)
+    allocate_ids_response.set_end(start + size - 1)
+
+  def _Dynamic_CreateIndex(self, index, id_response):
+    self.__ValidateAppId(index.app_id())
+    if index.id() != 0:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             'New index id must be 0.')
+    elif self.__FindIndex(index):
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             'Index already exists.')
+
+    self.__index_id_lock.acquire()
+    index.set_id(self.__next_index_id)
+    id_response.set_value(self.__next_index_id)
+    self.__next_index_id += 1
+    self.__index_id_lock.release()
+
+    clone = entity_pb.CompositeIndex()
+    clone.CopyFrom(index)
+    app = index.app_id()
+    clone.set_app_id(app)
+
+    self.__indexes_lock.acquire()
+    try:
+      if app not in self.__indexes:
+        self.__indexes[app] = []
+      self.__indexes[app].append(clone)
+    finally:
+      self.__indexes_lock.release()
+
+  def _Dynamic_GetIndices(self, app_str, composite_indices):
+    self.__ValidateAppId(app_str.value())
+    composite_indices.index_list().extend(
+      self.__indexes.get(app_str.value(), []))
+
+  def _Dynamic_UpdateIndex(self, index, void):
+    self.__ValidateAppId(index.app_id())
+    stored_index = self.__FindIndex(index)
+    if not stored_index:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             "Index doesn't exist.")
+    elif (index.state() != stored_index.state() and
+          index.state() not in self._INDEX_STATE_TRANSITIONS[stored_index.state()]):
+      raise apiproxy_errors.ApplicationError(
+        datastore_pb.Error.BAD_REQUEST,
+        "cannot move index state from %s to %s" %
+          (entity_pb.CompositeIndex.State_Name(stored_index.state()),
+          (entity_pb.CompositeIndex.State_Name(index.state()))))
+
+    self.__indexes_lock.acquire()
+    try:
+      stored_index.set_state(index.state())
+    finally:
+      self.__indexes_lock.release()
+
+  def _Dynamic_DeleteIndex(self, index, void):
+    self.__ValidateAppId(index.app_id())
+    stored_index = self.__FindIndex(index)
+    if not stored_index:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             "Index doesn't exist.")
+
+    app = index.app_id()
+    self.__indexes_lock.acquire()
+    try:
+      self.__indexes[app].remove(stored_index)
+    finally:
+      self.__indexes_lock.release()
+
+  def __FindIndex(self, index):
+    """Finds an existing index by definition.
+
+    Args:
+      definition: entity_pb.CompositeIndex
+
+    Returns:
+      entity_pb.CompositeIndex, if it exists; otherwise None
+    """
+    app = index.app_id()
+    self.__ValidateAppId(app)
+    if app in self.__indexes:
+      for stored_index in self.__indexes[app]:
+        if index.definition() == stored_index.definition():
+          return stored_index
+
+    return None
@@ -3276,6 +3276,8 @@ def SetupStubs(app_id, **config):
     datastore_path: Path to the file to store Datastore file stub data in.
     history_path: DEPRECATED, No-op.
     clear_datastore: If the datastore should be cleared on startup.
+    use_sqlite: Whether to store the Datastore in an SQLite database instead of
+        using the file stub.
     smtp_host: SMTP host used for sending test mail.
     smtp_port: SMTP port.
     smtp_user: SMTP user.
@@ -3291,6 +3293,7 @@ def SetupStubs(app_id, **config):
   login_url = config['login_url']
   datastore_path = config['datastore_path']
   clear_datastore = config['clear_datastore']
+  use_sqlite = config.get('use_sqlite', False)
   require_indexes = config.get('require_indexes', False)
   smtp_host = config.get('smtp_host', None)
   smtp_port = config.get('smtp_port', 25)
@@ -3304,19 +3307,27 @@ def SetupStubs(app_id, **config):
   os.environ['APPLICATION_ID'] = app_id
 
   if clear_datastore:
-    path = datastore_path
-    if os.path.lexists(path):
-      logging.info('Attempting to remove file at %s', path)
-      try:
-        remove(path)
-      except OSError, e:
-        logging.warning('Removing file failed: %s', e)
+    for path in (datastore_path,
+                 datastore_file_stub.JournalFilename(datastore_path),
+                 datastore_path + '-wal', datastore_path + '-shm'):
+      if os.path.lexists(path):
+        logging.info('Attempting to remove file at %s', path)
+        try:
+          remove(path)
+        except OSError, e:
+          logging.warning('Removing file failed: %s', e)
 
   apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
 
-  datastore = datastore_file_stub.DatastoreFileStub(
-      app_id, datastore_path, require_indexes=require_indexes,
-      trusted=trusted)
+  if use_sqlite:
+    from google.appengine.api import datastore_sqlite_stub
+    datastore = datastore_sqlite_stub.DatastoreSqliteStub(
+        app_id, datastore_path, require_indexes=require_indexes,
+        trusted=trusted)
+  else:
+    datastore = datastore_file_stub.DatastoreFileStub(
+        app_id, datastore_path, require_indexes=require_indexes,
+        trusted=trusted)
   apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', datastore)
 
   fixed_login_url = '%s?%s=%%s' % (login_url,
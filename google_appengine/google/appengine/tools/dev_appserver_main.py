@@ -35,6 +35,10 @@ Options:
                              (Default %(history_path)s)
   --require_indexes          Disallows queries that require composite indexes
                              not defined in index.yaml.
+  --use_sqlite               Store the Datastore in an SQLite database at the
+                             datastore path, instead of in memory with a
+                             pickled snapshot and journal.
+                             (Default false)
   --smtp_host=HOSTNAME       SMTP host to send test mail to.  Leaving this
                              unset will disable SMTP mail sending.
                              (Default '%(smtp_host)s')
@@ -117,6 +121,7 @@ ARG_SMTP_USER = 'smtp_user'
 ARG_STATIC_CACHING = 'static_caching'
 ARG_TEMPLATE_DIR = 'template_dir'
 ARG_TRUSTED = 'trusted'
+ARG_USE_SQLITE = 'use_sqlite'
 
 SDK_PATH = os.path.dirname(
              os.path.dirname(
@@ -150,6 +155,7 @@ DEFAULT_ARGS = {
   ARG_ALLOW_SKIPPED_FILES: False,
   ARG_STATIC_CACHING: True,
   ARG_TRUSTED: False,
+  ARG_USE_SQLITE: False,
 }
 
 API_PATHS = {'1':
@@ -276,6 +282,7 @@ def ParseArguments(argv):
         'smtp_user=',
         'template_dir=',
         'trusted',
+        'use_sqlite',
       ])
   except getopt.GetoptError, e:
     print >>sys.stderr, 'Error: %s' % e
@@ -312,6 +319,9 @@ def ParseArguments(argv):
     if option == '--require_indexes':
       option_dict[ARG_REQUIRE_INDEXES] = True
 
+    if option == '--use_sqlite':
+      option_dict[ARG_USE_SQLITE] = True
+
     if option == '--smtp_host':
       option_dict[ARG_SMTP_HOST] = value
 